@@ -0,0 +1,212 @@
+"""
+Cache Module
+In-memory LRU cache and a SQLite-backed persistent store for LLM responses.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(*parts: Any) -> str:
+    """
+    Build a stable hash key from the given parts.
+
+    Args:
+        *parts: Values identifying the cached entry (provider, prompt, ...)
+
+    Returns:
+        Hex digest suitable for use as a cache key
+    """
+    # One digest call over the joined parts; same bytes as hashing each part + separator
+    data = "".join(f"{part}\x1f" for part in parts).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache with a fixed number of entries.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class TTLCache(LRUCache):
+    """
+    LRU cache whose entries expire ttl seconds after they are stored.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = super().get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        super().set(key, (time.monotonic() + self.ttl, value))
+
+
+class ResponseCache:
+    """
+    Two-level response cache: an in-memory LRU in front of a SQLite table,
+    so cached answers survive server restarts.
+    """
+
+    def __init__(self, db_path: str, maxsize: int = 4096):
+        self.db_path = db_path
+        self._memory = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._connect()
+
+    def _connect(self) -> None:
+        try:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, response TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Persistent LLM cache unavailable, using memory only: {e}")
+            self._conn = None
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response, promoting persistent hits into memory.
+        """
+        response = self._memory.get(key)
+        if response is not None or self._conn is None:
+            return response
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is None:
+            return None
+        self._memory.set(key, row[0])
+        return row[0]
+
+    def set(self, key: str, response: str) -> None:
+        """
+        Store a response in memory and in the persistent table.
+        Empty responses are never stored, since a hit is served as is.
+        """
+        if not response or not response.strip():
+            return
+        self._memory.set(key, response)
+        if self._conn is None:
+            return
+
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, response) VALUES (?, ?)",
+                    (key, response)
+                )
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Error writing LLM cache entry: {e}")
+
+
+class SemanticCache:
+    """
+    Nearest-neighbour response cache backed by a small Chroma collection.
+    Paraphrases of a previously answered query return the stored answer.
+    """
+
+    def __init__(self, persist_directory: str, threshold: float = 0.95):
+        # Imported lazily so the exact-match caches stay free of vector store deps
+        from langchain_chroma import Chroma
+        from .embedding_utils import get_embedder
+
+        self.threshold = threshold
+        self._store = Chroma(
+            collection_name="llm_semantic_cache",
+            embedding_function=get_embedder(),
+            persist_directory=persist_directory,
+            collection_metadata={"hnsw:space": "cosine"}
+        )
+
+    @staticmethod
+    def _where(provider: str, scope: str) -> dict:
+        return {"$and": [{"provider": provider}, {"scope": scope}]}
+
+    def get(self, query: str, provider: str, scope: str = "") -> Optional[str]:
+        """
+        Return the stored answer for the closest cached query, if it is
+        within the similarity threshold.
+        """
+        try:
+            hits = self._store.similarity_search_with_score(
+                query, k=1, filter=self._where(provider, scope)
+            )
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return None
+
+        if not hits:
+            return None
+        document, distance = hits[0]
+        # Cosine distance is 1 - similarity
+        if 1.0 - distance < self.threshold:
+            return None
+        return document.metadata.get("answer")
+
+    def set(self, query: str, answer: str, provider: str, scope: str = "") -> None:
+        """
+        Store an answer under the given query. Empty answers are never stored.
+        """
+        if not answer or not answer.strip():
+            return
+        try:
+            self._store.add_texts(
+                [query],
+                metadatas=[{"answer": answer, "provider": provider, "scope": scope}]
+            )
+        except Exception as e:
+            logger.warning(f"Error writing semantic cache entry: {e}")
@@ -7,6 +7,13 @@ CHROMA_DB_DIR = "data/vectorstore/products"
 
 # Embedding model
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_DEVICE = "auto"  # Options: "auto", "cpu", "cuda"
+EMBEDDING_BATCH_SIZE = 64  # Texts per encode batch during bulk ingest (CPU)
+EMBEDDING_BATCH_SIZE_GPU = 128  # Larger batches keep the GPU saturated
+EMBEDDING_NORMALIZE = True
+EMBEDDING_BACKEND = "torch"  # Options: "torch", "onnx" (int8 ONNX Runtime on CPU)
+EMBEDDING_ONNX_DIR = "data/models/minilm-int8"  # Written by `python -m core.embed_onnx`
+QUERY_EMBEDDING_CACHE_SIZE = 10000  # Query vectors kept in memory for repeat questions
 
 # Chunking
 CHUNK_SIZE = 300
@@ -16,8 +23,19 @@ CHUNK_OVERLAP = 50
 CHUNK_SIZE_QA = CHUNK_SIZE
 CHUNK_OVERLAP_QA = CHUNK_OVERLAP
 
+# Retrieval depth per intent; sales answers compare several products, policy answers need few chunks
+RETRIEVAL_K_BY_INTENT = {"sales": 8, "refund": 3, "support": 3, "general": 5}
+RETRIEVAL_K_DEFAULT = 5
+
 # ChromaDB collection
 CHROMA_COLLECTION_NAME = "product_data"
+CHROMA_ADD_BATCH_SIZE = 200  # Records written per collection.add call
+CHROMA_GET_BATCH_SIZE = 900  # Ids per collection.get lookup (SQLite parameter limit)
+# HNSW settings, applied when a collection is first created. With normalized
+# embeddings inner product ranks like cosine but skips the norm computation.
+CHROMA_HNSW_SPACE = "ip" if EMBEDDING_NORMALIZE else "l2"
+CHROMA_HNSW_M = 16
+PRODUCT_STREAM_BATCH_SIZE = 256  # Catalog rows parsed and embedded per ingest step
 
 # Token limits (optional for LLMs later)
 LLM_CONTEXT_SIZE = 2048
@@ -35,3 +53,20 @@ GEMINI_API_KEY = None  # Set via environment variable
 MAX_TOKENS = 1000  # Increased from 500 to prevent response cutoff
 TEMPERATURE = 0.7
 LLM_THREADS = 4
+LLM_GPU_LAYERS = -1  # -1 offloads all layers when a GPU backend is available, 0 forces CPU
+LLM_N_BATCH = 512  # Prompt tokens evaluated per batch
+LLM_USE_MMAP = True
+LLM_USE_MLOCK = False  # Pin model pages in RAM; only enable when memory permits
+
+# LLM response cache
+LLM_CACHE_ENABLED = True
+LLM_CACHE_PATH = "data/llm_cache.db"
+LLM_CACHE_MAX_ENTRIES = 4096  # In-memory LRU entries in front of the SQLite store
+
+# RAG pipeline response cache (skips retrieval and generation for repeated queries)
+RAG_RESPONSE_CACHE_SIZE = 1024
+
+# Semantic response cache (paraphrase hits on previously answered queries)
+SEMANTIC_CACHE_ENABLED = True
+SEMANTIC_CACHE_DIR = "data/semantic_cache"
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Minimum cosine similarity for a hit
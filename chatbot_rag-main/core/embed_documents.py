@@ -1,40 +1,50 @@
 import json
 import logging
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from typing import List, Optional
 from langchain_core.documents import Document
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from tqdm import tqdm
 from .config import (
     DOCUMENTS_DIR,
-    EMBEDDING_MODEL_NAME,
-    CHROMA_DB_DIR,
-    CHROMA_COLLECTION_NAME,
     CHUNK_SIZE_QA,
     CHUNK_OVERLAP_QA
 )
+from .embedding_utils import (
+    add_documents_batched,
+    batch_mutations,
+    get_vectorstore,
+    persist_vectorstore
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared text splitter for Q&A chunking (stateless after construction)
+_QA_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE_QA,
+    chunk_overlap=CHUNK_OVERLAP_QA,
+    length_function=len,
+    separators=["\n\n", "\n", " ", ""]
+)
 
-def create_vectorstore() -> Chroma:
-    """
-    Create and return ChromaDB vector store instance (same as products).
-    """
-    embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
-    
-    vectorstore = Chroma(
-        collection_name=CHROMA_COLLECTION_NAME,
-        embedding_function=embedding_model,
-        persist_directory=CHROMA_DB_DIR
-    )
-    
-    return vectorstore
+# One "Q: ...\nA: ..." pair per match; the answer runs until the next blank-line-separated question
+_QA_PAIR_RE = re.compile(
+    r'^Q:[ \t]*(.+?)\s*\n[ \t]*A:[ \t]*(.+?)\s*(?=\n\s*\nQ:|\Z)',
+    re.MULTILINE | re.DOTALL
+)
+
+# Source filename keyword -> document category, checked in priority order
+_CATEGORY_KEYWORDS = (
+    ("refund", "refund"),
+    ("general", "general"),
+    ("shipping", "shipping"),
+    ("policy", "policy"),
+)
 
 
 def _parse_qa_file(file_path: Path) -> List[dict]:
@@ -45,29 +55,12 @@ def _parse_qa_file(file_path: Path) -> List[dict]:
         content = f.read()
     
     qa_pairs = []
-    sections = content.split('\n\n')
-    
-    for section in sections:
-        section = section.strip()
-        if not section:
-            continue
-            
-        lines = section.split('\n')
-        if len(lines) >= 2:
-            question = lines[0].strip()
-            answer = lines[1].strip()
-            
-            # Remove Q: and A: prefixes if present
-            if question.startswith('Q:'):
-                question = question[2:].strip()
-            if answer.startswith('A:'):
-                answer = answer[2:].strip()
-            
-            qa_pairs.append({
-                'question': question,
-                'answer': answer,
-                'full_text': f"Q: {question}\nA: {answer}"
-            })
+    for question, answer in _QA_PAIR_RE.findall(content):
+        qa_pairs.append({
+            'question': question,
+            'answer': answer,
+            'full_text': f"Q: {question}\nA: {answer}"
+        })
     
     return qa_pairs
 
@@ -78,14 +71,6 @@ def _create_document_chunks(qa_pairs: List[dict], source: str) -> List[Document]
     """
     documents = []
     
-    # Create text splitter
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE_QA,
-        chunk_overlap=CHUNK_OVERLAP_QA,
-        length_function=len,
-        separators=["\n\n", "\n", " ", ""]
-    )
-    
     for i, qa in enumerate(qa_pairs):
         # Create document for each Q&A pair
         doc = Document(
@@ -102,7 +87,7 @@ def _create_document_chunks(qa_pairs: List[dict], source: str) -> List[Document]
         # Check if chunking is needed
         if len(qa['full_text']) > CHUNK_SIZE_QA:
             # Split into chunks
-            chunks = text_splitter.split_documents([doc])
+            chunks = _QA_SPLITTER.split_documents([doc])
             for chunk_idx, chunk in enumerate(chunks):
                 chunk.metadata["chunk_index"] = chunk_idx
                 documents.append(chunk)
@@ -118,21 +103,30 @@ def _get_category_from_source(source: str) -> str:
     """
     Determine category based on source filename.
     """
-    if "refund" in source.lower():
-        return "refund"
-    elif "general" in source.lower():
-        return "general"
-    elif "shipping" in source.lower():
-        return "shipping"
-    elif "policy" in source.lower():
-        return "policy"
-    else:
-        return "general"
+    source_lower = source.lower()
+    return next(
+        (category for keyword, category in _CATEGORY_KEYWORDS if keyword in source_lower),
+        "general"
+    )
 
 
-def embed_documents(file_name: Optional[str] = None) -> None:
+def _process_file(file_path: Path) -> List[Document]:
+    """
+    Parse one Q&A file into chunked documents. Runs inside a worker process.
+    """
+    source = file_path.stem  # filename without extension
+    
+    qa_pairs = _parse_qa_file(file_path)
+    if not qa_pairs:
+        return []
+    
+    return _create_document_chunks(qa_pairs, source)
+
+
+def embed_documents(file_name: Optional[str] = None, bulk: bool = False) -> None:
     """
     Embed documents from files. Auto-scans all .txt files if no file_name provided.
+    With bulk=True the caller is responsible for persisting.
     """
     documents_path = Path(DOCUMENTS_DIR)
     
@@ -157,33 +151,42 @@ def embed_documents(file_name: Optional[str] = None) -> None:
     
     logger.info(f"Processing {len(files_to_process)} document files")
     
-    vectorstore = create_vectorstore()
-    total_documents = 0
+    # Parse files in parallel worker processes; Chroma writes stay in this process
+    all_documents = []
+    max_workers = min(len(files_to_process), os.cpu_count() or 1)
     
-    for file_path in tqdm(files_to_process, desc="Processing files"):
-        try:
-            source = file_path.stem  # filename without extension
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_process_file, file_path): file_path
+            for file_path in files_to_process
+        }
+        
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing files"):
+            file_path = futures[future]
+            try:
+                documents = future.result()
+            except Exception as e:
+                logger.error(f"Error processing {file_path.name}: {e}")
+                continue
             
-            # Parse Q&A pairs
-            qa_pairs = _parse_qa_file(file_path)
-            if not qa_pairs:
+            if not documents:
                 logger.warning(f"No Q&A pairs found in {file_path.name}")
                 continue
             
-            # Create documents with chunking
-            documents = _create_document_chunks(qa_pairs, source)
-            
-            # Add to vector store
-            if documents:
-                vectorstore.add_documents(documents)
-                total_documents += len(documents)
-                logger.info(f"Added {len(documents)} documents from {file_path.name}")
-        
-        except Exception as e:
-            logger.error(f"Error processing {file_path.name}: {e}")
+            all_documents.extend(documents)
+            logger.info(f"Parsed {len(documents)} documents from {file_path.name}")
     
-    # Persist to disk
-    vectorstore.persist()
+    # Add everything to the vector store in one batched call
+    vectorstore = get_vectorstore()
+    total_documents = 0
+    try:
+        total_documents = add_documents_batched(vectorstore, all_documents)
+    except Exception as e:
+        logger.error(f"Error adding documents to vector store: {e}")
+    
+    # Persist to disk unless the caller batches persistence
+    if not bulk:
+        persist_vectorstore(vectorstore)
     logger.info(f"Embedded and stored {total_documents} document chunks in ChromaDB")
 
 
@@ -191,29 +194,29 @@ def update_documents_by_source(source: str) -> None:
     """
     Update documents for a specific source (filename without extension).
     """
-    vectorstore = create_vectorstore()
-    
-    # Delete existing documents from this source
-    try:
-        vectorstore.delete(where={"source": source})
-        vectorstore.persist()
-        logger.info(f"Deleted existing documents from source: {source}")
-    except Exception as e:
-        logger.warning(f"Error deleting existing documents from {source}: {e}")
-    
-    # Re-add documents from this source
-    embed_documents(file_name=source)
+    with batch_mutations(get_vectorstore()) as vectorstore:
+        # Delete existing documents from this source
+        try:
+            vectorstore.delete(where={"source": source})
+            logger.info(f"Deleted existing documents from source: {source}")
+        except Exception as e:
+            logger.warning(f"Error deleting existing documents from {source}: {e}")
+        
+        # Re-add documents from this source
+        embed_documents(file_name=source, bulk=True)
 
 
-def delete_documents_by_source(source: str) -> bool:
+def delete_documents_by_source(source: str, bulk: bool = False) -> bool:
     """
     Delete all documents from a specific source.
+    With bulk=True the caller is responsible for persisting.
     """
-    vectorstore = create_vectorstore()
+    vectorstore = get_vectorstore()
     
     try:
         vectorstore.delete(where={"source": source})
-        vectorstore.persist()
+        if not bulk:
+            persist_vectorstore(vectorstore)
         logger.info(f"Deleted all documents from source: {source}")
         return True
     except Exception as e:
@@ -225,18 +228,16 @@ def update_all_documents() -> None:
     """
     Update all documents by deleting all document sources and re-adding.
     """
-    vectorstore = create_vectorstore()
-    
-    # Delete all documents (keep products)
-    try:
-        vectorstore.delete(where={"document_type": "faq"})
-        vectorstore.persist()
-        logger.info("Deleted all existing documents")
-    except Exception as e:
-        logger.warning(f"Error deleting existing documents: {e}")
-    
-    # Re-add all documents
-    embed_documents()
+    with batch_mutations(get_vectorstore()) as vectorstore:
+        # Delete all documents (keep products)
+        try:
+            vectorstore.delete(where={"document_type": "faq"})
+            logger.info("Deleted all existing documents")
+        except Exception as e:
+            logger.warning(f"Error deleting existing documents: {e}")
+        
+        # Re-add all documents
+        embed_documents(bulk=True)
 
 
 def list_document_sources() -> List[str]:
@@ -0,0 +1,108 @@
+"""
+ONNX Embedding Module
+Exports the sentence-transformer model to ONNX with dynamic int8 quantization
+and serves embeddings from an ONNX Runtime CPU session.
+"""
+
+import logging
+import os
+from typing import List
+from langchain_core.embeddings import Embeddings
+from .config import (
+    EMBEDDING_MODEL_NAME,
+    EMBEDDING_ONNX_DIR,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_NORMALIZE
+)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+
+
+def export_quantized_model(save_dir: str = EMBEDDING_ONNX_DIR) -> str:
+    """
+    Export the embedding model to ONNX and quantize it to int8.
+
+    Args:
+        save_dir: Directory to write the quantized model and tokenizer to
+
+    Returns:
+        Path to the quantized ONNX model file
+    """
+    try:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+    except ImportError:
+        raise ImportError("Missing optimum[onnxruntime] package")
+
+    model_id = f"sentence-transformers/{EMBEDDING_MODEL_NAME}"
+    model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+
+    # Dynamic quantization: weights int8, activations quantized at runtime
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantizer.quantize(
+        save_dir=save_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False)
+    )
+    tokenizer.save_pretrained(save_dir)
+
+    model_path = os.path.join(save_dir, QUANTIZED_MODEL_FILE)
+    logger.info(f"Exported int8 ONNX embedding model to {model_path}")
+    return model_path
+
+
+class ONNXEmbeddings(Embeddings):
+    """
+    LangChain embeddings backed by a quantized ONNX Runtime session.
+    Produces the same mean-pooled sentence vectors as sentence-transformers.
+    """
+
+    def __init__(self, model_dir: str = EMBEDDING_ONNX_DIR, batch_size: int = EMBEDDING_BATCH_SIZE):
+        try:
+            import numpy as np
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+        except ImportError:
+            raise ImportError("Missing onnxruntime package")
+
+        model_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Quantized ONNX model not found: {model_path}")
+
+        self._np = np
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self._input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _encode_batch(self, texts: List[str]):
+        np = self._np
+        encoded = self.tokenizer(texts, padding=True, truncation=True, return_tensors="np")
+        inputs = {name: value for name, value in encoded.items() if name in self._input_names}
+        token_embeddings = self.session.run(None, inputs)[0]
+
+        # Mean pooling over non-padding tokens
+        mask = encoded["attention_mask"][..., None].astype(token_embeddings.dtype)
+        embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if EMBEDDING_NORMALIZE:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self._encode_batch(texts[start:start + self.batch_size]).tolist())
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode_batch([text])[0].tolist()
+
+
+if __name__ == "__main__":
+    export_quantized_model()
@@ -1,93 +1,125 @@
-import json
+import functools
+import itertools
 import logging
-from typing import List
+import operator
+import os
+from typing import Iterator, List
+import orjson
 from langchain_core.documents import Document
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import Chroma
 from tqdm import tqdm
-from .config import PRODUCT_JSON_PATH, EMBEDDING_MODEL_NAME, CHROMA_DB_DIR
+from .config import PRODUCT_JSON_PATH, PRODUCT_STREAM_BATCH_SIZE
+from .embedding_utils import (
+    add_documents_batched,
+    batch_mutations,
+    document_id,
+    ensure_document_ids,
+    get_existing_ids,
+    get_vectorstore,
+    persist_vectorstore
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Product fields rendered into the document text, in template order
+_PRODUCT_FIELDS = (
+    "product",
+    "product_group",
+    "product_category",
+    "product_type",
+    "product_description",
+    "unit_of_measure",
+    "current_wholesale_price",
+    "current_retail_price",
+    "tax_exempt_yn",
+    "promo_yn",
+    "new_product_yn",
+)
+_PRODUCT_FIELDS_GETTER = operator.itemgetter(*_PRODUCT_FIELDS)
+_PRODUCT_TEMPLATE = (
+    "Product: {}\n"
+    "Group: {}\n"
+    "Category: {}\n"
+    "Type: {}\n"
+    "Description: {}\n"
+    "Size: {}\n"
+    "Wholesale Price: {}\n"
+    "Retail Price: {}\n"
+    "Tax Exempt: {}\n"
+    "Promo: {}\n"
+    "New Product: {}"
+).format
 
-def embed_products() -> None:
+
+def _iter_products() -> Iterator[dict]:
     """
-    Load products from JSON and embed them into ChromaDB vector store.
+    Yield products from the catalog JSON one at a time.
+    Streams with ijson when installed, otherwise parses the whole file with orjson.
     """
-    # Load products from JSON
-    with open(PRODUCT_JSON_PATH, 'r', encoding='utf-8') as f:
-        products = json.load(f)
+    try:
+        import ijson
+    except ImportError:
+        with open(PRODUCT_JSON_PATH, 'rb') as f:
+            yield from orjson.loads(f.read())
+        return
     
-    # Convert to documents
-    documents = []
-    for row in tqdm(products, desc="Converting to documents"):
-        content = (
-            f"Product: {row['product']}\n"
-            f"Group: {row['product_group']}\n"
-            f"Category: {row['product_category']}\n"
-            f"Type: {row['product_type']}\n"
-            f"Description: {row['product_description']}\n"
-            f"Size: {row['unit_of_measure']}\n"
-            f"Wholesale Price: {row['current_wholesale_price']}\n"
-            f"Retail Price: {row['current_retail_price']}\n"
-            f"Tax Exempt: {row['tax_exempt_yn']}\n"
-            f"Promo: {row['promo_yn']}\n"
-            f"New Product: {row['new_product_yn']}"
-        )
+    with open(PRODUCT_JSON_PATH, 'rb') as f:
+        # use_float keeps prices as floats rather than Decimal, matching orjson
+        yield from ijson.items(f, 'item', use_float=True)
 
-        metadata = {
-            "product_id": str(row["product_id"]),
-            "product": row["product"],
-            "category": row["product_category"],
-            "type": "product",
-            "promo": row["promo_yn"],
-            "new": row["new_product_yn"],
-            "source": "product_json"
-        }
 
-        documents.append(Document(page_content=content, metadata=metadata))
-    
-    vectorstore = create_vectorstore()
-    vectorstore.add_documents(documents)
-    vectorstore.persist() 
-    
-    logger.info(f"Embedded and stored {len(documents)} product documents in ChromaDB")
+@functools.lru_cache(maxsize=1)
+def _products_by_id(mtime: float) -> dict:
+    # mtime is only the cache key; a changed catalog file gets a fresh index
+    return {str(product["product_id"]): product for product in _iter_products()}
 
 
-def create_vectorstore() -> Chroma:
+def _load_products_by_id() -> dict:
     """
-    Create and return ChromaDB vector store instance.
+    Return the catalog indexed by product_id, rebuilt only when the JSON file changes.
     """
-    embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+    return _products_by_id(os.path.getmtime(PRODUCT_JSON_PATH))
+
+
+def _iter_batches(items: Iterator, size: int) -> Iterator[list]:
+    """
+    Group an iterator into lists of at most size items.
+    """
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def embed_products(bulk: bool = False) -> None:
+    """
+    Load products from JSON and embed them into ChromaDB vector store.
+    Products are parsed, embedded and written in PRODUCT_STREAM_BATCH_SIZE
+    groups so the full catalog is never held in memory at once.
+    With bulk=True the caller is responsible for persisting.
+    """
+    vectorstore = get_vectorstore()
+    total = 0
+    
+    products = tqdm(_iter_products(), desc="Converting to documents")
+    for batch in _iter_batches(products, PRODUCT_STREAM_BATCH_SIZE):
+        documents = [_create_product_document(row) for row in batch]
+        total += add_documents_batched(vectorstore, documents)
     
-    vectorstore = Chroma(
-        collection_name="product_data",
-        embedding_function=embedding_model,
-        persist_directory=CHROMA_DB_DIR
-    )
+    if not bulk:
+        persist_vectorstore(vectorstore)
     
-    return vectorstore
+    logger.info(f"Embedded and stored {total} product documents in ChromaDB")
 
 
 def _create_product_document(product_data: dict) -> Document:
     """
     Helper function to create a Document from product data.
     """
-    content = (
-        f"Product: {product_data['product']}\n"
-        f"Group: {product_data['product_group']}\n"
-        f"Category: {product_data['product_category']}\n"
-        f"Type: {product_data['product_type']}\n"
-        f"Description: {product_data['product_description']}\n"
-        f"Size: {product_data['unit_of_measure']}\n"
-        f"Wholesale Price: {product_data['current_wholesale_price']}\n"
-        f"Retail Price: {product_data['current_retail_price']}\n"
-        f"Tax Exempt: {product_data['tax_exempt_yn']}\n"
-        f"Promo: {product_data['promo_yn']}\n"
-        f"New Product: {product_data['new_product_yn']}"
-    )
+    content = _PRODUCT_TEMPLATE(*_PRODUCT_FIELDS_GETTER(product_data))
 
     metadata = {
         "product_id": str(product_data["product_id"]),
@@ -102,16 +134,18 @@ def _create_product_document(product_data: dict) -> Document:
     return Document(page_content=content, metadata=metadata)
 
 
-def delete_product_by_id(product_id: str) -> bool:
+def delete_product_by_id(product_id: str, bulk: bool = False) -> bool:
     """
     Delete a specific product by product_id.
+    With bulk=True the caller is responsible for persisting.
     """
-    vectorstore = create_vectorstore()
+    vectorstore = get_vectorstore()
     
     try:
         # Delete by product_id filter
         vectorstore.delete(where={"product_id": str(product_id)})
-        vectorstore.persist()
+        if not bulk:
+            persist_vectorstore(vectorstore)
         logger.info(f"Deleted product with ID: {product_id}")
         return True
     except Exception as e:
@@ -119,14 +153,15 @@ def delete_product_by_id(product_id: str) -> bool:
         return False
 
 
-def add_new_product(product_data: dict) -> bool:
+def add_new_product(product_data: dict, bulk: bool = False) -> bool:
     """
     Add a single new product, checking for duplicates first.
+    With bulk=True the caller is responsible for persisting.
     """
     product_id = str(product_data["product_id"])
     
     # Check if product already exists
-    vectorstore = create_vectorstore()
+    vectorstore = get_vectorstore()
     existing = vectorstore.get(where={"product_id": product_id})
     
     if existing['ids']:
@@ -136,8 +171,9 @@ def add_new_product(product_data: dict) -> bool:
     # Add new product
     try:
         document = _create_product_document(product_data)
-        vectorstore.add_documents([document])
-        vectorstore.persist()
+        add_documents_batched(vectorstore, [document])
+        if not bulk:
+            persist_vectorstore(vectorstore)
         logger.info(f"Added new product: {product_id}")
         return True
     except Exception as e:
@@ -145,33 +181,27 @@ def add_new_product(product_data: dict) -> bool:
         return False
 
 
-def update_product_by_id(product_id: str) -> bool:
+def update_product_by_id(product_id: str, bulk: bool = False) -> bool:
     """
     Update a specific product by product_id.
     Loads updated data from JSON file.
+    With bulk=True the caller is responsible for persisting.
     """
-    # Load products from JSON
-    with open(PRODUCT_JSON_PATH, 'r', encoding='utf-8') as f:
-        products = json.load(f)
-    
     # Find the product to update
-    product_data = None
-    for product in products:
-        if str(product["product_id"]) == str(product_id):
-            product_data = product
-            break
+    product_data = _load_products_by_id().get(str(product_id))
     
     if not product_data:
         logger.error(f"Product {product_id} not found in JSON file")
         return False
     
     # Delete existing and add updated
-    if delete_product_by_id(product_id):
+    if delete_product_by_id(product_id, bulk=True):
         try:
-            vectorstore = create_vectorstore()
+            vectorstore = get_vectorstore()
             document = _create_product_document(product_data)
-            vectorstore.add_documents([document])
-            vectorstore.persist()
+            add_documents_batched(vectorstore, [document])
+            if not bulk:
+                persist_vectorstore(vectorstore)
             logger.info(f"Updated product: {product_id}")
             return True
         except Exception as e:
@@ -185,54 +215,61 @@ def update_all_products() -> None:
     """
     Update entire product collection by deleting all products and re-adding.
     """
-    vectorstore = create_vectorstore()
-    
-    # Delete all products by source
-    try:
-        vectorstore.delete(where={"source": "product_json"})
-        vectorstore.persist()
-        logger.info("Deleted all existing products")
-    except Exception as e:
-        logger.warning(f"Error deleting existing products: {e}")
-    
-    # Re-add all products
-    embed_products()
+    with batch_mutations(get_vectorstore()) as vectorstore:
+        # Delete all products by source
+        try:
+            vectorstore.delete(where={"source": "product_json"})
+            logger.info("Deleted all existing products")
+        except Exception as e:
+            logger.warning(f"Error deleting existing products: {e}")
+        
+        # Re-add all products
+        embed_products(bulk=True)
 
 
-def embed_products_safe() -> None:
+def embed_products_safe(bulk: bool = False) -> None:
     """
     Embed products with duplicate checking - only adds new products.
+    With bulk=True the caller is responsible for persisting.
     """
-    # Load products from JSON
-    with open(PRODUCT_JSON_PATH, 'r', encoding='utf-8') as f:
-        products = json.load(f)
-    
-    vectorstore = create_vectorstore()
-    new_documents = []
+    vectorstore = get_vectorstore()
+    added = 0
     skipped = 0
     
-    for row in tqdm(products, desc="Checking for duplicates"):
-        product_id = str(row["product_id"])
+    # Legacy records get their deterministic ids first, so the id lookup finds them
+    ensure_document_ids(vectorstore)
+    
+    products = tqdm(_iter_products(), desc="Checking for duplicates")
+    for batch in _iter_batches(products, PRODUCT_STREAM_BATCH_SIZE):
+        documents = [_create_product_document(row) for row in batch]
         
-        # Check if product already exists
-        existing = vectorstore.get(where={"product_id": product_id})
+        # One id lookup per batch instead of one metadata filter per product
+        existing_ids = get_existing_ids(vectorstore, [document_id(doc) for doc in documents])
+        new_documents = [doc for doc in documents if document_id(doc) not in existing_ids]
         
-        if existing['ids']:
-            skipped += 1
-            continue
+        # Records stored under another id (legacy random ids) still carry product_id
+        if new_documents:
+            stored = vectorstore.get(
+                where={"product_id": {"$in": [doc.metadata["product_id"] for doc in new_documents]}},
+                include=["metadatas"]
+            )
+            stored_product_ids = {metadata["product_id"] for metadata in stored["metadatas"]}
+            new_documents = [
+                doc for doc in new_documents if doc.metadata["product_id"] not in stored_product_ids
+            ]
+        skipped += len(documents) - len(new_documents)
         
-        # Add to new documents list
-        document = _create_product_document(row)
-        new_documents.append(document)
+        # Add only new documents
+        if new_documents:
+            added += add_documents_batched(vectorstore, new_documents)
     
-    # Add only new documents
-    if new_documents:
-        vectorstore.add_documents(new_documents)
-        vectorstore.persist()
-        logger.info(f"Added {len(new_documents)} new products")
+    if added:
+        if not bulk:
+            persist_vectorstore(vectorstore)
+        logger.info(f"Added {added} new products")
     
     if skipped > 0:
         logger.info(f"Skipped {skipped} existing products")
     
-    total_count = len(new_documents) + skipped
+    total_count = added + skipped
     logger.info(f"Total products processed: {total_count}")
@@ -0,0 +1,343 @@
+"""
+Embedding Utilities Module
+Shared helpers for encoding documents and writing them to ChromaDB in bulk.
+"""
+
+import functools
+import hashlib
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_chroma import Chroma
+from langchain_huggingface import HuggingFaceEmbeddings
+from .config import (
+    CHROMA_DB_DIR,
+    CHROMA_COLLECTION_NAME,
+    CHROMA_ADD_BATCH_SIZE,
+    CHROMA_GET_BATCH_SIZE,
+    CHROMA_HNSW_SPACE,
+    CHROMA_HNSW_M,
+    EMBEDDING_MODEL_NAME,
+    EMBEDDING_DEVICE,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_SIZE_GPU,
+    EMBEDDING_NORMALIZE,
+    EMBEDDING_BACKEND,
+    QUERY_EMBEDDING_CACHE_SIZE
+)
+from .cache import LRUCache
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def resolve_embedding_device() -> str:
+    """
+    Resolve the configured embedding device, auto-detecting CUDA when set to "auto".
+    """
+    if EMBEDDING_DEVICE != "auto":
+        return EMBEDDING_DEVICE
+    
+    try:
+        import torch
+    except ImportError:
+        return "cpu"
+    
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def create_embedding_model() -> Embeddings:
+    """
+    Create the sentence-transformer embedding model on the best available device.
+    With EMBEDDING_BACKEND = "onnx" on CPU, the int8 ONNX model is used instead
+    when it has been exported; otherwise this falls back to PyTorch.
+    """
+    device = resolve_embedding_device()
+    
+    if EMBEDDING_BACKEND == "onnx" and device == "cpu":
+        try:
+            from .embed_onnx import ONNXEmbeddings
+            embedding_model = ONNXEmbeddings()
+            logger.info(f"Loaded int8 ONNX embedding model {EMBEDDING_MODEL_NAME}")
+            return embedding_model
+        except (ImportError, FileNotFoundError) as e:
+            logger.warning(f"ONNX embeddings unavailable, using PyTorch: {e}")
+    
+    batch_size = EMBEDDING_BATCH_SIZE_GPU if device == "cuda" else EMBEDDING_BATCH_SIZE
+    
+    embedding_model = HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        model_kwargs={"device": device},
+        encode_kwargs={
+            "batch_size": batch_size,
+            "normalize_embeddings": EMBEDDING_NORMALIZE
+        }
+    )
+    
+    logger.info(f"Loaded embedding model {EMBEDDING_MODEL_NAME} on {device} (batch size {batch_size})")
+    return embedding_model
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Embedding model wrapper that remembers query vectors.
+    
+    Retrieval and the semantic response cache both embed the incoming query,
+    and test suites and FAQs repeat questions, so query vectors are kept in
+    an LRU. Document embedding is passed straight through.
+    """
+    
+    def __init__(self, model: Embeddings, maxsize: int = QUERY_EMBEDDING_CACHE_SIZE):
+        self.model = model
+        self._cache = LRUCache(maxsize)
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.embed_documents(texts)
+    
+    def embed_query(self, text: str) -> List[float]:
+        vector = self._cache.get(text)
+        if vector is None:
+            # Stored as a tuple so callers cannot mutate the cached vector
+            vector = tuple(self.model.embed_query(text))
+            self._cache.set(text, vector)
+        return list(vector)
+    
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed several queries, encoding only the uncached ones in one batch.
+        """
+        vectors = {}
+        missing = []
+        for text in dict.fromkeys(texts):
+            vector = self._cache.get(text)
+            if vector is None:
+                missing.append(text)
+            else:
+                vectors[text] = vector
+        
+        if missing:
+            for text, vector in zip(missing, self.model.embed_documents(missing)):
+                vectors[text] = tuple(vector)
+                self._cache.set(text, vectors[text])
+        
+        return [list(vectors[text]) for text in texts]
+
+
+@functools.lru_cache(maxsize=1)
+def get_embedder() -> CachedQueryEmbeddings:
+    """
+    Return the process-wide embedding model, loading it on first use.
+    """
+    return CachedQueryEmbeddings(create_embedding_model())
+
+
+@functools.lru_cache(maxsize=None)
+def get_vectorstore(persist_directory: str = CHROMA_DB_DIR) -> Chroma:
+    """
+    Return the shared ChromaDB vector store handle for a persist directory.
+    """
+    return Chroma(
+        collection_name=CHROMA_COLLECTION_NAME,
+        embedding_function=get_embedder(),
+        persist_directory=persist_directory,
+        collection_metadata={"hnsw:space": CHROMA_HNSW_SPACE, "hnsw:M": CHROMA_HNSW_M}
+    )
+
+
+def corpus_version(persist_directory: str = CHROMA_DB_DIR) -> int:
+    """
+    Return a token that changes whenever the persisted vector store is written.
+    
+    Response caches mix this into their keys, so re-embedding products or
+    documents (from any process) invalidates answers built on the old corpus.
+    """
+    version = 0
+    for name in ("chroma.sqlite3", "chroma.sqlite3-wal"):
+        try:
+            version = max(version, os.stat(os.path.join(persist_directory, name)).st_mtime_ns)
+        except OSError:
+            continue
+    return version
+
+
+def persist_vectorstore(vectorstore: Chroma) -> None:
+    """
+    Flush the vector store to disk.
+    langchain_chroma stores persist automatically through the Chroma client,
+    so this is only a real call for handles that still expose persist().
+    """
+    persist = getattr(vectorstore, "persist", None)
+    if persist is not None:
+        persist()
+
+
+@contextmanager
+def batch_mutations(vectorstore: Chroma) -> Iterator[Chroma]:
+    """
+    Group several vector store mutations and persist once when the block exits.
+    Pass bulk=True to the CRUD helpers inside the block so they skip their own persist.
+    """
+    yield vectorstore
+    persist_vectorstore(vectorstore)
+
+
+def document_id(document: Document) -> str:
+    """
+    Return a deterministic vector store id for a document.
+    
+    Products are keyed by product_id so re-ingesting a product replaces it;
+    other chunks are keyed by a hash of their source and content.
+    """
+    product_id = document.metadata.get("product_id")
+    if product_id is not None:
+        return f"product:{product_id}"
+    
+    hasher = hashlib.blake2b(digest_size=8)
+    hasher.update(str(document.metadata.get("source", "")).encode("utf-8"))
+    hasher.update(b"\x1f")
+    hasher.update(document.page_content.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def get_existing_ids(vectorstore: Chroma, ids: List[str]) -> set:
+    """
+    Return the subset of ids already stored in the collection.
+    
+    Lookups are by primary id (an indexed IN query) and are chunked to stay
+    under SQLite's bound-parameter limit.
+    """
+    present = set()
+    for start in range(0, len(ids), CHROMA_GET_BATCH_SIZE):
+        result = vectorstore._collection.get(ids=ids[start:start + CHROMA_GET_BATCH_SIZE], include=[])
+        present.update(result["ids"])
+    return present
+
+
+# Collections already checked for legacy ids in this process
+_rekeyed_collections = set()
+_rekey_lock = threading.Lock()
+
+
+def ensure_document_ids(vectorstore: Chroma) -> int:
+    """
+    Re-key records stored under ids other than document_id(), once per collection per process.
+    
+    Stores built before deterministic ids hold random UUIDs; upserting under
+    the new ids would otherwise add a second copy of every product and FAQ
+    chunk. Stored embeddings are reused, so nothing is re-encoded.
+    
+    Returns:
+        Number of legacy records re-keyed
+    """
+    collection = vectorstore._collection
+    with _rekey_lock:
+        if collection.id in _rekeyed_collections:
+            return 0
+        count = _rekey_documents(vectorstore)
+        _rekeyed_collections.add(collection.id)
+    
+    if count:
+        logger.info(f"Re-keyed {count} legacy vector store records to deterministic ids")
+    return count
+
+
+def _rekey_documents(vectorstore: Chroma) -> int:
+    collection = vectorstore._collection
+    stale_ids = []
+    replacements = {}
+    
+    # Page through the whole collection; nothing is written until the scan is done
+    offset = 0
+    while True:
+        page = collection.get(
+            include=["documents", "metadatas", "embeddings"],
+            limit=CHROMA_GET_BATCH_SIZE,
+            offset=offset
+        )
+        if not page["ids"]:
+            break
+        offset += len(page["ids"])
+        
+        for record_id, text, metadata, embedding in zip(
+            page["ids"], page["documents"], page["metadatas"], page["embeddings"]
+        ):
+            new_id = document_id(Document(page_content=text or "", metadata=metadata or {}))
+            if new_id != record_id:
+                stale_ids.append(record_id)
+                # Legacy duplicates of one record collapse into a single copy
+                replacements.setdefault(new_id, (text, metadata, embedding))
+    
+    if not stale_ids:
+        return 0
+    
+    # A record already stored under its deterministic id is kept as is
+    existing = get_existing_ids(vectorstore, list(replacements))
+    items = [(new_id, record) for new_id, record in replacements.items() if new_id not in existing]
+    for start in range(0, len(items), CHROMA_ADD_BATCH_SIZE):
+        batch = items[start:start + CHROMA_ADD_BATCH_SIZE]
+        collection.upsert(
+            ids=[new_id for new_id, _ in batch],
+            embeddings=[embedding for _, (_, _, embedding) in batch],
+            documents=[text for _, (text, _, _) in batch],
+            metadatas=[metadata for _, (_, metadata, _) in batch]
+        )
+    
+    for start in range(0, len(stale_ids), CHROMA_GET_BATCH_SIZE):
+        collection.delete(ids=stale_ids[start:start + CHROMA_GET_BATCH_SIZE])
+    
+    return len(stale_ids)
+
+
+def add_documents_batched(vectorstore: Chroma, documents: List[Document]) -> int:
+    """
+    Embed documents once in length-sorted batches and upsert them into the vector store.
+    
+    Sorting by content length keeps similarly sized texts in the same encode
+    batch, so far fewer padding tokens are pushed through the model. The
+    embeddings are handed to the collection directly, so Chroma does not
+    re-embed anything, and writes go out in CHROMA_ADD_BATCH_SIZE chunks so
+    each chunk is committed as one insert. Ids come from document_id(), so
+    re-running an ingest updates records in place instead of duplicating them.
+    
+    Args:
+        vectorstore: Target Chroma vector store
+        documents: Documents to embed and store
+        
+    Returns:
+        Number of documents written
+    """
+    if not documents:
+        return 0
+    
+    # Stores written before deterministic ids are re-keyed first, so the upsert
+    # below replaces their records instead of adding copies
+    ensure_document_ids(vectorstore)
+    
+    # Collapse duplicates (last one wins) since Chroma rejects repeated ids in one call
+    unique = {document_id(doc): doc for doc in documents}
+    
+    # Encode and write in ascending length order
+    ordered = sorted(unique.items(), key=lambda item: len(item[1].page_content))
+    batch_size = CHROMA_ADD_BATCH_SIZE
+    max_batch_size = getattr(vectorstore._client, "max_batch_size", None)
+    if max_batch_size:
+        batch_size = min(batch_size, max_batch_size)
+    
+    for start in range(0, len(ordered), batch_size):
+        batch = ordered[start:start + batch_size]
+        texts = [doc.page_content for _, doc in batch]
+        
+        vectorstore._collection.upsert(
+            ids=[doc_id for doc_id, _ in batch],
+            embeddings=vectorstore.embeddings.embed_documents(texts),
+            documents=texts,
+            metadatas=[doc.metadata for _, doc in batch]
+        )
+    
+    logger.info(f"Embedded {len(ordered)} documents in length-sorted batches")
+    return len(ordered)
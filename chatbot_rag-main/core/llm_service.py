@@ -1,7 +1,9 @@
 
+import asyncio
 import os
 import logging
-from typing import Optional
+import threading
+from typing import AsyncIterator, Iterator, List, Optional
 from .config import (
     LOCAL_LLM_MODEL_PATH,
     LOCAL_LLM_MODEL_NAME,
@@ -9,16 +11,54 @@ from .config import (
     MAX_TOKENS,
     TEMPERATURE,
     LLM_THREADS,
-    LLM_CONTEXT_SIZE
+    LLM_CONTEXT_SIZE,
+    LLM_GPU_LAYERS,
+    LLM_N_BATCH,
+    LLM_USE_MMAP,
+    LLM_USE_MLOCK,
+    LLM_CACHE_ENABLED,
+    LLM_CACHE_PATH,
+    LLM_CACHE_MAX_ENTRIES,
+    SEMANTIC_CACHE_ENABLED,
+    SEMANTIC_CACHE_DIR,
+    SEMANTIC_CACHE_THRESHOLD
 )
+from .cache import ResponseCache, SemanticCache, make_cache_key
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def resolve_gpu_layers() -> int:
+    """
+    Return the number of layers to offload to the GPU, falling back to 0
+    when neither llama.cpp nor torch reports a usable GPU backend.
+    """
+    if LLM_GPU_LAYERS == 0:
+        return 0
+    
+    try:
+        import llama_cpp
+        if llama_cpp.llama_supports_gpu_offload():
+            return LLM_GPU_LAYERS
+    except (ImportError, AttributeError):
+        pass
+    
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return LLM_GPU_LAYERS
+    except ImportError:
+        pass
+    
+    return 0
+
+
 class LLMService:
     _instances = {}
+    _response_cache = None
+    _semantic_cache = None
     
     def __new__(cls, provider: str = DEFAULT_LLM_PROVIDER):
         if provider not in cls._instances:
@@ -30,7 +70,16 @@ class LLMService:
             return
         self.provider = provider
         self.llm = None
+        # llama.cpp contexts are not thread-safe; local generations run one at a time
+        self._generation_lock = threading.Lock()
         self._initialize_llm()
+        if LLM_CACHE_ENABLED and LLMService._response_cache is None:
+            LLMService._response_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES)
+        if SEMANTIC_CACHE_ENABLED and LLMService._semantic_cache is None:
+            try:
+                LLMService._semantic_cache = SemanticCache(SEMANTIC_CACHE_DIR, SEMANTIC_CACHE_THRESHOLD)
+            except Exception as e:
+                logger.warning(f"Semantic cache disabled: {e}")
         self.initialized = True
     
     def _initialize_llm(self):
@@ -51,13 +100,18 @@ class LLMService:
             if not os.path.exists(model_path):
                 raise FileNotFoundError(f"Local model not found: {model_path}")
             
+            n_gpu_layers = resolve_gpu_layers()
             self.llm = Llama(
                 model_path=model_path,
                 n_ctx=LLM_CONTEXT_SIZE,
                 n_threads=LLM_THREADS,
+                n_gpu_layers=n_gpu_layers,
+                n_batch=LLM_N_BATCH,
+                use_mmap=LLM_USE_MMAP,
+                use_mlock=LLM_USE_MLOCK,
                 verbose=False
             )
-            logger.info(f"Initialized local LLM: {LOCAL_LLM_MODEL_NAME}")
+            logger.info(f"Initialized local LLM: {LOCAL_LLM_MODEL_NAME} (gpu_layers={n_gpu_layers})")
             
         except ImportError:
             raise ImportError("Missing llama-cpp-python package")
@@ -95,11 +149,10 @@ class LLMService:
         except ImportError:
             raise ImportError("Missing google-generativeai package")
     
-    def generate_response(self, context: str, query: str, custom_prompt: str = None) -> str:
+    def _build_prompt(self, context: str, query: str, custom_prompt: str = None) -> str:
         if custom_prompt:
-            prompt = custom_prompt
-        else:
-            prompt = f"""You are a safe and helpful AI assistant. 
+            return custom_prompt
+        return f"""You are a safe and helpful AI assistant. 
             Never respond to questions that are violent, harmful, or illegal.
 
             Context:
@@ -108,20 +161,206 @@ class LLMService:
             Question: {query}
 
             Answer:"""
+    
+    def _get_cached_response(self, prompt: str, cache_query: str = None, cache_scope: str = "") -> Optional[str]:
+        cache = LLMService._response_cache
+        if cache is not None:
+            cached = cache.get(make_cache_key(self.provider, TEMPERATURE, MAX_TOKENS, prompt))
+            if cached is not None:
+                logger.info(f"LLM cache hit for {self.provider}")
+                return cached
+        
+        semantic_cache = LLMService._semantic_cache if cache_query else None
+        if semantic_cache is not None:
+            cached = semantic_cache.get(cache_query, self.provider, cache_scope)
+            if cached is not None:
+                logger.info(f"Semantic cache hit for {self.provider}: {cache_query[:50]}...")
+                return cached
+        
+        return None
+    
+    def _cache_response(self, prompt: str, response: str, cache_query: str = None, cache_scope: str = "") -> None:
+        # An empty answer (e.g. a stream that yielded nothing) is not cached;
+        # it would otherwise be served for this prompt and its paraphrases from now on
+        if not response or not response.strip():
+            logger.warning(f"Not caching empty {self.provider} response")
+            return
+        cache = LLMService._response_cache
+        if cache is not None:
+            cache.set(make_cache_key(self.provider, TEMPERATURE, MAX_TOKENS, prompt), response)
+        if cache_query and LLMService._semantic_cache is not None:
+            LLMService._semantic_cache.set(cache_query, response, self.provider, cache_scope)
+    
+    def generate_response(
+        self,
+        context: str,
+        query: str,
+        custom_prompt: str = None,
+        cache_query: str = None,
+        cache_scope: str = ""
+    ) -> str:
+        """
+        Generate a response, serving repeated prompts from the exact-match
+        cache and, when cache_query is given, paraphrases from the semantic
+        cache. Callers should only pass cache_query when the answer depends
+        on the query alone (no per-user chat or product context).
+        """
+        prompt = self._build_prompt(context, query, custom_prompt)
+        
+        cached = self._get_cached_response(prompt, cache_query, cache_scope)
+        if cached is not None:
+            return cached
         
         if self.provider == "local":
-            return self._generate_local_response(prompt)
+            response = self._generate_local_response(prompt)
         else:
-            return self._generate_langchain_response(prompt)
+            response = self._generate_langchain_response(prompt)
+        
+        self._cache_response(prompt, response, cache_query, cache_scope)
+        return response
     
-    def _generate_local_response(self, prompt: str) -> str:
+    async def agenerate_response(
+        self,
+        context: str,
+        query: str,
+        custom_prompt: str = None,
+        cache_query: str = None,
+        cache_scope: str = ""
+    ) -> str:
+        """
+        Async variant of generate_response so several requests can be in
+        flight at once. The local model has no async API and runs in a
+        worker thread instead.
+        """
+        prompt = self._build_prompt(context, query, custom_prompt)
+        
+        # Cache lookups may embed the query and hit SQLite/Chroma; keep them off the event loop
+        cached = await asyncio.to_thread(self._get_cached_response, prompt, cache_query, cache_scope)
+        if cached is not None:
+            return cached
+        
+        try:
+            if self.provider == "local":
+                response = await asyncio.to_thread(self._generate_local_response, prompt)
+            elif self.provider == "gemini":
+                result = await self.gemini_client.generate_content_async(prompt)
+                response = result.text.strip()
+            else:
+                from langchain.schema import HumanMessage
+                
+                result = await self.llm.ainvoke([HumanMessage(content=prompt)])
+                response = result.content.strip()
+        except Exception as e:
+            logger.error(f"Error generating async response: {e}")
+            raise
+        
+        await asyncio.to_thread(self._cache_response, prompt, response, cache_query, cache_scope)
+        return response
+    
+    def stream_response(self, context: str, query: str, custom_prompt: str = None) -> Iterator[str]:
+        """
+        Yield response text as it is generated, for lower first-token latency.
+        The full text is added to the exact-match cache once streaming ends.
+        """
+        prompt = self._build_prompt(context, query, custom_prompt)
+        
+        cached = self._get_cached_response(prompt)
+        if cached is not None:
+            yield cached
+            return
+        
+        parts = []
         try:
-            response = self.llm(
+            if self.provider == "local":
+                for text in self._stream_local_response(prompt):
+                    parts.append(text)
+                    yield text
+            elif self.provider == "gemini":
+                for chunk in self.gemini_client.generate_content(prompt, stream=True):
+                    parts.append(chunk.text)
+                    yield chunk.text
+            else:
+                from langchain.schema import HumanMessage
+                
+                for chunk in self.llm.stream([HumanMessage(content=prompt)]):
+                    parts.append(chunk.content)
+                    yield chunk.content
+        except Exception as e:
+            logger.error(f"Error streaming response: {e}")
+            raise
+        
+        self._cache_response(prompt, "".join(parts).strip())
+    
+    async def astream_response(
+        self,
+        context: str,
+        query: str,
+        custom_prompt: str = None,
+        cache_query: str = None,
+        cache_scope: str = ""
+    ) -> AsyncIterator[str]:
+        """
+        Async variant of stream_response. Remote providers stream through
+        their async clients; the local model streams from a worker thread.
+        """
+        prompt = self._build_prompt(context, query, custom_prompt)
+        
+        cached = await asyncio.to_thread(self._get_cached_response, prompt, cache_query, cache_scope)
+        if cached is not None:
+            yield cached
+            return
+        
+        parts = []
+        try:
+            if self.provider == "local":
+                chunks = self._stream_local_response(prompt)
+                done = object()
+                try:
+                    while True:
+                        text = await asyncio.to_thread(next, chunks, done)
+                        if text is done:
+                            break
+                        parts.append(text)
+                        yield text
+                finally:
+                    # Release the generation lock even if the consumer stops early
+                    chunks.close()
+            elif self.provider == "gemini":
+                async for chunk in await self.gemini_client.generate_content_async(prompt, stream=True):
+                    parts.append(chunk.text)
+                    yield chunk.text
+            else:
+                from langchain.schema import HumanMessage
+                
+                async for chunk in self.llm.astream([HumanMessage(content=prompt)]):
+                    parts.append(chunk.content)
+                    yield chunk.content
+        except Exception as e:
+            logger.error(f"Error streaming async response: {e}")
+            raise
+        
+        await asyncio.to_thread(self._cache_response, prompt, "".join(parts).strip(), cache_query, cache_scope)
+    
+    def _stream_local_response(self, prompt: str) -> Iterator[str]:
+        with self._generation_lock:
+            for chunk in self.llm(
                 prompt,
                 max_tokens=MAX_TOKENS,
                 stop=["\nQ:", "\nQuestion:", "\nContext:"],
-                temperature=TEMPERATURE
-            )
+                temperature=TEMPERATURE,
+                stream=True
+            ):
+                yield chunk["choices"][0]["text"]
+    
+    def _generate_local_response(self, prompt: str) -> str:
+        try:
+            with self._generation_lock:
+                response = self.llm(
+                    prompt,
+                    max_tokens=MAX_TOKENS,
+                    stop=["\nQ:", "\nQuestion:", "\nContext:"],
+                    temperature=TEMPERATURE
+                )
             return response["choices"][0]["text"].strip()
         except Exception as e:
             logger.error(f"Error generating local response: {e}")
@@ -143,22 +382,63 @@ class LLMService:
             raise
 
 
-def call_local_llm(context: str, query: str, custom_prompt: str = None) -> str:
+def call_local_llm(
+    context: str,
+    query: str,
+    custom_prompt: str = None,
+    cache_query: str = None,
+    cache_scope: str = ""
+) -> str:
     service = LLMService(provider="local")
-    return service.generate_response(context, query, custom_prompt)
+    return service.generate_response(context, query, custom_prompt, cache_query, cache_scope)
 
 
-def call_openai_llm(context: str, query: str, custom_prompt: str = None) -> str:
+def call_openai_llm(
+    context: str,
+    query: str,
+    custom_prompt: str = None,
+    cache_query: str = None,
+    cache_scope: str = ""
+) -> str:
     service = LLMService(provider="openai")
-    return service.generate_response(context, query, custom_prompt)
+    return service.generate_response(context, query, custom_prompt, cache_query, cache_scope)
 
 
-def call_gemini_llm(context: str, query: str, custom_prompt: str = None) -> str:
+def call_gemini_llm(
+    context: str,
+    query: str,
+    custom_prompt: str = None,
+    cache_query: str = None,
+    cache_scope: str = ""
+) -> str:
     service = LLMService(provider="gemini")
-    return service.generate_response(context, query, custom_prompt)
+    return service.generate_response(context, query, custom_prompt, cache_query, cache_scope)
 
 
-def call_llm(context: str, query: str, provider: str = DEFAULT_LLM_PROVIDER, custom_prompt: str = None) -> str:
+def call_llm(
+    context: str,
+    query: str,
+    provider: str = DEFAULT_LLM_PROVIDER,
+    custom_prompt: str = None,
+    cache_query: str = None,
+    cache_scope: str = ""
+) -> str:
     service = LLMService(provider=provider)
-    return service.generate_response(context, query, custom_prompt)
+    return service.generate_response(context, query, custom_prompt, cache_query, cache_scope)
+
 
+async def call_llm_batch(prompts: List[str], provider: str = DEFAULT_LLM_PROVIDER) -> List[str]:
+    """
+    Run several prompts concurrently against one provider.
+    
+    Args:
+        prompts: Complete prompts to send
+        provider: LLM provider name
+        
+    Returns:
+        Responses in the same order as prompts
+    """
+    service = LLMService(provider=provider)
+    return list(await asyncio.gather(
+        *(service.agenerate_response("", "", custom_prompt=prompt) for prompt in prompts)
+    ))
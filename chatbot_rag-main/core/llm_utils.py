@@ -3,171 +3,143 @@ LLM Utilities Module
 Contains utility functions for LLM operations like intent classification, etc.
 """
 
+import functools
 import logging
 import re
 import json
-from typing import List, Dict, Any
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-
-def classify_intent(query: str) -> str:
-    """
-    Classify the intent of user query.
-    
-    Args:
-        query: User input query
-        
-    Returns:
-        Intent classification (sales, refund, general, etc.)
-    """
-    query_lower = query.lower()
-    
+# Keyword tables, tagged by category so one scan of the query serves every check.
+# Intents are listed in priority order: sales > refund > support.
+_INTENT_KEYWORDS = {
     # Sales intent keywords
-    sales_keywords = [
+    "sales": [
         "buy", "purchase", "price", "cost", "order", "product", "coffee", "beans",
         "available", "stock", "catalog", "shop", "store", "wholesale", "retail",
         "discount", "offer", "promo", "new", "recommendation", "suggest"
-    ]
-    
+    ],
     # Refund intent keywords
-    refund_keywords = [
+    "refund": [
         "refund", "return", "exchange", "cancel", "money back", "replacement",
         "damaged", "defective", "wrong", "mistake", "complaint", "issue"
-    ]
-    
+    ],
     # Support intent keywords
-    support_keywords = [
+    "support": [
         "help", "support", "contact", "hours", "location", "store", "delivery",
         "shipping", "payment", "account", "login", "register"
-    ]
-    
-    # Check for sales intent
-    if any(keyword in query_lower for keyword in sales_keywords):
-        logger.info(f"Classified as SALES intent: {query[:50]}...")
-        return "sales"
-    
-    # Check for refund intent
-    if any(keyword in query_lower for keyword in refund_keywords):
-        logger.info(f"Classified as REFUND intent: {query[:50]}...")
-        return "refund"
-    
-    # Check for support intent
-    if any(keyword in query_lower for keyword in support_keywords):
-        logger.info(f"Classified as SUPPORT intent: {query[:50]}...")
-        return "support"
-    
-    # Default to general
-    logger.info(f"Classified as GENERAL intent: {query[:50]}...")
-    return "general"
-
-
-def get_chat_history_context(chat_history: List[Dict[str, str]], limit: int = 5) -> str:
+    ],
+}
+
+# Banned word stems followed by any word ending ("stabbing", "bombings", "suicidal",
+# "murderous", "weaponry"); "die" only as the word itself and its inflections, so
+# "diesel" and "diet" stay allowed
+_UNSAFE_RE = re.compile(
+    r"\b(?:(?:kill|murder|harm|bomb|weapon|stab|suicid)\w*|die|died|dies|dying)\b",
+    re.IGNORECASE
+)
+
+# Ordinary words that start with a banned stem
+_UNSAFE_ALLOWLIST = frozenset({
+    "stable", "stability", "stabilize", "stabilise", "stabilized", "stabilised",
+    "stabilizer", "stabilizers", "stabilizing", "stabilising",
+    "harmony", "harmonies", "harmonious", "harmonic", "harmonize", "harmonise",
+    "bombay",
+})
+
+# Keywords that suggest need for conversation context
+_CHAT_CONTEXT_KEYWORDS = [
+    "continue", "also", "and", "what about", "how about",
+    "yes", "no", "okay", "sure", "thanks", "thank you",
+    "previous", "earlier", "before", "last time",
+    "again", "still", "more", "else", "other"
+]
+
+# Keywords that suggest need for specific product information
+_PRODUCT_CONTEXT_KEYWORDS = [
+    "this", "that", "it", "the one", "same", "different", "another",
+    "previous", "last", "earlier", "mentioned", "discussed",
+    "compare", "vs", "versus", "difference between",
+    "similar", "like that", "alternative"
+]
+
+# Reference words that suggest continuing previous conversation
+_REFERENCE_KEYWORDS = [
+    "this product", "that coffee", "the beans", "same order",
+    "my order", "my coffee", "my purchase", "what I bought"
+]
+
+_KEYWORD_CATEGORIES = {
+    **_INTENT_KEYWORDS,
+    "chat_context": _CHAT_CONTEXT_KEYWORDS,
+    "product_context": _PRODUCT_CONTEXT_KEYWORDS,
+    "reference": _REFERENCE_KEYWORDS,
+}
+
+# Categories whose single-word keywords must match whole words ("no" should not
+# match "noodle"); multi-word phrases in them are still matched as substrings
+_WHOLE_WORD_CATEGORIES = ("chat_context", "product_context")
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _split_keyword_categories():
     """
-    Get formatted chat history context from last N messages.
-    
-    Args:
-        chat_history: List of chat messages with 'user' and 'assistant' keys
-        limit: Number of last messages to include
-        
-    Returns:
-        Formatted context string
+    Split the keyword tables into substring keywords per category and a
+    token -> categories map for whole-word keywords.
     """
-    # TODO: Implement proper chat history retrieval from database
-    # For now, return empty string
-    logger.info(f"Getting chat history context (limit: {limit})")
-    return ""
+    substring_keywords = {}
+    word_keywords = {}
+    for category, keywords in _KEYWORD_CATEGORIES.items():
+        for keyword in keywords:
+            if category in _WHOLE_WORD_CATEGORIES and " " not in keyword:
+                word_keywords.setdefault(keyword, []).append(category)
+            else:
+                substring_keywords.setdefault(category, []).append(keyword)
+    
+    return substring_keywords, {token: tuple(categories) for token, categories in word_keywords.items()}
 
 
-def resolve_product_reference(query: str, chat_history: List[Dict[str, str]]) -> str:
-    """
-    Resolve product references in query using chat history context.
-    
-    Args:
-        query: User input query
-        chat_history: Previous conversation context
-        
-    Returns:
-        Additional product context (for now returns empty string)
-    """
-    # TODO: Implement product reference resolution
-    # This would analyze chat history to find product mentions
-    # and return relevant product information
-    logger.info(f"Resolving product references for query: {query[:50]}...")
-    return ""
+_SUBSTRING_KEYWORDS, _WORD_KEYWORDS = _split_keyword_categories()
 
 
-def format_rag_context(retrieved_docs: List[str], chat_context: str, product_context: str) -> str:
+def _build_keyword_matcher():
     """
-    Format all context components into a single context string for LLM.
-    
-    Args:
-        retrieved_docs: Documents retrieved from vector store
-        chat_context: Previous conversation context
-        product_context: Product-specific context
-        
-    Returns:
-        Formatted context string
+    Build a single Aho-Corasick automaton over every substring keyword, or one
+    compiled alternation regex per category when pyahocorasick is not installed.
     """
-    context_parts = []
-    
-    # Add retrieved documents
-    if retrieved_docs:
-        context_parts.append("Retrieved Information:")
-        context_parts.extend(retrieved_docs)
-    
-    # Add chat history context
-    if chat_context:
-        context_parts.append("\nPrevious Conversation:")
-        context_parts.append(chat_context)
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for category, keywords in _SUBSTRING_KEYWORDS.items():
+            for keyword in keywords:
+                if keyword in automaton:
+                    automaton.get(keyword)[1].append(category)
+                else:
+                    automaton.add_word(keyword, (keyword, [category]))
+        automaton.make_automaton()
+        return automaton
     
-    # Add product context
-    if product_context:
-        context_parts.append("\nProduct Information:")
-        context_parts.append(product_context)
-    
-    return "\n".join(context_parts)
+    return {
+        category: re.compile("|".join(map(re.escape, keywords)))
+        for category, keywords in _SUBSTRING_KEYWORDS.items()
+    }
 
 
-def is_safe_query(query: str) -> bool:
-    """
-    Check if query is safe (not harmful/violent/illegal).
-    
-    Args:
-        query: User input query
-        
-    Returns:
-        True if query is safe, False otherwise
-    """
-    banned_words = ["kill", "murder", "harm", "die", "bomb", "weapon", "stab", "suicide"]
-    
-    query_lower = query.lower()
-    for word in banned_words:
-        if word in query_lower:
-            logger.warning(f"Unsafe query detected: contains '{word}'")
-            return False
-    
-    return True
+_KEYWORD_MATCHER = _build_keyword_matcher()
 
+_BASE_SAFETY = "You are a helpful AI assistant. Never respond to questions that are violent, harmful, or illegal."
 
-def get_specialized_prompt(intent: str, context: str, query: str) -> str:
-    """
-    Get specialized prompt based on intent.
-    
-    Args:
-        intent: Classified intent (sales, refund, support, general)
-        context: Retrieved context information
-        query: User query
-        
-    Returns:
-        Specialized prompt for the intent
-    """
-    base_safety = "You are a helpful AI assistant. Never respond to questions that are violent, harmful, or illegal."
-    
-    if intent == "sales":
-        return f"""{base_safety}
+# Intent prompt templates; only {context} and {query} are filled in per request
+_SALES_PROMPT_TEMPLATE = _BASE_SAFETY + """
 
 You are a coffee sales specialist. Your goal is to help customers find the perfect coffee products and make purchases.
 
@@ -195,8 +167,7 @@ Customer Question: {query}
 
 Sales Response:"""
 
-    elif intent == "refund":
-        return f"""{base_safety}
+_REFUND_PROMPT_TEMPLATE = _BASE_SAFETY + """
 
 You are a customer service specialist handling refunds and returns.
 
@@ -215,8 +186,7 @@ Customer Question: {query}
 
 Customer Service Response:"""
 
-    elif intent == "support":
-        return f"""{base_safety}
+_SUPPORT_PROMPT_TEMPLATE = _BASE_SAFETY + """
 
 You are a customer support specialist providing general assistance.
 
@@ -235,8 +205,7 @@ Customer Question: {query}
 
 Support Response:"""
 
-    else:  # general
-        return f"""{base_safety}
+_GENERAL_PROMPT_TEMPLATE = _BASE_SAFETY + """
 
 You are a knowledgeable coffee store assistant providing general information.
 
@@ -254,6 +223,199 @@ Question: {query}
 
 Response:"""
 
+_PROMPT_TEMPLATES = {
+    "sales": _SALES_PROMPT_TEMPLATE,
+    "refund": _REFUND_PROMPT_TEMPLATE,
+    "support": _SUPPORT_PROMPT_TEMPLATE,
+}
+
+# Keyword categories that call for product context resolution, per intent.
+# Comparison/follow-up wording always does; sales and refund also accept
+# explicit product references ("my order", "this product").
+_DEFAULT_PRODUCT_CONTEXT_TRIGGERS = frozenset({"product_context"})
+_PRODUCT_CONTEXT_TRIGGERS = {
+    "sales": frozenset({"product_context", "reference"}),
+    "refund": frozenset({"product_context", "reference"}),
+}
+
+_AGENT_NAMES = {
+    "sales": "Sales Specialist",
+    "refund": "Customer Service Agent",
+    "support": "Support Agent",
+    "general": "Coffee Assistant"
+}
+
+# Pattern to match product format: **Product Name** (ID: product_id) - $price
+# Name and id are captured without surrounding whitespace, so matches need no stripping
+_PRODUCT_RE = re.compile(r'\*\*(?=[^*])\s*([^*]*?)\s*\*\*\s*\(ID:(?=[^)])\s*([^)]*?)\s*\)\s*-\s*\$([0-9.]+)')
+
+
+@functools.lru_cache(maxsize=1024)
+def match_keyword_categories(query_lower: str) -> Dict[str, str]:
+    """
+    Tag a lowercased query with every keyword category it matches.
+    
+    Args:
+        query_lower: Lowercased user query
+        
+    Returns:
+        Mapping of matched category to the first keyword found for it.
+        The result is cached and shared between callers; do not modify it.
+    """
+    matched = {}
+    
+    # Whole-word keywords: one set lookup per query token
+    for token in _WORD_RE.findall(query_lower):
+        for category in _WORD_KEYWORDS.get(token, ()):
+            matched.setdefault(category, token)
+    
+    if ahocorasick is not None:
+        for _, (keyword, categories) in _KEYWORD_MATCHER.iter(query_lower):
+            for category in categories:
+                matched.setdefault(category, keyword)
+        return matched
+    
+    for category, pattern in _KEYWORD_MATCHER.items():
+        if category not in matched:
+            match = pattern.search(query_lower)
+            if match:
+                matched[category] = match.group()
+    return matched
+
+
+def _resolve_matches(
+    query: str,
+    query_lower: Optional[str],
+    keyword_matches: Optional[Dict[str, str]]
+) -> Dict[str, str]:
+    if keyword_matches is not None:
+        return keyword_matches
+    return match_keyword_categories(query_lower or query.lower())
+
+
+def classify_intent(
+    query: str,
+    query_lower: Optional[str] = None,
+    keyword_matches: Optional[Dict[str, str]] = None
+) -> str:
+    """
+    Classify the intent of user query.
+    
+    Args:
+        query: User input query
+        query_lower: Precomputed query.lower(), if the caller already has it
+        keyword_matches: Precomputed match_keyword_categories() result for the query
+        
+    Returns:
+        Intent classification (sales, refund, general, etc.)
+    """
+    matched = _resolve_matches(query, query_lower, keyword_matches)
+    
+    # Pick the highest-priority intent among the categories tagged in one scan
+    intent = next((name for name in _INTENT_KEYWORDS if name in matched), "general")
+    logger.info("Classified as %s intent: %.50s...", intent.upper(), query)
+    return intent
+
+
+def get_chat_history_context(chat_history: List[Dict[str, str]], limit: int = 5) -> str:
+    """
+    Get formatted chat history context from last N messages.
+    
+    Args:
+        chat_history: List of chat messages with 'user' and 'assistant' keys
+        limit: Number of last messages to include
+        
+    Returns:
+        Formatted context string
+    """
+    # TODO: Implement proper chat history retrieval from database
+    # For now, return empty string
+    logger.info("Getting chat history context (limit: %s)", limit)
+    return ""
+
+
+def resolve_product_reference(query: str, chat_history: List[Dict[str, str]]) -> str:
+    """
+    Resolve product references in query using chat history context.
+    
+    Args:
+        query: User input query
+        chat_history: Previous conversation context
+        
+    Returns:
+        Additional product context (for now returns empty string)
+    """
+    # TODO: Implement product reference resolution
+    # This would analyze chat history to find product mentions
+    # and return relevant product information
+    logger.info("Resolving product references for query: %.50s...", query)
+    return ""
+
+
+def format_rag_context(retrieved_docs: List[str], chat_context: str, product_context: str) -> str:
+    """
+    Format all context components into a single context string for LLM.
+    
+    Args:
+        retrieved_docs: Documents retrieved from vector store
+        chat_context: Previous conversation context
+        product_context: Product-specific context
+        
+    Returns:
+        Formatted context string
+    """
+    context_parts = []
+    
+    # Add retrieved documents (joined once, rather than one list entry per document)
+    if retrieved_docs:
+        context_parts.append("Retrieved Information:\n" + "\n".join(retrieved_docs))
+    
+    # Add chat history context
+    if chat_context:
+        context_parts.append("\nPrevious Conversation:\n" + chat_context)
+    
+    # Add product context
+    if product_context:
+        context_parts.append("\nProduct Information:\n" + product_context)
+    
+    return "\n".join(context_parts)
+
+
+def is_safe_query(query: str, query_lower: Optional[str] = None) -> bool:
+    """
+    Check if query is safe (not harmful/violent/illegal).
+    
+    Args:
+        query: User input query
+        query_lower: Precomputed query.lower(), if the caller already has it
+        
+    Returns:
+        True if query is safe, False otherwise
+    """
+    for match in _UNSAFE_RE.finditer(query_lower or query):
+        word = match.group(0)
+        if word.lower() not in _UNSAFE_ALLOWLIST:
+            logger.warning("Unsafe query detected: contains '%s'", word)
+            return False
+    
+    return True
+
+
+def get_specialized_prompt(intent: str, context: str, query: str) -> str:
+    """
+    Get specialized prompt based on intent.
+    
+    Args:
+        intent: Classified intent (sales, refund, support, general)
+        context: Retrieved context information
+        query: User query
+        
+    Returns:
+        Specialized prompt for the intent
+    """
+    template = _PROMPT_TEMPLATES.get(intent, _GENERAL_PROMPT_TEMPLATE)
+    return template.format(context=context, query=query)
+
 
 def get_agent_name(intent: str) -> str:
     """
@@ -265,104 +427,120 @@ def get_agent_name(intent: str) -> str:
     Returns:
         Agent name string
     """
-    agent_names = {
-        "sales": "Sales Specialist",
-        "refund": "Customer Service Agent",
-        "support": "Support Agent",
-        "general": "Coffee Assistant"
-    }
-    
-    return agent_names.get(intent, "Assistant")
+    return _AGENT_NAMES.get(intent, "Assistant")
 
 
-def should_resolve_product_context(query: str, intent: str) -> bool:
+def should_resolve_product_context(
+    query: str,
+    intent: str,
+    query_lower: Optional[str] = None,
+    keyword_matches: Optional[Dict[str, str]] = None
+) -> bool:
     """
     Determine if product context resolution is needed based on query and intent.
     
     Args:
         query: User query
         intent: Classified intent
+        query_lower: Precomputed query.lower(), if the caller already has it
+        keyword_matches: Precomputed match_keyword_categories() result for the query
         
     Returns:
         True if product context should be resolved, False otherwise
     """
-    query_lower = query.lower()
-    
-    # Keywords that suggest need for specific product information
-    product_context_keywords = [
-        "this", "that", "it", "the one", "same", "different", "another",
-        "previous", "last", "earlier", "mentioned", "discussed",
-        "compare", "vs", "versus", "difference between",
-        "similar", "like that", "alternative"
-    ]
-    
-    # Reference words that suggest continuing previous conversation
-    reference_keywords = [
-        "this product", "that coffee", "the beans", "same order",
-        "my order", "my coffee", "my purchase", "what I bought"
-    ]
-    
-    # Always check for product context in sales intent with references
-    if intent == "sales":
-        if any(keyword in query_lower for keyword in product_context_keywords + reference_keywords):
-            logger.info(f"Product context needed for sales query: {query[:50]}...")
-            return True
-    
-    # Check for refund/exchange scenarios
-    if intent == "refund":
-        if any(keyword in query_lower for keyword in reference_keywords):
-            logger.info(f"Product context needed for refund query: {query[:50]}...")
-            return True
+    matched = _resolve_matches(query, query_lower, keyword_matches)
     
-    # Check for comparison or follow-up questions
-    if any(keyword in query_lower for keyword in product_context_keywords):
-        logger.info(f"Product context needed for reference query: {query[:50]}...")
+    # One set test against the keyword categories that trigger resolution for this intent
+    triggers = _PRODUCT_CONTEXT_TRIGGERS.get(intent, _DEFAULT_PRODUCT_CONTEXT_TRIGGERS)
+    if not triggers.isdisjoint(matched):
+        logger.info("Product context needed for %s query: %.50s...", intent, query)
         return True
     
-    logger.info(f"No product context needed for query: {query[:50]}...")
+    logger.info("No product context needed for query: %.50s...", query)
     return False
 
 
-def should_use_chat_history(query: str, intent: str) -> bool:
+def should_use_chat_history(
+    query: str,
+    intent: str,
+    query_lower: Optional[str] = None,
+    keyword_matches: Optional[Dict[str, str]] = None
+) -> bool:
     """
     Determine if chat history context is needed based on query and intent.
     
     Args:
         query: User query
         intent: Classified intent
+        query_lower: Precomputed query.lower(), if the caller already has it
+        keyword_matches: Precomputed match_keyword_categories() result for the query
         
     Returns:
         True if chat history should be used, False otherwise
     """
-    query_lower = query.lower()
-    
-    # Keywords that suggest need for conversation context
-    context_keywords = [
-        "continue", "also", "and", "what about", "how about",
-        "yes", "no", "okay", "sure", "thanks", "thank you",
-        "previous", "earlier", "before", "last time",
-        "again", "still", "more", "else", "other"
-    ]
-    
     # Short queries often need context
     if len(query.split()) <= 3:
-        logger.info(f"Chat history needed for short query: {query}")
+        logger.info("Chat history needed for short query: %s", query)
         return True
     
     # Questions with context references
-    if any(keyword in query_lower for keyword in context_keywords):
-        logger.info(f"Chat history needed for contextual query: {query[:50]}...")
+    if "chat_context" in _resolve_matches(query, query_lower, keyword_matches):
+        logger.info("Chat history needed for contextual query: %.50s...", query)
         return True
     
     # Always use history for follow-up refund questions
     if intent == "refund":
-        logger.info(f"Chat history needed for refund query: {query[:50]}...")
+        logger.info("Chat history needed for refund query: %.50s...", query)
         return True
     
-    logger.info(f"No chat history needed for query: {query[:50]}...")
+    logger.info("No chat history needed for query: %.50s...", query)
     return False
 
 
+@dataclass
+class ProductMatches:
+    """
+    Products found in a response, stored column-wise. Per-product dicts are
+    only built by to_dicts(), when they are actually returned to the client.
+    """
+    ids: List[str] = field(default_factory=list)
+    names: List[str] = field(default_factory=list)
+    prices: List[float] = field(default_factory=list)
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "id": product_id,
+                "name": name,
+                "price": price,
+                "buy_link": f"/product/{product_id}",
+                "image_url": f"/images/product_{product_id}.jpg"
+            }
+            for product_id, name, price in zip(self.ids, self.names, self.prices)
+        ]
+
+
+def scan_products(response: str) -> ProductMatches:
+    """
+    Scan a sales response for product mentions without building per-product dicts.
+    
+    Args:
+        response: Sales agent response text
+        
+    Returns:
+        ProductMatches holding the ids, names and prices found
+    """
+    matches = ProductMatches()
+    for name, product_id, price in _PRODUCT_RE.findall(response):
+        matches.names.append(name)
+        matches.ids.append(product_id)
+        matches.prices.append(float(price))
+    return matches
+
+
 def extract_product_info(response: str) -> Dict[str, Any]:
     """
     Extract structured product information from sales response.
@@ -373,25 +551,7 @@ def extract_product_info(response: str) -> Dict[str, Any]:
     Returns:
         Dictionary containing products mentioned and metadata
     """
-    # Pattern to match product format: **Product Name** (ID: product_id) - $price
-    product_pattern = r'\*\*([^*]+)\*\*\s*\(ID:\s*([^)]+)\)\s*-\s*\$([0-9.]+)'
-    
-    products = []
-    matches = re.findall(product_pattern, response)
-    
-    for match in matches:
-        product_name, product_id, price = match
-        
-        # Clean up the product_id and ensure it's properly formatted
-        clean_product_id = product_id.strip()
-        
-        products.append({
-            "id": clean_product_id,
-            "name": product_name.strip(),
-            "price": float(price.strip()),
-            "buy_link": f"/product/{clean_product_id}",
-            "image_url": f"/images/product_{clean_product_id}.jpg"
-        })
+    products = scan_products(response).to_dicts()
     
     return {
         "products": products,
@@ -421,11 +581,23 @@ def format_sales_response(response: str, intent: str) -> Dict[str, Any]:
     }
     
     if intent == "sales":
-        product_info = extract_product_info(response)
-        result["products"] = product_info["products"]
+        matches = scan_products(response)
+        if matches:
+            result["products"] = matches.to_dicts()
         result["metadata"] = {
-            "total_products": product_info["total_products"],
-            "has_products": product_info["has_products"]
+            "total_products": len(matches),
+            "has_products": len(matches) > 0
         }
     
     return result
+
+
+def error_result(error: Exception) -> Dict[str, Any]:
+    """Response dictionary returned when a turn fails"""
+    return {
+        "response": "I apologize, but I encountered an error while processing your request.",
+        "intent": "error",
+        "agent": "Error Handler",
+        "sources": [],
+        "error": str(error)
+    }
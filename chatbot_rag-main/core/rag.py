@@ -3,16 +3,14 @@ RAG (Retrieval-Augmented Generation) System
 Combines vector retrieval with LLM generation for contextual responses.
 """
 
+import asyncio
+import functools
 import logging
-from typing import List, Dict, Any, Optional
-from langchain.vectorstores import Chroma
-from langchain.embeddings import HuggingFaceEmbeddings
-from .config import (
-    EMBEDDING_MODEL_NAME,
-    CHROMA_DB_DIR,
-    CHROMA_COLLECTION_NAME
-)
-from .llm_service import call_llm, call_local_llm, call_openai_llm, call_gemini_llm
+from typing import AsyncIterator, List, Dict, Any, Optional, Union
+from .cache import LRUCache, make_cache_key
+from .config import RAG_RESPONSE_CACHE_SIZE, RETRIEVAL_K_BY_INTENT, RETRIEVAL_K_DEFAULT
+from .embedding_utils import corpus_version, get_vectorstore
+from .llm_service import LLMService, call_llm, call_local_llm, call_openai_llm, call_gemini_llm
 from .llm_utils import (
     classify_intent,
     get_chat_history_context,
@@ -23,13 +21,25 @@ from .llm_utils import (
     get_agent_name,
     should_resolve_product_context,
     should_use_chat_history,
-    format_sales_response
+    format_sales_response,
+    match_keyword_categories,
+    error_result
 )
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Completed responses keyed by corpus version, provider, normalized query and the
+# chat/product context actually used, so history-dependent turns are cached too
+_RESPONSE_CACHE = LRUCache(RAG_RESPONSE_CACHE_SIZE)
+
+_PROVIDER_CALLS = {
+    "local": call_local_llm,
+    "openai": call_openai_llm,
+    "gemini": call_gemini_llm
+}
+
 
 class RAGSystem:
     """
@@ -38,23 +48,20 @@ class RAGSystem:
     
     def __init__(self, llm_provider: str = "local"):
         self.llm_provider = llm_provider
+        # Resolve the provider's call function once instead of branching per request
+        self._llm_call = _PROVIDER_CALLS.get(llm_provider) or functools.partial(call_llm, provider=llm_provider)
+        self.vectorstore = None
         self.retriever = None
         self._initialize_retriever()
     
     def _initialize_retriever(self):
         """Initialize the vector store retriever"""
         try:
-            # Initialize embedding model
-            embedding_model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
-            
-            # Load vector store
-            vectorstore = Chroma(
-                collection_name=CHROMA_COLLECTION_NAME,
-                embedding_function=embedding_model,
-                persist_directory=CHROMA_DB_DIR
-            )
+            # Shared vector store; the embedding model and Chroma client load once per process
+            vectorstore = get_vectorstore()
             
-            # Create retriever
+            # Retrieval goes through the vector store; the retriever is kept for LangChain callers
+            self.vectorstore = vectorstore
             self.retriever = vectorstore.as_retriever(
                 search_type="similarity",
                 search_kwargs={"k": 5}  # Top 5 similar documents
@@ -63,35 +70,68 @@ class RAGSystem:
             logger.info("RAG retriever initialized successfully")
             
         except Exception as e:
-            logger.error(f"Failed to initialize retriever: {e}")
+            logger.error("Failed to initialize retriever: %s", e)
             raise
     
-    def retrieve_relevant_documents(self, query: str, k: int = 5) -> List[str]:
+    def retrieve_relevant_documents(self, query: Union[str, List[str]], k: int = 5) -> List[str]:
         """
         Retrieve relevant documents from vector store.
         
         Args:
-            query: User query
-            k: Number of documents to retrieve
+            query: User query, or several sub-queries to retrieve for in one batch
+            k: Number of documents to retrieve per query
             
         Returns:
             List of relevant document contents
         """
+        if not isinstance(query, str):
+            return self._retrieve_for_queries(query, k)
+        
         try:
-            # Update retriever with new k value
-            self.retriever.search_kwargs = {"k": k}
-            
-            # Retrieve documents
-            documents = self.retriever.get_relevant_documents(query)
+            # Query the store directly; mutating the shared retriever's k would race
+            # between concurrent requests on the same RAGSystem
+            documents = self.vectorstore.similarity_search(query, k=k)
             
             # Extract content from documents
             doc_contents = [doc.page_content for doc in documents]
             
-            logger.info(f"Retrieved {len(doc_contents)} relevant documents")
+            logger.info("Retrieved %d relevant documents", len(doc_contents))
+            return doc_contents
+            
+        except Exception as e:
+            logger.error("Error retrieving documents: %s", e)
+            return []
+    
+    def _retrieve_for_queries(self, queries: List[str], k: int) -> List[str]:
+        """
+        Embed several queries in one batch and run a single multi-query
+        collection lookup, returning the de-duplicated documents in rank order.
+        """
+        if not queries:
+            return []
+        
+        try:
+            query_embeddings = self.vectorstore.embeddings.embed_queries(list(queries))
+            results = self.vectorstore._collection.query(
+                query_embeddings=query_embeddings,
+                n_results=k,
+                include=["documents"]
+            )
+            
+            # Interleave by rank so each query's best matches come first
+            doc_contents = []
+            seen = set()
+            for rank_docs in zip(*results["documents"]):
+                for content in rank_docs:
+                    if content not in seen:
+                        seen.add(content)
+                        doc_contents.append(content)
+            
+            logger.info("Retrieved %d relevant documents for %d queries", len(doc_contents), len(queries))
             return doc_contents
             
         except Exception as e:
-            logger.error(f"Error retrieving documents: {e}")
+            logger.error("Error retrieving documents: %s", e)
             return []
     
     def generate_response(
@@ -110,110 +150,292 @@ class RAGSystem:
             Dictionary containing response and metadata
         """
         try:
-            # Safety check
-            if not is_safe_query(query):
-                return {
-                    "response": "I cannot provide information on harmful or dangerous topics.",
-                    "intent": "blocked",
-                    "agent": "Safety Filter",
-                    "sources": [],
-                    "products": [],
-                    "metadata": {},
-                    "error": "Unsafe query blocked"
-                }
-                
-            # Initialize chat history if not provided
-            if chat_history is None:
-                chat_history = []
+            state = self._prepare_turn(query, chat_history)
+            if "result" in state:
+                return state["result"]
             
-            # Step 1: Intent classification
-            intent = classify_intent(query)
-            
-            # Step 2: Intelligent decision on whether to use chat history
-            use_chat_history = should_use_chat_history(query, intent)
-            
-            # Step 3: Intelligent decision on whether to resolve product context
-            use_product_resolution = should_resolve_product_context(query, intent)
+            # Step 9: Generate response using specialized agent
+            # Answers that depend only on the query are shared via the semantic cache
+            response = self._call_llm_with_prompt(
+                state["prompt"],
+                cache_query=state["cache_query"],
+                cache_scope=state["cache_scope"]
+            )
             
-            # Step 4: Retrieve relevant documents
-            retrieved_docs = self.retrieve_relevant_documents(query)
+            return self._finalize_turn(state, response)
             
-            # Step 5: Get chat history context (only if needed)
-            chat_context = ""
-            if use_chat_history:
-                chat_context = get_chat_history_context(chat_history)
+        except Exception as e:
+            logger.error("Error generating RAG response: %s", e)
+            return error_result(e)
+    
+    async def agenerate_response(
+        self,
+        query: str,
+        chat_history: Optional[List[Dict[str, str]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Async variant of generate_response for use from an event loop.
+        Retrieval runs in a worker thread and the LLM call is awaited, so
+        concurrent requests overlap instead of blocking each other.
+        
+        Args:
+            query: User query
+            chat_history: Previous conversation history
             
-            # Step 6: Resolve product references (only if needed)
-            product_context = ""
-            if use_product_resolution:
-                product_context = resolve_product_reference(query, chat_history)
+        Returns:
+            Dictionary containing response and metadata
+        """
+        try:
+            state = await asyncio.to_thread(self._prepare_turn, query, chat_history)
+            if "result" in state:
+                return state["result"]
             
-            # Step 7: Format context
-            formatted_context = format_rag_context(
-                retrieved_docs, 
-                chat_context, 
-                product_context
+            response = await LLMService(provider=self.llm_provider).agenerate_response(
+                "",
+                "",
+                custom_prompt=state["prompt"],
+                cache_query=state["cache_query"],
+                cache_scope=state["cache_scope"]
             )
             
-            # Step 8: Get specialized prompt based on intent
-            specialized_prompt = get_specialized_prompt(intent, formatted_context, query)
+            return self._finalize_turn(state, response)
             
-            # Step 9: Generate response using specialized agent
-            response = self._call_llm_with_prompt(specialized_prompt)
-            
-            # Step 10: Format response with structured product information
-            formatted_response = format_sales_response(response, intent)
-            
-            # Step 11: Get agent name
-            agent_name = get_agent_name(intent)
+        except Exception as e:
+            logger.error("Error generating RAG response: %s", e)
+            return error_result(e)
+    
+    async def astream_response(
+        self,
+        query: str,
+        chat_history: Optional[List[Dict[str, str]]] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Stream a response as it is generated.
+        
+        Yields {"tok": text} for each generated chunk and finishes with
+        {"result": ...} holding the same dictionary generate_response returns.
+        Blocked and cached turns yield only the result.
+        """
+        try:
+            state = await asyncio.to_thread(self._prepare_turn, query, chat_history)
+            if "result" in state:
+                result = state["result"]
+            else:
+                parts = []
+                async for token in LLMService(provider=self.llm_provider).astream_response(
+                    "",
+                    "",
+                    custom_prompt=state["prompt"],
+                    cache_query=state["cache_query"],
+                    cache_scope=state["cache_scope"]
+                ):
+                    parts.append(token)
+                    yield {"tok": token}
+                result = self._finalize_turn(state, "".join(parts).strip())
+        except Exception as e:
+            logger.error("Error streaming RAG response: %s", e)
+            result = error_result(e)
+        
+        yield {"result": result}
+    
+    async def agenerate_responses(
+        self,
+        queries: List[str],
+        chat_histories: Optional[List[Optional[List[Dict[str, str]]]]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Answer several queries with their LLM calls in flight concurrently.
+        Retrieval and prompt building run first for every query; only the
+        generation step is overlapped.
+        
+        Args:
+            queries: User queries
+            chat_histories: Previous conversation history per query
             
-            # Return structured response
+        Returns:
+            Response dictionaries in the same order as queries
+        """
+        if chat_histories is None:
+            chat_histories = [None] * len(queries)
+        
+        states = []
+        for query, chat_history in zip(queries, chat_histories):
+            try:
+                states.append(self._prepare_turn(query, chat_history))
+            except Exception as e:
+                logger.error("Error generating RAG response: %s", e)
+                states.append({"result": error_result(e)})
+        
+        pending = [state for state in states if "result" not in state]
+        service = LLMService(provider=self.llm_provider)
+        responses = await asyncio.gather(
+            *(
+                service.agenerate_response(
+                    "",
+                    "",
+                    custom_prompt=state["prompt"],
+                    cache_query=state["cache_query"],
+                    cache_scope=state["cache_scope"]
+                )
+                for state in pending
+            ),
+            return_exceptions=True
+        )
+        
+        for state, response in zip(pending, responses):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                state["result"] = self._finalize_turn(state, response)
+            except Exception as e:
+                logger.error("Error generating RAG response: %s", e)
+                state["result"] = error_result(e)
+        
+        return [state["result"] for state in states]
+    
+    def _prepare_turn(
+        self,
+        query: str,
+        chat_history: Optional[List[Dict[str, str]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Run every step up to the LLM call. Returns {"result": ...} when the
+        turn is answered without generation (blocked or cached), otherwise
+        the state _finalize_turn needs.
+        """
+        # Lowercase once and share it with every keyword check below
+        query_lower = query.lower()
+        
+        # Safety check
+        if not is_safe_query(query, query_lower):
             return {
-                "response": formatted_response["text"],
-                "intent": intent,
-                "agent": agent_name,
-                "sources": retrieved_docs,
-                "context": formatted_context,
-                "products": formatted_response["products"],
-                "metadata": formatted_response["metadata"],
-                "chat_history_used": use_chat_history,
-                "product_context_used": use_product_resolution,
-                "chat_context_actual": bool(chat_context),
-                "product_context_actual": bool(product_context),
-                "intelligent_decisions": True
+                "result": {
+                    "response": "I cannot provide information on harmful or dangerous topics.",
+                    "intent": "blocked",
+                    "agent": "Safety Filter",
+                    "sources": [],
+                    "products": [],
+                    "metadata": {},
+                    "error": "Unsafe query blocked"
+                }
             }
             
-        except Exception as e:
-            logger.error(f"Error generating RAG response: {e}")
-            return {
-                "response": "I apologize, but I encountered an error while processing your request.",
-                "intent": "error",
-                "agent": "Error Handler",
-                "sources": [],
-                "error": str(e)
-            }
+        # Initialize chat history if not provided
+        if chat_history is None:
+            chat_history = []
+        
+        # Step 1: Intent classification
+        # Tag the query's keyword categories once and share them with every classifier
+        keyword_matches = match_keyword_categories(query_lower)
+        intent = classify_intent(query, query_lower, keyword_matches)
+        
+        # Step 2: Intelligent decision on whether to use chat history
+        use_chat_history = should_use_chat_history(query, intent, query_lower, keyword_matches)
+        
+        # Step 3: Intelligent decision on whether to resolve product context
+        use_product_resolution = should_resolve_product_context(
+            query, intent, query_lower, keyword_matches
+        )
+        
+        # Step 4: Get chat history context (only if needed)
+        chat_context = ""
+        if use_chat_history:
+            chat_context = get_chat_history_context(chat_history)
+        
+        # Step 5: Resolve product references (only if needed)
+        product_context = ""
+        if use_product_resolution:
+            product_context = resolve_product_reference(query, chat_history)
+        
+        # Exact tier: the same question over the same context and corpus gets the same answer
+        version = corpus_version()
+        cache_key = make_cache_key(
+            version,
+            self.llm_provider,
+            " ".join(query_lower.split()),
+            chat_context,
+            product_context
+        )
+        cached = _RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            logger.info("RAG response cache hit: %.50s...", query)
+            return {"result": dict(cached)}
+        
+        # Step 6: Retrieve relevant documents, as deep as the intent needs
+        retrieved_docs = self.retrieve_relevant_documents(
+            query,
+            k=RETRIEVAL_K_BY_INTENT.get(intent, RETRIEVAL_K_DEFAULT)
+        )
+        
+        # Step 7: Format context
+        formatted_context = format_rag_context(
+            retrieved_docs, 
+            chat_context, 
+            product_context
+        )
+        
+        # Step 8: Get specialized prompt based on intent
+        specialized_prompt = get_specialized_prompt(intent, formatted_context, query)
+        
+        return {
+            "intent": intent,
+            "prompt": specialized_prompt,
+            "sources": retrieved_docs,
+            "context": formatted_context,
+            "chat_history_used": use_chat_history,
+            "product_context_used": use_product_resolution,
+            "chat_context_actual": bool(chat_context),
+            "product_context_actual": bool(product_context),
+            "cache_key": cache_key,
+            # Semantic tier: paraphrase matching is only safe for history-independent answers
+            "cache_query": None if (chat_context or product_context) else query,
+            "cache_scope": f"{intent}:{version}"
+        }
+    
+    def _finalize_turn(self, state: Dict[str, Any], response: str) -> Dict[str, Any]:
+        """Build the structured result for a generated response and cache it"""
+        intent = state["intent"]
+        
+        # Step 10: Format response with structured product information
+        formatted_response = format_sales_response(response, intent)
+        
+        # Step 11: Get agent name
+        agent_name = get_agent_name(intent)
+        
+        # Return structured response
+        result = {
+            "response": formatted_response["text"],
+            "intent": intent,
+            "agent": agent_name,
+            "sources": state["sources"],
+            "context": state["context"],
+            "products": formatted_response["products"],
+            "metadata": formatted_response["metadata"],
+            "chat_history_used": state["chat_history_used"],
+            "product_context_used": state["product_context_used"],
+            "chat_context_actual": state["chat_context_actual"],
+            "product_context_actual": state["product_context_actual"],
+            "intelligent_decisions": True
+        }
+        
+        # An empty answer (e.g. a stream that produced no tokens) is never
+        # replayed from the cache
+        if response and response.strip():
+            _RESPONSE_CACHE.set(state["cache_key"], result)
+        return dict(result)
     
-    def _call_llm_with_prompt(self, prompt: str) -> str:
+    def _call_llm_with_prompt(
+        self,
+        prompt: str,
+        cache_query: Optional[str] = None,
+        cache_scope: str = ""
+    ) -> str:
         """Call the configured LLM provider with custom prompt"""
-        if self.llm_provider == "local":
-            return call_local_llm("", "", custom_prompt=prompt)
-        elif self.llm_provider == "openai":
-            return call_openai_llm("", "", custom_prompt=prompt)
-        elif self.llm_provider == "gemini":
-            return call_gemini_llm("", "", custom_prompt=prompt)
-        else:
-            return call_llm("", "", provider=self.llm_provider, custom_prompt=prompt)
+        return self._llm_call("", "", custom_prompt=prompt, cache_query=cache_query, cache_scope=cache_scope)
     
     def _call_llm(self, context: str, query: str) -> str:
         """Call the configured LLM provider"""
-        if self.llm_provider == "local":
-            return call_local_llm(context, query)
-        elif self.llm_provider == "openai":
-            return call_openai_llm(context, query)
-        elif self.llm_provider == "gemini":
-            return call_gemini_llm(context, query)
-        else:
-            return call_llm(context, query, provider=self.llm_provider)
+        return self._llm_call(context, query)
 
 
 # Convenience functions for direct usage
@@ -222,6 +444,12 @@ def create_rag_system(llm_provider: str = "local") -> RAGSystem:
     return RAGSystem(llm_provider=llm_provider)
 
 
+@functools.lru_cache(maxsize=None)
+def _get_rag_system(llm_provider: str) -> RAGSystem:
+    """Return the shared RAG system for a provider, building it on first use"""
+    return RAGSystem(llm_provider=llm_provider)
+
+
 def quick_rag_query(query: str, llm_provider: str = "local") -> str:
     """
     Quick RAG query without advanced features.
@@ -233,7 +461,7 @@ def quick_rag_query(query: str, llm_provider: str = "local") -> str:
     Returns:
         Response string
     """
-    rag_system = RAGSystem(llm_provider=llm_provider)
+    rag_system = _get_rag_system(llm_provider)
     result = rag_system.generate_response(query)
     return result["response"]
 
@@ -254,9 +482,79 @@ def advanced_rag_query(
     Returns:
         Complete response dictionary with agent information
     """
-    rag_system = RAGSystem(llm_provider=llm_provider)
+    rag_system = _get_rag_system(llm_provider)
     return rag_system.generate_response(
         query,
         chat_history=chat_history
     )
 
+
+async def advanced_rag_query_async(
+    query: str,
+    chat_history: Optional[List[Dict[str, str]]] = None,
+    llm_provider: str = "local"
+) -> Dict[str, Any]:
+    """
+    Async variant of advanced_rag_query for the API endpoints.
+    
+    Args:
+        query: User query
+        chat_history: Previous conversation history
+        llm_provider: LLM provider to use
+        
+    Returns:
+        Complete response dictionary with agent information
+    """
+    # The first call per provider loads the embedding model and vector store
+    rag_system = await asyncio.to_thread(_get_rag_system, llm_provider)
+    return await rag_system.agenerate_response(query, chat_history=chat_history)
+
+
+async def advanced_rag_query_stream(
+    query: str,
+    chat_history: Optional[List[Dict[str, str]]] = None,
+    llm_provider: str = "local"
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming variant of advanced_rag_query.
+    
+    Args:
+        query: User query
+        chat_history: Previous conversation history
+        llm_provider: LLM provider to use
+        
+    Yields:
+        {"tok": text} chunks, then {"result": ...} with the complete response dictionary
+    """
+    rag_system = await asyncio.to_thread(_get_rag_system, llm_provider)
+    async for event in rag_system.astream_response(query, chat_history=chat_history):
+        yield event
+
+
+def advanced_rag_query_batch(
+    queries: List[str],
+    chat_histories: Optional[List[Optional[List[Dict[str, str]]]]] = None,
+    llm_provider: str = "local"
+) -> List[Dict[str, Any]]:
+    """
+    Run advanced_rag_query for several queries in one call. Remote providers
+    get their LLM requests issued concurrently; the local model handles one
+    completion at a time, so its queries run in sequence.
+    
+    Args:
+        queries: User queries
+        chat_histories: Previous conversation history per query
+        llm_provider: LLM provider to use
+        
+    Returns:
+        Response dictionaries in the same order as queries
+    """
+    rag_system = _get_rag_system(llm_provider)
+    if llm_provider == "local":
+        if chat_histories is None:
+            chat_histories = [None] * len(queries)
+        return [
+            rag_system.generate_response(query, chat_history=chat_history)
+            for query, chat_history in zip(queries, chat_histories)
+        ]
+    return asyncio.run(rag_system.agenerate_responses(queries, chat_histories))
@@ -6,6 +6,7 @@ Creates embeddings for both products and documents in ChromaDB.
 
 import sys
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Add the project root to the path
@@ -14,6 +15,7 @@ sys.path.insert(0, str(project_root))
 
 from core.embed_products import embed_products, embed_products_safe
 from core.embed_documents import embed_documents, list_document_sources
+from core.embedding_utils import batch_mutations, get_vectorstore
 
 # Configure logging
 logging.basicConfig(
@@ -27,20 +29,29 @@ def create_all_embeddings(safe_mode: bool = False):
     logger.info("Starting complete embedding process")
     
     try:
-        logger.info("Step 1: Embedding products")
-        if safe_mode:
-            embed_products_safe()
-        else:
-            embed_products()
-        
-        logger.info("Step 2: Embedding documents")
-        
-        sources = list_document_sources()
-        if sources:
-            logger.info(f"Found document sources: {sources}")
-            embed_documents()
-        else:
-            logger.warning("No document sources found")
+        # Persist once after both steps rather than after each one. The shared
+        # vector store (and its embedding model) is loaded here, before the
+        # worker threads start, so both steps reuse the same instance.
+        with batch_mutations(get_vectorstore()):
+            sources = list_document_sources()
+            if sources:
+                logger.info(f"Found document sources: {sources}")
+            else:
+                logger.warning("No document sources found")
+            
+            # Products and documents are independent; overlap their parsing and encoding
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                logger.info("Step 1: Embedding products")
+                futures = [
+                    executor.submit(embed_products_safe if safe_mode else embed_products, bulk=True)
+                ]
+                
+                if sources:
+                    logger.info("Step 2: Embedding documents")
+                    futures.append(executor.submit(embed_documents, bulk=True))
+                
+                for future in futures:
+                    future.result()
         
         logger.info("Complete embedding process finished successfully")
         
@@ -5,9 +5,14 @@ Tests the RAG system with predefined questions and saves results.
 """
 
 import sys
+import asyncio
 import logging
-import json
+import logging.handlers
 import os
+import orjson
+from collections import Counter
+from itertools import chain, islice
+from typing import Iterable, Iterator, TextIO
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
@@ -19,7 +24,8 @@ load_dotenv()
 project_root = Path(__file__).parent.parent.parent
 sys.path.insert(0, str(project_root))
 
-from core.rag import advanced_rag_query
+from core.embedding_utils import get_embedder
+from core.rag import advanced_rag_query_async
 
 # Configure logging
 logging.basicConfig(
@@ -28,20 +34,66 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Per-question report: plain messages on stdout, buffered and flushed in blocks
+# instead of one write (and tty flush) per line
+report = logging.getLogger(f"{__name__}.report")
+report.setLevel(logging.INFO)
+report.propagate = False
+report_handler = logging.handlers.MemoryHandler(
+    capacity=256,
+    flushLevel=logging.ERROR,
+    target=logging.StreamHandler(sys.stdout)
+)
+report_handler.target.setFormatter(logging.Formatter("%(message)s"))
+report.addHandler(report_handler)
+
+SEPARATOR = "=" * 60
+RULE = "-" * 60
+
+
+def _iter_question_blocks(f: TextIO) -> Iterator[str]:
+    """Yield the stripped, non-empty blocks between empty lines"""
+    block = []
+    for line in f:
+        if line == '\n':
+            text = ''.join(block).strip()
+            if text:
+                yield text
+            block = []
+        else:
+            block.append(line)
+    text = ''.join(block).strip()
+    if text:
+        yield text
+
+
+def iter_test_questions(file_path: str) -> Iterator[str]:
+    """
+    Stream test questions from file without reading it into memory.
+    Questions are separated by empty lines; a file with a single block
+    is read as one question per line.
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        blocks = _iter_question_blocks(f)
+        first = next(blocks, None)
+        if first is None:
+            return
+        
+        second = next(blocks, None)
+        if second is None:
+            # If no double newlines, split by single newlines
+            yield from (q.strip() for q in first.split('\n') if q.strip())
+            return
+        
+        yield first
+        yield second
+        yield from blocks
+
 
 def load_test_questions(file_path: str) -> list:
     """Load test questions from file"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read().strip()
-        
-        # Split by double newlines (empty lines)
-        questions = [q.strip() for q in content.split('\n\n') if q.strip()]
-        
-        # If no double newlines, split by single newlines
-        if len(questions) == 1:
-            questions = [q.strip() for q in content.split('\n') if q.strip()]
-        
+        questions = list(iter_test_questions(file_path))
         logger.info(f"Loaded {len(questions)} test questions")
         return questions
         
@@ -53,20 +105,22 @@ def load_test_questions(file_path: str) -> list:
         return []
 
 
-def test_rag_system(
-    questions: list,
+async def test_rag_system(
+    questions: Iterable[str],
     llm_provider: str = "local",
     save_results: bool = True,
-    verbose: bool = True
+    verbose: bool = True,
+    concurrency: int = 8
 ) -> dict:
     """
     Test RAG system with list of questions.
     
     Args:
-        questions: List of test questions
+        questions: Test questions; any iterable, consumed once (e.g. iter_test_questions)
         llm_provider: LLM provider to use
         save_results: Whether to save results to file
         verbose: Whether to show detailed output
+        concurrency: Maximum number of questions in flight at once
         
     Returns:
         Dictionary with test results
@@ -74,52 +128,100 @@ def test_rag_system(
     results = {
         "timestamp": datetime.now().isoformat(),
         "llm_provider": llm_provider,
-        "total_questions": len(questions),
+        "total_questions": 0,
         "successful_responses": 0,
         "failed_responses": 0,
-        "intent_distribution": {},
-        "agent_distribution": {},
+        "intent_distribution": Counter(),
+        "agent_distribution": Counter(),
         "test_results": []
     }
     
-    logger.info(f"Starting RAG testing with {len(questions)} questions using {llm_provider} LLM")
+    # Streamed questions have no length up front; progress then shows the running number only
+    expected = len(questions) if hasattr(questions, "__len__") else None
+    if expected is None:
+        logger.info(f"Starting RAG testing with streamed questions using {llm_provider} LLM")
+    else:
+        logger.info(f"Starting RAG testing with {expected} questions using {llm_provider} LLM")
     
-    for i, question in enumerate(questions, 1):
-        try:
-            if verbose:
-                print(f"\n{'='*60}")
-                print(f"Question {i}/{len(questions)}")
-                print(f"{'='*60}")
-                print(f"Q: {question}")
-                print("-" * 60)
-            
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def run_question(question: str) -> dict:
+        async with semaphore:
             # Call RAG system with intelligent context decisions
-            result = advanced_rag_query(
+            return await advanced_rag_query_async(
                 query=question,
                 llm_provider=llm_provider
             )
+    
+    # Pull questions a window at a time so only that many are held in memory
+    question_iter = iter(questions)
+    window_size = concurrency * 4
+    i = 0
+    while True:
+        window = list(islice(question_iter, window_size))
+        if not window:
+            break
+        
+        # Embed the window in one batch up front; retrieval then hits the query cache
+        try:
+            await asyncio.to_thread(get_embedder().embed_queries, window)
+        except Exception as e:
+            logger.warning(f"Could not pre-embed test questions: {e}")
+        
+        # Up to `concurrency` questions are in flight; results come back in question order
+        window_results = await asyncio.gather(
+            *(run_question(question) for question in window),
+            return_exceptions=True
+        )
+        
+        for question, result in zip(window, window_results):
+            i += 1
+            results["total_questions"] = i
+            
+            if verbose:
+                report.info("\n%s\nQuestion %s\n%s\nQ: %s\n%s", SEPARATOR, f"{i}/{expected}" if expected else i, SEPARATOR, question, RULE)
+            
+            if isinstance(result, Exception):
+                results["failed_responses"] += 1
+                logger.error(f"Error processing question {i}: {result}")
+            
+                if verbose:
+                    report.info("EXCEPTION: %s", result)
+            
+                # Store error result
+                test_result = {
+                    "question_number": i,
+                    "question": question,
+                    "intent": "error",
+                    "agent": "error",
+                    "response": "",
+                    "sources_count": 0,
+                    "error": str(result)
+                }
+                results["test_results"].append(test_result)
+                continue
             
             if "error" not in result:
                 results["successful_responses"] += 1
-                
+            
                 # Track intent distribution
                 intent = result.get("intent", "unknown")
-                results["intent_distribution"][intent] = results["intent_distribution"].get(intent, 0) + 1
-                
+                results["intent_distribution"][intent] += 1
+            
                 # Track agent distribution
                 agent = result.get("agent", "unknown")
-                results["agent_distribution"][agent] = results["agent_distribution"].get(agent, 0) + 1
-                
+                results["agent_distribution"][agent] += 1
+            
                 if verbose:
-                    print(f"Intent: {intent}")
-                    print(f"Agent: {agent}")
-                    print(f"Sources: {len(result.get('sources', []))}")
-                    print(f"A: {result['response']}")
-                
+                    report.info(
+                        "Intent: %s\nAgent: %s\nSources: %d\nA: %s",
+                        intent, agent, len(result.get("sources", [])), result["response"]
+                    )
+            
             else:
                 results["failed_responses"] += 1
                 if verbose:
-                    print(f"ERROR: {result.get('error', 'Unknown error')}")
+                    report.info("ERROR: %s", result.get("error", "Unknown error"))
             
             # Store individual result
             test_result = {
@@ -132,25 +234,10 @@ def test_rag_system(
                 "error": result.get("error", None)
             }
             results["test_results"].append(test_result)
-            
-        except Exception as e:
-            results["failed_responses"] += 1
-            logger.error(f"Error processing question {i}: {e}")
-            
-            if verbose:
-                print(f"EXCEPTION: {e}")
-            
-            # Store error result
-            test_result = {
-                "question_number": i,
-                "question": question,
-                "intent": "error",
-                "agent": "error",
-                "response": "",
-                "sources_count": 0,
-                "error": str(e)
-            }
-            results["test_results"].append(test_result)
+    
+    # Plain dicts for the saved and returned results
+    results["intent_distribution"] = dict(results["intent_distribution"])
+    results["agent_distribution"] = dict(results["agent_distribution"])
     
     # Calculate success rate
     total = results["total_questions"]
@@ -159,19 +246,17 @@ def test_rag_system(
     
     # Print summary
     if verbose:
-        print(f"\n{'='*60}")
-        print("TEST SUMMARY")
-        print(f"{'='*60}")
-        print(f"Total Questions: {total}")
-        print(f"Successful: {success}")
-        print(f"Failed: {results['failed_responses']}")
-        print(f"Success Rate: {results['success_rate']:.1f}%")
-        print(f"\nIntent Distribution:")
+        report.info(
+            "\n%s\nTEST SUMMARY\n%s\nTotal Questions: %d\nSuccessful: %d\nFailed: %d\nSuccess Rate: %.1f%%",
+            SEPARATOR, SEPARATOR, total, success, results["failed_responses"], results["success_rate"]
+        )
+        report.info("\nIntent Distribution:")
         for intent, count in results["intent_distribution"].items():
-            print(f"  {intent}: {count}")
-        print(f"\nAgent Distribution:")
+            report.info("  %s: %d", intent, count)
+        report.info("\nAgent Distribution:")
         for agent, count in results["agent_distribution"].items():
-            print(f"  {agent}: {count}")
+            report.info("  %s: %d", agent, count)
+    report_handler.flush()
     
     # Save results to file
     if save_results:
@@ -179,8 +264,8 @@ def test_rag_system(
         results_file = f"rag_test_results_{timestamp}.json"
         
         try:
-            with open(results_file, 'w', encoding='utf-8') as f:
-                json.dump(results, f, indent=2, ensure_ascii=False)
+            with open(results_file, 'wb') as f:
+                f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
             logger.info(f"Results saved to: {results_file}")
         except Exception as e:
             logger.error(f"Failed to save results: {e}")
@@ -195,21 +280,26 @@ def save_formatted_results(results: dict, filename: str = None):
         filename = f"rag_test_qa_{timestamp}.txt"
     
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(f"RAG System Test Results\n")
-            f.write(f"Generated: {results['timestamp']}\n")
-            f.write(f"LLM Provider: {results['llm_provider']}\n")
-            f.write(f"Success Rate: {results['success_rate']:.1f}%\n")
-            f.write("=" * 80 + "\n\n")
-            
-            for test_result in results["test_results"]:
-                f.write(f"Q{test_result['question_number']}: {test_result['question']}\n")
-                f.write(f"Intent: {test_result['intent']} | Agent: {test_result['agent']}\n")
-                if test_result['error']:
-                    f.write(f"ERROR: {test_result['error']}\n")
-                else:
-                    f.write(f"A: {test_result['response']}\n")
-                f.write("\n" + "-" * 80 + "\n\n")
+        parts = [
+            f"RAG System Test Results\n",
+            f"Generated: {results['timestamp']}\n",
+            f"LLM Provider: {results['llm_provider']}\n",
+            f"Success Rate: {results['success_rate']:.1f}%\n",
+            "=" * 80 + "\n\n"
+        ]
+        
+        for test_result in results["test_results"]:
+            parts.append(f"Q{test_result['question_number']}: {test_result['question']}\n")
+            parts.append(f"Intent: {test_result['intent']} | Agent: {test_result['agent']}\n")
+            if test_result['error']:
+                parts.append(f"ERROR: {test_result['error']}\n")
+            else:
+                parts.append(f"A: {test_result['response']}\n")
+            parts.append("\n" + "-" * 80 + "\n\n")
+        
+        # One large buffered write instead of many small ones
+        with open(filename, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            f.write("".join(parts))
         
         logger.info(f"Formatted results saved to: {filename}")
         
@@ -238,6 +328,12 @@ def main():
         action="store_true",
         help="Don't save results to file"
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of questions in flight at once"
+    )
     parser.add_argument(
         "--quiet",
         action="store_true",
@@ -246,20 +342,31 @@ def main():
     
     args = parser.parse_args()
     
-    # Load test questions
-    questions = load_test_questions(args.questions_file)
-    if not questions:
+    # Skip report formatting entirely in quiet mode
+    if args.quiet:
+        report.setLevel(logging.WARNING)
+    
+    # Stream test questions; only the first is read before testing starts
+    questions = iter_test_questions(args.questions_file)
+    try:
+        first_question = next(questions, None)
+    except FileNotFoundError:
+        logger.error(f"Test questions file not found: {args.questions_file}")
+        sys.exit(1)
+    if first_question is None:
         logger.error("No test questions loaded. Exiting.")
         sys.exit(1)
+    questions = chain([first_question], questions)
     
     # Run tests
     try:
-        results = test_rag_system(
+        results = asyncio.run(test_rag_system(
             questions=questions,
             llm_provider=args.llm_provider,
             save_results=not args.no_save,
-            verbose=not args.quiet
-        )
+            verbose=not args.quiet,
+            concurrency=max(1, args.concurrency)
+        ))
         
         # Save formatted results
         if not args.no_save:
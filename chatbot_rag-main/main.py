@@ -5,17 +5,19 @@ FastAPI application for RAG Chat API with SQLite Database
 
 import sys
 import os
+import asyncio
 from pathlib import Path
 import logging
-import uuid
 import hashlib
 import secrets
 from typing import List, Dict, Any, Optional
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, EmailStr
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, EmailStr, TypeAdapter
 from dotenv import load_dotenv
 import json
+import orjson
 
 # Add the project root to the path
 project_root = Path(__file__).parent.parent
@@ -24,8 +26,9 @@ sys.path.insert(0, str(project_root))
 # Load environment variables
 load_dotenv()
 
-# Import RAG system and database services
-from core.rag import advanced_rag_query
+# Import database services (the RAG system is imported on first chat request)
+from core.cache import TTLCache
+from core.llm_utils import error_result
 from database.db_service import ProductService, CartService, OrderService, ChatService, UserService
 
 # Configure logging
@@ -34,11 +37,26 @@ logger = logging.getLogger(__name__)
 
 # Initialize database services
 db_path = str(project_root / "database" / "coffee_shop.db")
+# Services on the same db_path share one pool: each worker thread opens and
+# configures a single connection
 product_service = ProductService(db_path)
 cart_service = CartService(db_path)
 order_service = OrderService(db_path)
 chat_service = ChatService(db_path)
 user_service = UserService(db_path)
+product_service.ensure_indexes()
+
+# Product listings only change through the offline import scripts; repeat listing
+# requests are served from memory (and browsers revalidate by ETag) for this long
+PRODUCT_CACHE_TTL = 60
+product_list_cache = TTLCache(maxsize=1024, ttl=PRODUCT_CACHE_TTL)
+
+# Build orders straight from cart_items in SQL; set ORDER_FROM_CART_IN_SQL=false for the
+# previous read-cart-then-insert path
+ORDER_FROM_CART_IN_SQL = os.getenv("ORDER_FROM_CART_IN_SQL", "true").lower() == "true"
+
+# Messages of history loaded per chat turn; older turns are not sent to the RAG prompt
+CHAT_HISTORY_LIMIT = 20
 
 # Create FastAPI app
 app = FastAPI(
@@ -56,21 +74,69 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Errors nothing else handled (the database services no longer log each failure)
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    logger.error(f"Unhandled error on {request.method} {request.url.path}: {exc}", exc_info=exc)
+    return JSONResponse(status_code=500, content={"detail": "Internal server error"})
+
+# RAG system loader
+async def load_rag():
+    """
+    Import core.rag on first use, off the event loop.
+    It pulls in LangChain, Chroma and the embedding stack, which product,
+    cart and auth routes never need, so workers start without paying for it.
+    """
+    rag = sys.modules.get("core.rag")
+    if rag is not None:
+        return rag
+    
+    def _import():
+        from core import rag
+        return rag
+    return await asyncio.to_thread(_import)
+
 # Authentication utilities
+# scrypt cost parameters (~16 MB of memory per hash); stored alongside each hash
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=0, dklen=32)
+
 def hash_password(password: str) -> str:
-    """Hash password using SHA-256 with salt"""
-    salt = secrets.token_hex(16)
-    hash_obj = hashlib.sha256((password + salt).encode())
-    return f"{salt}${hash_obj.hexdigest()}"
+    """Hash password with the scrypt key derivation function"""
+    salt = secrets.token_bytes(16)
+    derived = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${derived.hex()}"
 
 def verify_password(password: str, hashed_password: str) -> bool:
-    """Verify password against hash"""
-    try:
-        salt, hash_value = hashed_password.split('$')
-        hash_obj = hashlib.sha256((password + salt).encode())
-        return hash_obj.hexdigest() == hash_value
-    except:
+    """Verify password against hash (scrypt, or legacy salted SHA-256)"""
+    if hashed_password.startswith("scrypt$"):
+        try:
+            _, n, r, p, salt, hash_value = hashed_password.split('$')
+            derived = _scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+            return secrets.compare_digest(derived.hex(), hash_value)
+        except ValueError:
+            return False
+    
+    # Accounts registered before the scrypt switch
+    parts = hashed_password.split('$', 1)
+    if len(parts) != 2:
         return False
+    salt, hash_value = parts
+    hash_obj = hashlib.sha256((password + salt).encode())
+    # Compare as bytes: compare_digest rejects non-ASCII str
+    return secrets.compare_digest(hash_obj.hexdigest().encode(), hash_value.encode())
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """Check whether a stored hash predates the current scrypt parameters"""
+    return not hashed_password.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+def new_session_id() -> str:
+    """Generate an opaque session ID (22 URL-safe characters from 16 random bytes)"""
+    return secrets.token_urlsafe(16)
 
 def generate_token(user_id: int) -> str:
     """Generate a simple token for demo purposes"""
@@ -78,6 +144,8 @@ def generate_token(user_id: int) -> str:
 
 # Models
 class ChatMessage(BaseModel):
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
     role: str = Field(..., description="Role of the message sender (user or assistant)")
     content: str = Field(..., description="Content of the message")
 
@@ -86,6 +154,8 @@ class ChatRequest(BaseModel):
     message: str = Field(..., description="User message")
 
 class Product(BaseModel):
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
     id: str = Field(..., description="Product ID")
     name: str = Field(..., description="Product name")
     price: float = Field(..., description="Product price")
@@ -93,6 +163,8 @@ class Product(BaseModel):
     image_url: str = Field(..., description="URL of the product image")
 
 class ChatResponse(BaseModel):
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
     session_id: str = Field(..., description="Session ID for the conversation")
     response: str = Field(..., description="Assistant response")
     intent: str = Field(..., description="Detected intent")
@@ -101,6 +173,9 @@ class ChatResponse(BaseModel):
     sources_count: int = Field(..., description="Number of sources used")
     chat_history: List[ChatMessage] = Field(..., description="Chat history")
 
+# Validates whole chat_messages row lists (namedtuples, read by attribute) in pydantic-core; unused columns are ignored
+chat_history_adapter = TypeAdapter(List[ChatMessage])
+
 class CartItemRequest(BaseModel):
     session_id: str
     user_id: Optional[int] = None
@@ -153,55 +228,45 @@ async def chat_endpoint(request: ChatRequest):
     """
     try:
         # Get or create session
-        session_id = request.session_id or str(uuid.uuid4())
-        
-        # Create or get chat session in database
-        chat_service.create_chat_session(session_id)
+        session_id = request.session_id or new_session_id()
         
-        # Retrieve chat history from database
-        db_messages = chat_service.get_chat_history(session_id)
+        # Retrieve the recent chat history from database (empty for a new session)
+        db_messages = await asyncio.to_thread(chat_service.get_chat_history, session_id, CHAT_HISTORY_LIMIT)
         
         # Convert to format expected by RAG system
         rag_chat_history = [
-            {"role": msg["role"], "content": msg["content"]}
+            {"role": msg.role, "content": msg.content}
             for msg in db_messages
         ]
         
-        # Add user message to database
-        chat_service.add_chat_message(session_id, "user", request.message)
-        
         # Call RAG system with chat history
         logger.info(f"Processing query: '{request.message[:50]}...' for session {session_id}")
-        result = advanced_rag_query(
+        rag = await load_rag()
+        result = await rag.advanced_rag_query_async(
             query=request.message,
             chat_history=rag_chat_history,
             llm_provider="gemini"  # Using Gemini as default
         )
         
-        # Add assistant response to database
-        chat_service.add_chat_message(
-            session_id, 
-            "assistant", 
+        # Store the session, both messages and the timestamp in one transaction
+        await asyncio.to_thread(
+            chat_service.finalize_turn,
+            session_id,
+            request.message,
             result["response"],
             result.get("intent"),
             result.get("agent")
         )
         
-        # Update session timestamp
-        chat_service.update_session_timestamp(session_id)
-        
         # Convert database messages to response format
-        chat_history = [
-            ChatMessage(role=msg["role"], content=msg["content"])
-            for msg in db_messages
-        ]
+        chat_history = chat_history_adapter.validate_python(db_messages, from_attributes=True)
         
         # Add current messages
         chat_history.append(ChatMessage(role="user", content=request.message))
         chat_history.append(ChatMessage(role="assistant", content=result["response"]))
         
         # Return structured response
-        return ChatResponse(
+        chat_response = ChatResponse(
             session_id=session_id,
             response=result["response"],
             intent=result.get("intent", "unknown"),
@@ -210,10 +275,111 @@ async def chat_endpoint(request: ChatRequest):
             sources_count=len(result.get("sources", [])),
             chat_history=chat_history
         )
+        # Already validated; serialize once instead of letting FastAPI re-validate and encode it
+        return Response(content=chat_response.model_dump_json(), media_type="application/json")
     except Exception as e:
         logger.error(f"Error processing chat request: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    Streaming chat endpoint (Server-Sent Events)
+    
+    - Sends {"tok": ...} events as the answer is generated
+    - Ends with a {"done": true, ...} event carrying intent, agent and products
+    - Stores the turn once the stream finishes
+    """
+    session_id = request.session_id or new_session_id()
+    
+    try:
+        # Retrieve the recent chat history from database (empty for a new session)
+        db_messages = await asyncio.to_thread(chat_service.get_chat_history, session_id, CHAT_HISTORY_LIMIT)
+    except Exception as e:
+        logger.error(f"Error processing chat stream request: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+    
+    rag_chat_history = [
+        {"role": msg.role, "content": msg.content}
+        for msg in db_messages
+    ]
+    
+    async def event_stream():
+        parts = []
+        result = None
+        try:
+            try:
+                rag = await load_rag()
+                async for event in rag.advanced_rag_query_stream(
+                    query=request.message,
+                    chat_history=rag_chat_history,
+                    llm_provider="gemini"
+                ):
+                    if "tok" in event:
+                        parts.append(event["tok"])
+                        yield f"data: {json.dumps({'tok': event['tok']})}\n\n"
+                    else:
+                        result = event["result"]
+                
+                if result is None:
+                    raise RuntimeError("RAG stream ended without a result")
+            except Exception as e:
+                # Loading the RAG system can fail before its own stream handles errors
+                logger.error(f"Error streaming chat response: {str(e)}")
+                result = error_result(e)
+            
+            # Cached, blocked and failed answers arrive whole
+            if not parts:
+                yield f"data: {json.dumps({'tok': result['response']})}\n\n"
+            
+            done = {
+                "done": True,
+                "session_id": session_id,
+                "response": result["response"],
+                "intent": result.get("intent", "unknown"),
+                "agent": result.get("agent", "Assistant"),
+                "products": result.get("products", []),
+                "sources_count": len(result.get("sources", []))
+            }
+            if "error" in result:
+                done["error"] = result["error"]
+            yield "data: " + json.dumps(done) + "\n\n"
+        finally:
+            response = result["response"] if result else "".join(parts).strip()
+            if response:
+                # Shielded so the turn is still stored if the client disconnects
+                await asyncio.shield(asyncio.to_thread(
+                    chat_service.finalize_turn,
+                    session_id,
+                    request.message,
+                    response,
+                    result.get("intent") if result else None,
+                    result.get("agent") if result else None
+                ))
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/chat/history", response_model=List[ChatMessage])
+async def chat_history_endpoint(
+    session_id: str = Query(...),
+    full: bool = False
+):
+    """
+    Chat history for a session
+    
+    - Returns the last CHAT_HISTORY_LIMIT messages, or every message with full=true
+    """
+    try:
+        db_messages = await asyncio.to_thread(
+            chat_service.get_chat_history,
+            session_id,
+            None if full else CHAT_HISTORY_LIMIT
+        )
+        return chat_history_adapter.validate_python(db_messages, from_attributes=True)
+    except Exception as e:
+        logger.error(f"Error getting chat history: {e}")
+        raise HTTPException(status_code=500, detail="Error retrieving chat history")
+
 @app.post("/api/chatbot")
 async def chatbot_endpoint(request: ChatRequest):
     """
@@ -221,42 +387,35 @@ async def chatbot_endpoint(request: ChatRequest):
     """
     try:
         # Get or create session
-        session_id = request.session_id or str(uuid.uuid4())
+        session_id = request.session_id or new_session_id()
         
-        # Create or get chat session in database
-        chat_service.create_chat_session(session_id)
-        
-        # Retrieve chat history from database
-        db_messages = chat_service.get_chat_history(session_id)
+        # Retrieve the recent chat history from database (empty for a new session)
+        db_messages = await asyncio.to_thread(chat_service.get_chat_history, session_id, CHAT_HISTORY_LIMIT)
         
         # Convert to format expected by RAG system
         rag_chat_history = [
-            {"role": msg["role"], "content": msg["content"]}
+            {"role": msg.role, "content": msg.content}
             for msg in db_messages
         ]
         
-        # Add user message to database
-        chat_service.add_chat_message(session_id, "user", request.message)
-        
         # Call RAG system
-        result = advanced_rag_query(
+        rag = await load_rag()
+        result = await rag.advanced_rag_query_async(
             query=request.message,
             chat_history=rag_chat_history,
             llm_provider="gemini"
         )
         
-        # Add assistant response to database
-        chat_service.add_chat_message(
-            session_id, 
-            "assistant", 
+        # Store the session, both messages and the timestamp in one transaction
+        await asyncio.to_thread(
+            chat_service.finalize_turn,
+            session_id,
+            request.message,
             result["response"],
             result.get("intent"),
             result.get("agent")
         )
         
-        # Update session timestamp
-        chat_service.update_session_timestamp(session_id)
-        
         # Return simplified response for frontend
         return {
             "reply": result["response"],
@@ -275,18 +434,39 @@ async def get_products(
     category_id: Optional[int] = None,
     is_popular: Optional[bool] = None,
     is_active: Optional[bool] = None,
-    search: Optional[str] = None
+    search: Optional[str] = None,
+    after_is_popular: Optional[bool] = None,
+    after_price: Optional[float] = None,
+    after_id: Optional[int] = None,
+    columnar: bool = False,
+    if_none_match: Optional[str] = Header(None)
 ):
-    """Get products with filtering and pagination"""
+    """Get products with filtering and pagination (skip, or the next_cursor fields of the previous page)"""
     try:
-        return product_service.get_products(
-            skip=skip,
-            limit=limit,
-            category_id=category_id,
-            is_popular=is_popular,
-            is_active=is_active,
-            search=search
-        )
+        cache_key = (skip, limit, category_id, is_popular, is_active, search, after_is_popular, after_price, after_id, columnar)
+        cached = product_list_cache.get(cache_key)
+        if cached is None:
+            products = product_service.get_products(
+                skip=skip,
+                limit=limit,
+                category_id=category_id,
+                is_popular=is_popular,
+                is_active=is_active,
+                search=search,
+                after_is_popular=after_is_popular,
+                after_price=after_price,
+                after_id=after_id,
+                columnar=columnar
+            )
+            body = orjson.dumps(products)
+            cached = (body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"')
+            product_list_cache.set(cache_key, cached)
+        
+        body, etag = cached
+        headers = {"ETag": etag, "Cache-Control": f"max-age={PRODUCT_CACHE_TTL}"}
+        if if_none_match == etag:
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
     except Exception as e:
         logger.error(f"Error getting products: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving products")
@@ -340,7 +520,7 @@ async def get_cart(
 async def update_cart_item(cart_item_id: int, quantity: int):
     """Update cart item quantity"""
     try:
-        success = cart_service.update_cart_item_quantity(cart_item_id, quantity)
+        success = await cart_service.update_cart_item_quantity_async(cart_item_id, quantity)
         if not success:
             raise HTTPException(status_code=404, detail="Cart item not found")
         return {"message": "Cart item updated successfully"}
@@ -354,7 +534,7 @@ async def update_cart_item(cart_item_id: int, quantity: int):
 async def remove_from_cart(cart_item_id: int):
     """Remove item from cart"""
     try:
-        success = cart_service.remove_from_cart(cart_item_id)
+        success = await cart_service.remove_from_cart_async(cart_item_id)
         if not success:
             raise HTTPException(status_code=404, detail="Cart item not found")
         return {"message": "Item removed from cart"}
@@ -371,7 +551,7 @@ async def clear_cart(
 ):
     """Clear all items from cart"""
     try:
-        success = cart_service.clear_cart(session_id, user_id)
+        success = await cart_service.clear_cart_async(session_id, user_id)
         return {"message": "Cart cleared successfully"}
     except Exception as e:
         logger.error(f"Error clearing cart: {e}")
@@ -381,7 +561,7 @@ async def clear_cart(
 @app.get("/api/v1/session-id/")
 async def generate_session_id():
     """Generate a new session ID"""
-    session_id = str(uuid.uuid4())
+    session_id = new_session_id()
     # Create session in database
     chat_service.create_chat_session(session_id)
     return {"session_id": session_id}
@@ -395,9 +575,15 @@ async def login(request: LoginRequest):
         if not user:
             raise HTTPException(status_code=401, detail="Invalid email or password")
         
-        if not verify_password(request.password, user["password_hash"]):
+        # Key derivation is deliberately slow; keep it off the event loop
+        if not await asyncio.to_thread(verify_password, request.password, user["password_hash"]):
             raise HTTPException(status_code=401, detail="Invalid email or password")
         
+        # Upgrade legacy hashes now that the plaintext is known to be correct
+        if password_needs_rehash(user["password_hash"]):
+            new_hash = await asyncio.to_thread(hash_password, request.password)
+            user_service.update_password_hash(user["id"], new_hash)
+        
         token = generate_token(user["id"])
         return {
             "access_token": token,
@@ -418,7 +604,7 @@ async def register(request: RegisterRequest):
         user_data = {
             "name": request.name,
             "email": request.email,
-            "password_hash": hash_password(request.password),
+            "password_hash": await asyncio.to_thread(hash_password, request.password),
             "is_active": True
         }
         user = user_service.create_user(user_data)
@@ -437,9 +623,6 @@ async def register(request: RegisterRequest):
 async def create_order(request: OrderRequest):
     """Create a new order"""
     try:
-        # Get cart items for the session
-        cart_data = cart_service.get_cart(request.session_id, request.user_id)
-        
         # Prepare order data
         order_data = {
             "user_id": request.user_id,
@@ -453,37 +636,47 @@ async def create_order(request: OrderRequest):
             "payment_method": request.payment_method,
             "shipping_address": request.shipping_address,
             "billing_address": request.billing_address,
-            "notes": request.notes,
-            "order_items": [
-                {
-                    "product_id": item["product_id"],
-                    "quantity": item["quantity"],
-                    "unit_price": item["unit_price"],
-                    "total_price": item["total_price"],
-                    "selected_size": item.get("selected_size"),
-                    "customizations": item.get("customizations"),
-                    "notes": None
-                }
-                for item in cart_data["items"]
-            ]
+            "notes": request.notes
         }
         
-        # Create order
-        order = order_service.create_order(order_data)
+        if ORDER_FROM_CART_IN_SQL:
+            # Order, items copied from the cart and cart deletion in one SQL transaction
+            return order_service.create_order_from_cart(order_data)
         
-        # Clear cart after successful order
-        cart_service.clear_cart(request.session_id, request.user_id)
+        # Get cart items for the session
+        cart_data = cart_service.get_cart(request.session_id, request.user_id)
+        order_data["order_items"] = [
+            {
+                "product_id": item["product_id"],
+                "quantity": item["quantity"],
+                "unit_price": item["unit_price"],
+                "total_price": item["total_price"],
+                "selected_size": item.get("selected_size"),
+                "customizations": item.get("customizations"),
+                "notes": None
+            }
+            for item in cart_data["items"]
+        ]
         
-        return order
+        # Create order and clear the cart in the same transaction
+        return order_service.create_order(order_data, clear_cart=True)
     except Exception as e:
         logger.error(f"Error creating order: {e}")
         raise HTTPException(status_code=500, detail="Error creating order")
 
 @app.get("/api/v1/orders/")
-async def get_orders(user_id: Optional[int] = None):
-    """Get orders for a user"""
+async def get_orders(
+    user_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=100),
+    after_created_at: Optional[str] = None,
+    after_id: Optional[int] = None,
+    include_items: bool = False
+):
+    """Get orders for a user, newest first; pass the last order's created_at and id for the next page"""
     try:
-        return order_service.get_orders(user_id)
+        if include_items:
+            return order_service.get_orders_with_items(user_id, limit, after_created_at, after_id)
+        return order_service.get_orders(user_id, limit, after_created_at, after_id)
     except Exception as e:
         logger.error(f"Error getting orders: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving orders")
@@ -515,13 +708,30 @@ async def get_categories():
 if __name__ == "__main__":
     import uvicorn
     import argparse
+    from importlib.util import find_spec
     
     parser = argparse.ArgumentParser(description='Run the FastAPI server')
     parser.add_argument('--port', type=int, default=8000, help='Port to run the server on')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to run the server on')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--reload', action='store_true', help='Reload on code changes (development only, single worker)')
     
     args = parser.parse_args()
     
-    print(f"Starting server on {args.host}:{args.port}")
+    # uvloop and httptools (C event loop and HTTP parser) when installed; uvloop has no Windows build.
+    # In production run: gunicorn main:app -k uvicorn.workers.UvicornWorker --workers $(nproc)
+    loop = "uvloop" if find_spec("uvloop") else "asyncio"
+    http = "httptools" if find_spec("httptools") else "h11"
+    
+    print(f"Starting server on {args.host}:{args.port} (loop={loop}, http={http})")
     print(f"Database: {db_path}")
-    uvicorn.run("main:app", host=args.host, port=args.port, reload=True)
+    # Each worker loads its own models; the local provider serves one generation at a time per worker
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        reload=args.reload,
+        loop=loop,
+        http=http
+    )
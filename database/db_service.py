@@ -4,185 +4,471 @@ Database Service Module
 Handles all database operations for the coffee shop application
 """
 
+import asyncio
 import sqlite3
 import json
-from typing import List, Dict, Any, Optional, Tuple
+import orjson
+from typing import Iterator, List, Dict, Any, Optional, Tuple, Union
 from pathlib import Path
-from datetime import datetime
+import atexit
+import collections
+import contextlib
+import functools
+import itertools
 import logging
+import secrets
+import threading
+import time
+from database.pool import ConnectionPool
+from database.writer import SQLiteWriter
 
 logger = logging.getLogger(__name__)
 
+# INSERT/UPDATE ... RETURNING hands back the written row (SQLite 3.35+)
+SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Identifies a cart line: one row per user, product, size and customizations
+CART_LINE_KEY = "user_id, product_id, IFNULL(selected_size, ''), IFNULL(customizations, '')"
+
+# Indexes behind the services' hot WHERE/ORDER BY clauses; also in schema.sql,
+# created by ensure_indexes on databases built before they were added
+HOT_QUERY_INDEXES = (
+    ("idx_products_sort",
+     "CREATE INDEX IF NOT EXISTS idx_products_sort ON products(is_popular DESC, retail_price DESC, id DESC)"),
+    ("idx_products_category_sort",
+     "CREATE INDEX IF NOT EXISTS idx_products_category_sort ON products(category_id, is_popular DESC, retail_price DESC, id DESC)"),
+    ("idx_cart_items_user",
+     "CREATE INDEX IF NOT EXISTS idx_cart_items_user ON cart_items(user_id, created_at DESC)"),
+    ("idx_orders_created",
+     "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at DESC, id DESC)"),
+    ("idx_orders_user_created",
+     "CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at DESC, id DESC)"),
+    ("idx_order_items_order",
+     "CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)"),
+    ("idx_chat_messages_session",
+     "CREATE INDEX IF NOT EXISTS idx_chat_messages_session ON chat_messages(session_id, created_at, id)"),
+)
+
+# Rows pulled from SQLite per fetchmany by execute_query_iter
+QUERY_BATCH_SIZE = 256
+
+# In-process caches for product lookups and the category list
+PRODUCT_CACHE_SIZE = 1024
+PRODUCT_CACHE_TTL = 300
+CATEGORY_CACHE_TTL = 600
+
+def _decode_json_value(value: Any) -> Any:
+    """Decode JSON text; NULL/empty is returned as is, bad JSON becomes {}"""
+    if not value:
+        return value
+    try:
+        return orjson.loads(value)
+    except (orjson.JSONDecodeError, TypeError):
+        return {}
+
+def _decode_json_field(row: Dict, field: str) -> None:
+    """Decode a JSON text column in place (see _decode_json_value)"""
+    value = row.get(field)
+    if value:
+        row[field] = _decode_json_value(value)
+
+@functools.lru_cache(maxsize=256)
+def _record_type(description: tuple) -> type:
+    """Namedtuple class for one result shape, built once per set of columns"""
+    return collections.namedtuple("Record", [column[0] for column in description], rename=True)
+
+def _record_factory(cursor: sqlite3.Cursor, row: tuple) -> tuple:
+    return _record_type(cursor.description)._make(row)
+
 class DatabaseService:
-    def __init__(self, db_path: str = "database/coffee_shop.db"):
-        self.db_path = db_path
-        self.conn = None
+    # One connection pool per database file, shared by every service instance
+    _pools: Dict[str, ConnectionPool] = {}
+    _pools_lock = threading.Lock()
+    
+    # One writer thread per database file, started on the first async write
+    _writers: Dict[str, SQLiteWriter] = {}
+    
+    # Optional schema objects (added by the migrate_* scripts) per database file
+    _schema_objects: Dict[Tuple[str, str], bool] = {}
+    
+    def __init__(self, db_path: Union[str, ConnectionPool] = "database/coffee_shop.db"):
+        # Services for the same database share its per-thread connections
+        self.pool = db_path if isinstance(db_path, ConnectionPool) else self._pool(db_path)
+        self.db_path = self.pool.db_path
+        
+    @classmethod
+    def _pool(cls, db_path: str) -> ConnectionPool:
+        """Get the shared pool for a database file, creating it on first use"""
+        with cls._pools_lock:
+            pool = cls._pools.get(db_path)
+            if pool is None:
+                pool = cls._pools[db_path] = ConnectionPool(db_path)
+            return pool
+        
+    @classmethod
+    def close_all_pools(cls):
+        """Close every pooled connection; registered to run at process exit"""
+        with cls._pools_lock:
+            pools = list(cls._pools.values())
+        for pool in pools:
+            pool.close_all()
+        
+    def ensure_indexes(self) -> None:
+        """Create any missing HOT_QUERY_INDEXES and refresh planner statistics when needed"""
+        try:
+            conn = self.get_connection()
+            existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+            missing = [sql for name, sql in HOT_QUERY_INDEXES if name not in existing]
+            for sql in missing:
+                conn.execute(sql)
+            # ANALYZE only when the planner has no statistics or new indexes to weigh
+            if missing or "sqlite_stat1" not in existing:
+                conn.execute("ANALYZE")
+                logger.info(f"Created {len(missing)} indexes and analyzed {self.db_path}")
+        except sqlite3.Error as e:
+            logger.warning(f"Could not create indexes in {self.db_path}: {e}")
+            
+    def has_schema_object(self, name: str) -> bool:
+        """Check once per database whether a table or index exists"""
+        key = (self.db_path, name)
+        available = self._schema_objects.get(key)
+        if available is None:
+            rows = self.execute_query("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+            available = self._schema_objects[key] = bool(rows)
+            if not available:
+                logger.warning(f"{name} not found in {self.db_path}; run the matching database/migrate_* script")
+        return available
         
     def get_connection(self):
         """Get database connection"""
-        if self.conn is None:
-            self.conn = sqlite3.connect(self.db_path)
-            self.conn.row_factory = sqlite3.Row  # Enable dict-like access
-        return self.conn
+        return self.pool.get_conn()
         
     def close_connection(self):
-        """Close database connection"""
-        if self.conn:
-            self.conn.close()
-            self.conn = None
+        """Connections are long-lived and closed at process exit; nothing to do per call"""
+        pass
             
     def execute_query(self, query: str, params: tuple = ()) -> List[Dict]:
         """Execute a SELECT query and return results as list of dicts"""
+        # conn.execute reuses the connection's compiled statement for this SQL text
+        rows = self.get_connection().execute(query, params).fetchall()
+        return [dict(row) for row in rows]
+            
+    def execute_query_iter(self, query: str, params: tuple = ()) -> Iterator[Dict]:
+        """Execute a SELECT query and yield rows as dicts, fetched in batches"""
+        cursor = self.get_connection().execute(query, params)
+        cursor.arraysize = QUERY_BATCH_SIZE
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
-        except Exception as e:
-            logger.error(f"Database query error: {e}")
-            raise
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+        finally:
+            # Ends the read even if the caller stops early
+            cursor.close()
+            
+    def execute_query_records(self, query: str, params: tuple = ()) -> Iterator[tuple]:
+        """Execute a SELECT query and yield rows as immutable namedtuples, fetched in batches"""
+        cursor = self.get_connection().cursor()
+        cursor.row_factory = _record_factory
+        cursor.arraysize = QUERY_BATCH_SIZE
+        cursor.execute(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+            
+    def execute_query_columns(self, query: str, params: tuple = ()) -> Dict[str, List]:
+        """Execute a SELECT query and return results column-wise, as {column: [values]}"""
+        cursor = self.get_connection().cursor()
+        # Plain tuples: skip building a Row and then a dict per row
+        cursor.row_factory = None
+        rows = cursor.execute(query, params).fetchall()
+        names = [d[0] for d in cursor.description]
+        columns = zip(*rows) if rows else ([] for _ in names)
+        return {name: list(values) for name, values in zip(names, columns)}
             
     def execute_update(self, query: str, params: tuple = ()) -> int:
         """Execute an INSERT/UPDATE/DELETE query and return affected rows"""
+        # Commits on success and rolls back on error
+        with self.get_connection() as conn:
+            return conn.execute(query, params).rowcount
+            
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Run a block of writes as one transaction on this thread's connection.
+        
+        BEGIN IMMEDIATE takes the write lock up front, so a concurrent writer
+        waits in busy_timeout here instead of failing mid-transaction. Commits
+        when the block completes and rolls back if it raises.
+        """
+        conn = self.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute(query, params)
+            yield conn
+            # Inside the try: a failed COMMIT must not leave the transaction open
+            # on this thread's pooled connection
             conn.commit()
-            return cursor.rowcount
-        except Exception as e:
-            logger.error(f"Database update error: {e}")
+        except BaseException:
             conn.rollback()
             raise
             
+    async def execute_update_async(self, query: str, params: tuple = ()) -> int:
+        """
+        Queue an INSERT/UPDATE/DELETE on the database's writer thread and return
+        the affected rows once committed, without blocking the event loop.
+        """
+        writer = self._writers.get(self.db_path)
+        if writer is None:
+            with self._pools_lock:
+                writer = self._writers.get(self.db_path)
+                if writer is None:
+                    writer = self._writers[self.db_path] = SQLiteWriter(self.pool)
+        return await asyncio.wrap_future(writer.submit(query, params))
+        
     def execute_many(self, query: str, params_list: List[tuple]) -> int:
-        """Execute multiple INSERT/UPDATE/DELETE queries"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.executemany(query, params_list)
-            conn.commit()
-            return cursor.rowcount
-        except Exception as e:
-            logger.error(f"Database batch update error: {e}")
-            conn.rollback()
-            raise
+        """Execute multiple INSERT/UPDATE/DELETE queries in a single transaction"""
+        with self.transaction() as conn:
+            return conn.executemany(query, params_list).rowcount
+            
+    def execute_returning(self, query: str, params: tuple = ()) -> Optional[Dict]:
+        """Execute an INSERT/UPDATE ... RETURNING query and return the written row"""
+        with self.get_connection() as conn:
+            # Fetch everything so the statement finishes and autocommits
+            rows = conn.execute(query, params).fetchall()
+        return dict(rows[0]) if rows else None
             
     def get_last_insert_id(self) -> int:
         """Get the last inserted row ID"""
-        try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            return cursor.lastrowid
-        except Exception as e:
-            logger.error(f"Error getting last insert ID: {e}")
-            raise
+        # Per connection, and the pool gives each thread its own
+        return self.get_connection().execute("SELECT last_insert_rowid()").fetchone()[0]
+
+atexit.register(DatabaseService.close_all_pools)
+
+def _product_where(has_category: bool, has_popular: bool, has_active: bool,
+                   search_mode: Optional[str], use_cursor: bool) -> str:
+    """WHERE clause of a get_products filter shape"""
+    where_conditions = []
+    if has_category:
+        where_conditions.append("p.category_id = ?")
+    if has_popular:
+        where_conditions.append("p.is_popular = ?")
+    if has_active:
+        where_conditions.append("p.is_active = ?")
+    if search_mode == 'fts':
+        # Trigram index lookup
+        where_conditions.append("p.id IN (SELECT rowid FROM products_fts WHERE products_fts MATCH ?)")
+    elif search_mode == 'like':
+        where_conditions.append("(p.name LIKE ? OR p.description LIKE ?)")
+    if use_cursor:
+        # Keyset cursor: rows sorting after the last row of the previous page
+        where_conditions.append("(p.is_popular, p.retail_price, p.id) < (?, ?, ?)")
+    return " AND ".join(where_conditions) if where_conditions else "1=1"
+
+def _product_queries(where_clause: str) -> Tuple[str, str]:
+    """Page query (with the total match count) and count-only query for a WHERE clause"""
+    query = f"""
+        SELECT 
+            p.*,
+            json_object('id', p.category_id, 'name', c.name, 'description', c.description) as category_json,
+            COUNT(*) OVER () as _total
+        FROM products p
+        LEFT JOIN categories c ON p.category_id = c.id
+        WHERE {where_clause}
+        ORDER BY p.is_popular DESC, p.retail_price DESC, p.id DESC
+        LIMIT ? OFFSET ?
+    """
+    count_query = f"""
+        SELECT COUNT(*) as total
+        FROM products p
+        WHERE {where_clause}
+    """
+    return query, count_query
+
+# (page, count) SQL for every get_products filter shape, built once at import
+_PRODUCT_QUERIES = {
+    shape: _product_queries(_product_where(*shape))
+    for shape in itertools.product(
+        (False, True), (False, True), (False, True), (None, 'fts', 'like'), (False, True)
+    )
+}
 
 class ProductService(DatabaseService):
     """Service for product-related database operations"""
     
+    # Per database file, shared by every ProductService/CartService instance
+    _product_caches: Dict[str, "collections.OrderedDict[int, Tuple[float, Dict]]"] = {}
+    _category_caches: Dict[str, Tuple[float, List[Dict]]] = {}
+    _cache_lock = threading.Lock()
+    
     def get_products(self, 
                     skip: int = 0, 
                     limit: int = 20, 
                     category_id: Optional[int] = None,
                     is_popular: Optional[bool] = None,
                     is_active: Optional[bool] = None,
-                    search: Optional[str] = None) -> Dict[str, Any]:
-        """Get products with filtering and pagination"""
+                    search: Optional[str] = None,
+                    after_is_popular: Optional[bool] = None,
+                    after_price: Optional[float] = None,
+                    after_id: Optional[int] = None,
+                    columnar: bool = False) -> Dict[str, Any]:
+        """
+        Get products with filtering and pagination.
         
-        # Build WHERE clause
-        where_conditions = []
-        params = []
+        Pages are addressed either by skip (OFFSET) or, for deep pages, by the
+        keyset cursor after_is_popular/after_price/after_id taken from the
+        previous page's next_cursor. With a cursor, skip is ignored and total
+        and page are None.
+        
+        With columnar=True, 'products' is {field: [value per product]} instead
+        of a list of product dicts.
+        """
+        
+        # Look up the prebuilt SQL for this filter shape; only the params vary per call
+        if not search:
+            search_mode = None
+        elif len(search) > 2 and self.has_schema_object('products_fts'):
+            search_mode = 'fts'
+        else:
+            # Trigrams need 3+ characters
+            search_mode = 'like'
+        use_cursor = after_id is not None
+        query, count_query = _PRODUCT_QUERIES[
+            (category_id is not None, is_popular is not None, is_active is not None, search_mode, use_cursor)
+        ]
         
+        # Parameters in the order of _product_where
+        params = []
         if category_id is not None:
-            where_conditions.append("p.category_id = ?")
             params.append(category_id)
-            
         if is_popular is not None:
-            where_conditions.append("p.is_popular = ?")
             params.append(is_popular)
-            
         if is_active is not None:
-            where_conditions.append("p.is_active = ?")
             params.append(is_active)
-            
-        if search:
-            where_conditions.append("(p.name LIKE ? OR p.description LIKE ?)")
+        if search_mode == 'fts':
+            # The quoted phrase matches the term as a substring
+            params.append('"' + search.replace('"', '""') + '"')
+        elif search_mode == 'like':
             search_term = f"%{search}%"
             params.extend([search_term, search_term])
-            
-        where_clause = " AND ".join(where_conditions) if where_conditions else "1=1"
-        
-        # Get total count
-        count_query = f"""
-            SELECT COUNT(*) as total
-            FROM products p
-            WHERE {where_clause}
-        """
-        count_result = self.execute_query(count_query, params)
-        total = count_result[0]['total'] if count_result else 0
+        if use_cursor:
+            params.extend([after_is_popular, after_price, after_id])
+            skip = 0
         
-        # Get products with pagination
-        query = f"""
-            SELECT 
-                p.*,
-                c.name as category_name,
-                c.description as category_description,
-                pt.name as product_type_name,
-                pg.name as product_group_name
-            FROM products p
-            LEFT JOIN categories c ON p.category_id = c.id
-            LEFT JOIN product_types pt ON p.product_type_id = pt.id
-            LEFT JOIN product_groups pg ON p.product_group_id = pg.id
-            WHERE {where_clause}
-            ORDER BY p.is_popular DESC, p.retail_price DESC
-            LIMIT ? OFFSET ?
-        """
-        
-        params.extend([limit, skip])
-        products = self.execute_query(query, params)
+        if columnar:
+            # One list per column; JSON columns are decoded a column at a time
+            products = self.execute_query_columns(query, params + [limit, skip])
+            totals = products.pop('_total')
+            page_total = totals[0] if totals else 0
+            products['nutrition_info'] = [_decode_json_value(v) for v in products['nutrition_info']]
+            products['category'] = [orjson.loads(v) for v in products.pop('category_json')]
+            count = len(totals)
+            last = {key: products[key][-1] for key in ('is_popular', 'retail_price', 'id')} if count else None
+        else:
+            # Process products as they are fetched
+            products = []
+            page_total = 0
+            for product in self.execute_query_iter(query, params + [limit, skip]):
+                page_total = product.pop('_total')
+                
+                # Parse JSON fields
+                _decode_json_field(product, 'nutrition_info')
+                        
+                # Category object, assembled by SQLite
+                product['category'] = orjson.loads(product.pop('category_json'))
+                products.append(product)
+            count = len(products)
+            last = products[-1] if products else None
         
-        # Process products
-        for product in products:
-            # Parse JSON fields
-            if product.get('nutrition_info'):
-                try:
-                    product['nutrition_info'] = json.loads(product['nutrition_info'])
-                except:
-                    product['nutrition_info'] = {}
-                    
-            # Add category object
-            product['category'] = {
-                'id': product['category_id'],
-                'name': product['category_name'],
-                'description': product['category_description']
+        # Cursor for the next page, when this one is full
+        next_cursor = None
+        if count == limit:
+            next_cursor = {
+                'after_is_popular': last['is_popular'],
+                'after_price': last['retail_price'],
+                'after_id': last['id']
             }
             
-            # Remove redundant fields
-            for field in ['category_name', 'category_description', 'product_type_name', 'product_group_name']:
-                product.pop(field, None)
+        if use_cursor:
+            # Rows before the cursor are not counted; the first page reports the total
+            total = None
+        elif count:
+            total = page_total
+        elif skip > 0:
+            # Page past the end: no row carries the total, so count separately
+            count_result = self.execute_query(count_query, params)
+            total = count_result[0]['total'] if count_result else 0
+        else:
+            total = 0
                 
         return {
             'products': products,
             'total': total,
-            'page': (skip // limit) + 1,
-            'per_page': limit
+            'page': None if use_cursor else (skip // limit) + 1,
+            'per_page': limit,
+            'next_cursor': next_cursor
         }
         
     def get_product_by_id(self, product_id: int) -> Optional[Dict]:
-        """Get a single product by ID"""
+        """
+        Get a single product by ID.
+        
+        Results are cached in process for PRODUCT_CACHE_TTL seconds and shared
+        between callers: treat the returned dict as read-only, and call
+        invalidate() after changing products. Missing products are not cached.
+        """
+        with self._cache_lock:
+            cache = self._product_caches.setdefault(self.db_path, collections.OrderedDict())
+            cached = cache.get(product_id)
+            if cached is not None and cached[0] > time.monotonic():
+                cache.move_to_end(product_id)
+                return cached[1]
+        
+        product = self._load_product_by_id(product_id)
+        if product is None:
+            return None
+        
+        with self._cache_lock:
+            cache[product_id] = (time.monotonic() + PRODUCT_CACHE_TTL, product)
+            cache.move_to_end(product_id)
+            if len(cache) > PRODUCT_CACHE_SIZE:
+                cache.popitem(last=False)
+        return product
+        
+    def invalidate(self, product_id: Optional[int] = None) -> None:
+        """
+        Drop cached products and categories after a product or category write.
+        
+        A product_id drops only that product (cached under either its row id
+        or its product_id); without one the whole product cache is cleared.
+        """
+        with self._cache_lock:
+            cache = self._product_caches.get(self.db_path)
+            if cache is not None:
+                if product_id is None:
+                    cache.clear()
+                else:
+                    for key in [
+                        key for key, (_, product) in cache.items()
+                        if product_id in (key, product.get('id'), product.get('product_id'))
+                    ]:
+                        del cache[key]
+            self._category_caches.pop(self.db_path, None)
+        
+    def _load_product_by_id(self, product_id: int) -> Optional[Dict]:
+        """Read a single product by ID from the database"""
         query = """
             SELECT 
                 p.*,
-                c.name as category_name,
-                c.description as category_description,
-                pt.name as product_type_name,
-                pg.name as product_group_name
+                json_object('id', p.category_id, 'name', c.name, 'description', c.description) as category_json
             FROM products p
             LEFT JOIN categories c ON p.category_id = c.id
-            LEFT JOIN product_types pt ON p.product_type_id = pt.id
-            LEFT JOIN product_groups pg ON p.product_group_id = pg.id
             WHERE p.id = ? OR p.product_id = ?
         """
         
@@ -193,35 +479,29 @@ class ProductService(DatabaseService):
         product = results[0]
         
         # Parse JSON fields
-        if product.get('nutrition_info'):
-            try:
-                product['nutrition_info'] = json.loads(product['nutrition_info'])
-            except:
-                product['nutrition_info'] = {}
+        _decode_json_field(product, 'nutrition_info')
                 
-        # Add category object
-        product['category'] = {
-            'id': product['category_id'],
-            'name': product['category_name'],
-            'description': product['category_description']
-        }
-        
-        # Remove redundant fields
-        for field in ['category_name', 'category_description', 'product_type_name', 'product_group_name']:
-            product.pop(field, None)
+        # Category object, assembled by SQLite
+        product['category'] = orjson.loads(product.pop('category_json'))
             
         return product
         
     def get_categories(self) -> List[Dict]:
-        """Get all categories"""
+        """Get all categories (cached for CATEGORY_CACHE_TTL seconds; treat as read-only)"""
+        cached = self._category_caches.get(self.db_path)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+            
         query = """
             SELECT id, name, description, parent_id, created_at, updated_at
             FROM categories
             ORDER BY name
         """
-        return self.execute_query(query)
+        categories = self.execute_query(query)
+        self._category_caches[self.db_path] = (time.monotonic() + CATEGORY_CACHE_TTL, categories)
+        return categories
 
-class CartService(DatabaseService):
+class CartService(ProductService):
     """Service for cart-related database operations"""
     
     def add_to_cart(self, session_id: str, product_id: int, quantity: int, 
@@ -229,13 +509,42 @@ class CartService(DatabaseService):
                    customizations: Optional[Dict] = None) -> Dict:
         """Add item to cart (update quantity if already exists, by user_id only)"""
         # Get product details
-        product_service = ProductService(self.db_path)
-        product = product_service.get_product_by_id(product_id)
+        product = self.get_product_by_id(product_id)
         if not product:
             raise ValueError(f"Product with ID {product_id} not found")
         unit_price = float(product['retail_price'])
         total_price = unit_price * quantity
+        # Stays on json.dumps: the text is compared with stored rows to find the same line
         customizations_json = json.dumps(customizations) if customizations else None
+        
+        if not (SUPPORTS_RETURNING and self.has_schema_object('idx_cart_items_unique')):
+            return self._add_to_cart_checked(
+                product, user_id, product_id, quantity, selected_size, customizations_json
+            )
+            
+        # One atomic statement: insert the line, or add to the quantity of the same line
+        query = f"""
+            INSERT INTO cart_items (
+                user_id, product_id, quantity, selected_size, 
+                customizations, unit_price, total_price, created_at, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ON CONFLICT ({CART_LINE_KEY}) DO UPDATE SET
+                quantity = cart_items.quantity + excluded.quantity,
+                total_price = excluded.unit_price * (cart_items.quantity + excluded.quantity),
+                updated_at = CURRENT_TIMESTAMP
+            RETURNING *
+        """
+        item = self.execute_returning(query, (
+            user_id, product_id, quantity, selected_size,
+            customizations_json, unit_price, total_price
+        ))
+        return self._cart_item_with_product(item, product)
+        
+    def _add_to_cart_checked(self, product: Dict, user_id: Optional[int], product_id: int, quantity: int,
+                             selected_size: Optional[str], customizations_json: Optional[str]) -> Dict:
+        """add_to_cart for databases without idx_cart_items_unique: check, then update or insert"""
+        unit_price = float(product['retail_price'])
+        total_price = unit_price * quantity
         # Check if item already exists in cart (same user, product, size, customizations)
         query_check = """
             SELECT id, quantity FROM cart_items
@@ -248,25 +557,43 @@ class CartService(DatabaseService):
         if existing:
             cart_item_id = existing[0]['id']
             new_quantity = existing[0]['quantity'] + quantity
-            update_query = """
+            write_query = """
                 UPDATE cart_items
                 SET quantity = ?, total_price = ?, updated_at = CURRENT_TIMESTAMP
                 WHERE id = ?
             """
-            self.execute_update(update_query, (new_quantity, unit_price * new_quantity, cart_item_id))
-            return self.get_cart_item_by_user_and_product(user_id, product_id)
+            params = (new_quantity, unit_price * new_quantity, cart_item_id)
         else:
-            query = """
+            write_query = """
                 INSERT INTO cart_items (
                     user_id, product_id, quantity, selected_size, 
                     customizations, unit_price, total_price, created_at, updated_at
                 ) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
             """
-            self.execute_update(query, (
+            params = (
                 user_id, product_id, quantity, selected_size,
                 customizations_json, unit_price, total_price
-            ))
+            )
+            
+        if not SUPPORTS_RETURNING:
+            self.execute_update(write_query, params)
             return self.get_cart_item_by_user_and_product(user_id, product_id)
+            
+        # The written row comes back with the statement; product details are already loaded
+        item = self.execute_returning(write_query + " RETURNING *", params)
+        return self._cart_item_with_product(item, product)
+        
+    def _cart_item_with_product(self, item: Dict, product: Dict) -> Dict:
+        """Shape a cart_items row like get_cart_item_by_user_and_product"""
+        _decode_json_field(item, 'customizations')
+        item['product'] = {
+            'id': item['product_id'],
+            'name': product['name'],
+            'description': product['description'],
+            'image': product['image_url'],
+            'price': product['retail_price']
+        }
+        return item
 
     def get_cart(self, session_id: str = None, user_id: Optional[int] = None) -> Dict[str, Any]:
         """Get cart items for a user only (ignore session_id)"""
@@ -275,11 +602,14 @@ class CartService(DatabaseService):
         query = """
             SELECT 
                 ci.*,
-                p.name as product_name,
-                p.description as product_description,
-                p.image_url as product_image,
-                p.retail_price as product_price,
-                c.name as category_name
+                json_object(
+                    'id', ci.product_id,
+                    'name', p.name,
+                    'description', p.description,
+                    'image', p.image_url,
+                    'price', p.retail_price,
+                    'category', json_object('name', c.name)
+                ) as product_json
             FROM cart_items ci
             JOIN products p ON ci.product_id = p.id
             LEFT JOIN categories c ON p.category_id = c.id
@@ -289,23 +619,9 @@ class CartService(DatabaseService):
         params = [user_id]
         items = self.execute_query(query, params)
         for item in items:
-            if item.get('customizations'):
-                try:
-                    item['customizations'] = json.loads(item['customizations'])
-                except:
-                    item['customizations'] = {}
-            item['product'] = {
-                'id': item['product_id'],
-                'name': item['product_name'],
-                'description': item['product_description'],
-                'image': item['product_image'],
-                'price': item['product_price'],
-                'category': {
-                    'name': item['category_name']
-                }
-            }
-            for field in ['product_name', 'product_description', 'product_image', 'product_price', 'category_name']:
-                item.pop(field, None)
+            _decode_json_field(item, 'customizations')
+            # Product object, assembled by SQLite
+            item['product'] = orjson.loads(item.pop('product_json'))
         total_items = sum(item['quantity'] for item in items)
         total_amount = sum(item['total_price'] for item in items)
         return {
@@ -331,11 +647,7 @@ class CartService(DatabaseService):
         if not results:
             return None
         item = results[0]
-        if item.get('customizations'):
-            try:
-                item['customizations'] = json.loads(item['customizations'])
-            except:
-                item['customizations'] = {}
+        _decode_json_field(item, 'customizations')
         item['product'] = {
             'id': item['product_id'],
             'name': item['product_name'],
@@ -383,16 +695,81 @@ class CartService(DatabaseService):
         affected_rows = self.execute_update(query, params)
         return affected_rows > 0
 
+    async def update_cart_item_quantity_async(self, cart_item_id: int, quantity: int) -> bool:
+        """update_cart_item_quantity through the writer thread, as a single UPDATE"""
+        query = """
+            UPDATE cart_items 
+            SET quantity = ?, total_price = unit_price * ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """
+        return await self.execute_update_async(query, (quantity, quantity, cart_item_id)) > 0
+        
+    async def remove_from_cart_async(self, cart_item_id: int) -> bool:
+        """remove_from_cart through the writer thread"""
+        query = "DELETE FROM cart_items WHERE id = ?"
+        return await self.execute_update_async(query, (cart_item_id,)) > 0
+        
+    async def clear_cart_async(self, session_id: str, user_id: Optional[int] = None) -> bool:
+        """clear_cart through the writer thread"""
+        query = "DELETE FROM cart_items WHERE user_id = ?"
+        return await self.execute_update_async(query, (user_id,)) > 0
+
 class OrderService(DatabaseService):
     """Service for order-related database operations"""
     
-    def create_order(self, order_data: Dict[str, Any]) -> Dict:
-        """Create a new order"""
+    ORDER_ITEM_INSERT = """
+        INSERT INTO order_items (
+            order_id, product_id, quantity, unit_price, total_price,
+            selected_size, customizations, notes, created_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    """
+    
+    def create_order(self, order_data: Dict[str, Any], clear_cart: bool = False) -> Dict:
+        """Create a new order and its items in one transaction, optionally clearing the user's cart"""
+        with self.transaction() as conn:
+            order_id = self._insert_order(conn, order_data)
+            
+            # Add order items with one prepared statement
+            if order_data.get('order_items'):
+                conn.executemany(self.ORDER_ITEM_INSERT, self._order_item_rows(order_id, order_data['order_items']))
+            
+            # Same scope as CartService.clear_cart, but committed with the order
+            if clear_cart:
+                conn.execute("DELETE FROM cart_items WHERE user_id = ?", (order_data.get('user_id'),))
+            
+        return self.get_order_by_id(order_id)
+        
+    def create_order_from_cart(self, order_data: Dict[str, Any]) -> Dict:
+        """
+        Create an order from the user's cart entirely in SQL: the order row, its items
+        copied from cart_items and the cart deletion all commit together
+        """
+        user_id = order_data.get('user_id')
+        with self.transaction() as conn:
+            order_id = self._insert_order(conn, order_data)
+            
+            # Same rows and order CartService.get_cart returns
+            conn.execute("""
+                INSERT INTO order_items (
+                    order_id, product_id, quantity, unit_price, total_price,
+                    selected_size, customizations, notes, created_at
+                )
+                SELECT ?, ci.product_id, ci.quantity, ci.unit_price, ci.total_price,
+                       ci.selected_size, ci.customizations, NULL, CURRENT_TIMESTAMP
+                FROM cart_items ci
+                JOIN products p ON ci.product_id = p.id
+                WHERE ci.user_id = ?
+                ORDER BY ci.created_at DESC
+            """, (order_id, user_id))
+            conn.execute("DELETE FROM cart_items WHERE user_id = ?", (user_id,))
+            
+        return self.get_order_by_id(order_id)
         
+    def _insert_order(self, conn: sqlite3.Connection, order_data: Dict[str, Any]) -> int:
+        """Insert the order row inside the caller's transaction and return its ID"""
         # Generate order number
         order_number = self.generate_order_number()
         
-        # Insert order
         order_query = """
             INSERT INTO orders (
                 order_number, user_id, session_id, status, total_amount,
@@ -403,7 +780,7 @@ class OrderService(DatabaseService):
                      CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
         """
         
-        self.execute_update(order_query, (
+        cursor = conn.execute(order_query + (" RETURNING id" if SUPPORTS_RETURNING else ""), (
             order_number,
             order_data.get('user_id'),
             order_data.get('session_id'),
@@ -414,50 +791,41 @@ class OrderService(DatabaseService):
             order_data.get('final_amount', 0),
             order_data.get('payment_status', 'pending'),
             order_data.get('payment_method'),
-            json.dumps(order_data.get('shipping_address', {})),
-            json.dumps(order_data.get('billing_address', {})),
+            orjson.dumps(order_data.get('shipping_address', {})).decode(),
+            orjson.dumps(order_data.get('billing_address', {})).decode(),
             order_data.get('notes')
         ))
-        
-        # Get the created order ID
-        order_id = self.get_last_insert_id()
-        
-        # Add order items
-        if order_data.get('order_items'):
-            self.add_order_items(order_id, order_data['order_items'])
-            
-        return self.get_order_by_id(order_id)
+        return cursor.fetchone()[0] if SUPPORTS_RETURNING else cursor.lastrowid
         
     def generate_order_number(self) -> str:
         """Generate unique order number"""
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        return f"ORD-{timestamp}"
+        # Nanosecond clock plus a random suffix: orders in the same second no longer collide
+        return f"ORD-{time.time_ns():x}-{secrets.token_hex(2)}"
         
     def get_last_insert_id(self) -> int:
         """Get the last inserted row ID"""
         result = self.execute_query("SELECT last_insert_rowid() as id")
         return result[0]['id'] if result else 0
         
-    def add_order_items(self, order_id: int, items: List[Dict]) -> None:
-        """Add items to an order"""
-        query = """
-            INSERT INTO order_items (
-                order_id, product_id, quantity, unit_price, total_price,
-                selected_size, customizations, notes, created_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """
-        
-        for item in items:
-            self.execute_update(query, (
+    def _order_item_rows(self, order_id: int, items: List[Dict]) -> List[tuple]:
+        """Build order_items parameter rows"""
+        return [
+            (
                 order_id,
                 item['product_id'],
                 item['quantity'],
                 item['unit_price'],
                 item['total_price'],
                 item.get('selected_size'),
-                json.dumps(item.get('customizations', {})),
+                orjson.dumps(item.get('customizations', {})).decode(),
                 item.get('notes')
-            ))
+            )
+            for item in items
+        ]
+        
+    def add_order_items(self, order_id: int, items: List[Dict]) -> None:
+        """Add items to an order"""
+        self.execute_many(self.ORDER_ITEM_INSERT, self._order_item_rows(order_id, items))
             
     def get_order_by_id(self, order_id: int) -> Optional[Dict]:
         """Get order by ID with items"""
@@ -487,11 +855,7 @@ class OrderService(DatabaseService):
         
         # Process items
         for item in items:
-            if item.get('customizations'):
-                try:
-                    item['customizations'] = json.loads(item['customizations'])
-                except:
-                    item['customizations'] = {}
+            _decode_json_field(item, 'customizations')
                     
             # Add product object
             item['product'] = {
@@ -506,50 +870,106 @@ class OrderService(DatabaseService):
                 item.pop(field, None)
                 
         # Process order
-        if order.get('shipping_address'):
-            try:
-                order['shipping_address'] = json.loads(order['shipping_address'])
-            except:
-                order['shipping_address'] = {}
-                
-        if order.get('billing_address'):
-            try:
-                order['billing_address'] = json.loads(order['billing_address'])
-            except:
-                order['billing_address'] = {}
+        _decode_json_field(order, 'shipping_address')
+        _decode_json_field(order, 'billing_address')
                 
         order['order_items'] = items
         return order
         
-    def get_orders(self, user_id: Optional[int] = None, limit: int = 50) -> List[Dict]:
-        """Get orders with optional user filter"""
-        query = """
-            SELECT * FROM orders
-        """
+    def _order_filters(self, user_id: Optional[int], after_created_at: Optional[str],
+                       after_id: Optional[int]) -> Tuple[str, List]:
+        """Build the WHERE clause shared by the order listings"""
+        conditions = []
         params = []
         
         if user_id:
-            query += " WHERE user_id = ?"
+            conditions.append("o.user_id = ?")
             params.append(user_id)
             
-        query += " ORDER BY created_at DESC LIMIT ?"
-        params.append(limit)
+        if after_id is not None:
+            conditions.append("(o.created_at, o.id) < (?, ?)")
+            params.extend([after_created_at, after_id])
+            
+        where_clause = " AND ".join(conditions) if conditions else "1=1"
+        return where_clause, params
         
-        orders = self.execute_query(query, params)
+    def get_orders(self, user_id: Optional[int] = None, limit: int = 50,
+                   after_created_at: Optional[str] = None, after_id: Optional[int] = None) -> List[Dict]:
+        """
+        Get orders with optional user filter, newest first.
+        
+        The next page starts after the last order returned: pass its created_at
+        and id as after_created_at/after_id.
+        """
+        where_clause, params = self._order_filters(user_id, after_created_at, after_id)
+        query = f"""
+            SELECT o.* FROM orders o
+            WHERE {where_clause}
+            ORDER BY o.created_at DESC, o.id DESC LIMIT ?
+        """
+        params.append(limit)
         
-        # Process orders
-        for order in orders:
-            if order.get('shipping_address'):
-                try:
-                    order['shipping_address'] = json.loads(order['shipping_address'])
-                except:
-                    order['shipping_address'] = {}
+        # Process orders as they are fetched
+        orders = []
+        for order in self.execute_query_iter(query, params):
+            _decode_json_field(order, 'shipping_address')
+            _decode_json_field(order, 'billing_address')
+            orders.append(order)
                     
-            if order.get('billing_address'):
-                try:
-                    order['billing_address'] = json.loads(order['billing_address'])
-                except:
-                    order['billing_address'] = {}
+        return orders
+        
+    def get_orders_with_items(self, user_id: Optional[int] = None, limit: int = 50,
+                              after_created_at: Optional[str] = None,
+                              after_id: Optional[int] = None) -> List[Dict]:
+        """
+        Get orders like get_orders, each with its order_items as returned by
+        get_order_by_id, in a single query.
+        """
+        where_clause, params = self._order_filters(user_id, after_created_at, after_id)
+        # Items are gathered per order by SQLite; the LIMIT applies to orders, not item rows
+        query = f"""
+            SELECT 
+                o.*,
+                (
+                    SELECT json_group_array(json_object(
+                        'id', oi.id,
+                        'order_id', oi.order_id,
+                        'product_id', oi.product_id,
+                        'quantity', oi.quantity,
+                        'unit_price', oi.unit_price,
+                        'total_price', oi.total_price,
+                        'selected_size', oi.selected_size,
+                        'customizations', oi.customizations,
+                        'notes', oi.notes,
+                        'created_at', oi.created_at,
+                        'product', json_object(
+                            'id', oi.product_id,
+                            'name', p.name,
+                            'description', p.description,
+                            'image', p.image_url
+                        )
+                    ))
+                    FROM order_items oi
+                    JOIN products p ON oi.product_id = p.id
+                    WHERE oi.order_id = o.id
+                ) as items_json
+            FROM orders o
+            WHERE {where_clause}
+            ORDER BY o.created_at DESC, o.id DESC LIMIT ?
+        """
+        params.append(limit)
+        
+        # Process orders as they are fetched
+        orders = []
+        for order in self.execute_query_iter(query, params):
+            _decode_json_field(order, 'shipping_address')
+            _decode_json_field(order, 'billing_address')
+            
+            items = orjson.loads(order.pop('items_json'))
+            for item in items:
+                _decode_json_field(item, 'customizations')
+            order['order_items'] = items
+            orders.append(order)
                     
         return orders
 
@@ -584,6 +1004,9 @@ class ChatService(DatabaseService):
             ) VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
         """
         
+        if SUPPORTS_RETURNING:
+            return self.execute_returning(query + " RETURNING *", (session_id, role, content, intent, agent))
+            
         self.execute_update(query, (session_id, role, content, intent, agent))
         
         # Get the inserted message
@@ -598,16 +1021,29 @@ class ChatService(DatabaseService):
         results = self.execute_query(query, (message_id,))
         return results[0] if results else None
         
-    def get_chat_history(self, session_id: str, limit: int = 50) -> List[Dict]:
-        """Get chat history for a session"""
+    def get_chat_history(self, session_id: str, limit: Optional[int] = 20) -> List[tuple]:
+        """
+        Get the most recent messages of a session, oldest first (all of them when limit is None).
+        Messages are read-only namedtuples (msg.role, msg.content, ...) rather than dicts.
+        """
+        if limit is None:
+            query = """
+                SELECT * FROM chat_messages 
+                WHERE session_id = ?
+                ORDER BY created_at ASC, id ASC
+            """
+            return list(self.execute_query_records(query, (session_id,)))
+        
+        # Take the newest `limit` rows, then restore chronological order
         query = """
             SELECT * FROM chat_messages 
             WHERE session_id = ?
-            ORDER BY created_at ASC
+            ORDER BY created_at DESC, id DESC
             LIMIT ?
         """
-        
-        return self.execute_query(query, (session_id, limit))
+        results = list(self.execute_query_records(query, (session_id, limit)))
+        results.reverse()
+        return results
         
     def update_session_timestamp(self, session_id: str) -> None:
         """Update session timestamp"""
@@ -617,51 +1053,75 @@ class ChatService(DatabaseService):
             WHERE session_id = ?
         """
         self.execute_update(query, (session_id,))
+        
+    def finalize_turn(self, session_id: str, user_message: str, assistant_message: str,
+                      intent: Optional[str] = None, agent: Optional[str] = None) -> None:
+        """Store a completed chat turn (session, both messages, timestamp) in one transaction"""
+        with self.transaction() as conn:
+            conn.execute("""
+                INSERT OR IGNORE INTO chat_sessions (session_id, user_id, created_at, updated_at)
+                VALUES (?, NULL, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            """, (session_id,))
+            conn.executemany("""
+                INSERT INTO chat_messages (
+                    session_id, role, content, intent, agent, created_at
+                ) VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            """, [
+                (session_id, "user", user_message, None, None),
+                (session_id, "assistant", assistant_message, intent, agent)
+            ])
+            conn.execute("""
+                UPDATE chat_sessions 
+                SET updated_at = CURRENT_TIMESTAMP
+                WHERE session_id = ?
+            """, (session_id,))
 
 class UserService(DatabaseService):
     """Service for user-related database operations"""
     
     def create_user(self, user_data: Dict[str, Any]) -> Dict:
         """Create a new user"""
-        try:
-            # Extract name and split into first_name and last_name
-            name = user_data.get('name', '')
-            name_parts = name.split(' ', 1)
-            first_name = name_parts[0] if name_parts else ''
-            last_name = name_parts[1] if len(name_parts) > 1 else ''
+        # Extract name and split into first_name and last_name
+        name = user_data.get('name', '')
+        name_parts = name.split(' ', 1)
+        first_name = name_parts[0] if name_parts else ''
+        last_name = name_parts[1] if len(name_parts) > 1 else ''
+        
+        query = """
+            INSERT INTO users (
+                email, password_hash, first_name, last_name, phone,
+                is_active, is_admin, created_at, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        """
+        params = (
+            user_data['email'], 
+            user_data['password_hash'], 
+            first_name, 
+            last_name, 
+            user_data.get('phone'), 
+            user_data.get('is_active', True), 
+            user_data.get('is_admin', False)
+        )
+        
+        if SUPPORTS_RETURNING:
+            # Same columns as get_user_by_id
+            return self.execute_returning(query + """
+                RETURNING id, email, first_name, last_name, phone, is_active, is_admin,
+                          created_at, updated_at
+            """, params)
             
-            query = """
-                INSERT INTO users (
-                    email, password_hash, first_name, last_name, phone,
-                    is_active, is_admin, created_at, updated_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-            """
+        self.execute_update(query, params)
+        user_id = self.get_last_insert_id()
+        user = self.get_user_by_id(user_id)
+        
+        if user is None:
+            # If we can't get the user by ID, try to get it by email
+            user = self.get_user_by_email(user_data['email'])
             
-            self.execute_update(query, (
-                user_data['email'], 
-                user_data['password_hash'], 
-                first_name, 
-                last_name, 
-                user_data.get('phone'), 
-                user_data.get('is_active', True), 
-                user_data.get('is_admin', False)
-            ))
-            
-            user_id = self.get_last_insert_id()
-            user = self.get_user_by_id(user_id)
-            
-            if user is None:
-                # If we can't get the user by ID, try to get it by email
-                user = self.get_user_by_email(user_data['email'])
-                
-            if user is None:
-                raise Exception(f"Failed to create user with email {user_data['email']}")
-                
-            return user
+        if user is None:
+            raise Exception(f"Failed to create user with email {user_data['email']}")
             
-        except Exception as e:
-            logger.error(f"Error creating user: {e}")
-            raise
+        return user
         
     def get_user_by_id(self, user_id: int) -> Optional[Dict]:
         """Get user by ID"""
@@ -683,6 +1143,15 @@ class UserService(DatabaseService):
         results = self.execute_query(query, (email,))
         return results[0] if results else None
         
+    def update_password_hash(self, user_id: int, password_hash: str) -> bool:
+        """Replace a user's stored password hash"""
+        query = """
+            UPDATE users 
+            SET password_hash = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """
+        return self.execute_update(query, (password_hash, user_id)) > 0
+        
     def authenticate_user(self, email: str, password_hash: str) -> Optional[Dict]:
         """Authenticate user with email and password"""
         query = """
@@ -0,0 +1,62 @@
+import argparse
+import sqlite3
+from pathlib import Path
+
+# The app's database, next to this script regardless of the working directory
+DB_PATH = Path(__file__).parent / 'coffee_shop.db'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merge duplicate cart_items lines and add the unique cart line index'
+    )
+    parser.add_argument('db_path', nargs='?', default=str(DB_PATH),
+                        help=f'SQLite database to migrate (default: {DB_PATH})')
+    db_path = parser.parse_args().db_path
+
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+
+    # 1. Merge duplicate cart lines (same user, product, size, customizations) into the oldest row
+    c.execute('''
+        UPDATE cart_items
+        SET quantity = (
+                SELECT SUM(d.quantity) FROM cart_items d
+                WHERE d.user_id = cart_items.user_id AND d.product_id = cart_items.product_id
+                      AND IFNULL(d.selected_size, '') = IFNULL(cart_items.selected_size, '')
+                      AND IFNULL(d.customizations, '') = IFNULL(cart_items.customizations, '')
+            ),
+            total_price = unit_price * (
+                SELECT SUM(d.quantity) FROM cart_items d
+                WHERE d.user_id = cart_items.user_id AND d.product_id = cart_items.product_id
+                      AND IFNULL(d.selected_size, '') = IFNULL(cart_items.selected_size, '')
+                      AND IFNULL(d.customizations, '') = IFNULL(cart_items.customizations, '')
+            )
+        WHERE id IN (
+            SELECT MIN(id) FROM cart_items
+            GROUP BY user_id, product_id, IFNULL(selected_size, ''), IFNULL(customizations, '')
+            HAVING COUNT(*) > 1
+        )
+    ''')
+    c.execute('''
+        DELETE FROM cart_items
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM cart_items
+            GROUP BY user_id, product_id, IFNULL(selected_size, ''), IFNULL(customizations, '')
+        )
+    ''')
+
+    # 2. One row per cart line, so add_to_cart can upsert
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_items_unique
+        ON cart_items(user_id, product_id, IFNULL(selected_size, ''), IFNULL(customizations, ''))
+    ''')
+
+    conn.commit()
+    conn.close()
+
+    print('Migration complete: cart_items lines made unique.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import sqlite3
+
+DB_PATH = 'database/coffee_shop.db'
+
+conn = sqlite3.connect(DB_PATH)
+c = conn.cursor()
+
+# 1. Create the full-text index over product names and descriptions
+c.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description,
+        content='products', content_rowid='id',
+        tokenize='trigram'
+    )
+''')
+
+# 2. Keep it in sync with products
+c.execute('''
+    CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+''')
+c.execute('''
+    CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    END
+''')
+c.execute('''
+    CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO products_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END
+''')
+
+# 3. Index the existing products
+c.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+conn.commit()
+conn.close()
+
+print('Migration complete: products_fts search index created.')
@@ -11,22 +11,215 @@ import os
 from pathlib import Path
 from decimal import Decimal
 import re
+import functools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from operator import itemgetter
+from datetime import datetime, timezone
+
+# Bulk-load settings: no fsync until close(); a crash mid-import needs the import rerun
+FAST_LOAD_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+)
+
+# Same settings as the application's connection pool
+SAFE_LOAD_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+)
+
+# CSV columns read by migrate_products, in prepare_product_row's order
+CSV_COLUMNS = (
+    'product_id', 'product_group', 'product_category', 'product_type', 'product',
+    'product_description', 'unit_of_measure', 'current_wholesale_price',
+    'current_retail_price', 'tax_exempt_yn', 'promo_yn', 'new_product_yn',
+)
+
+# One staged products row, in INSERT_PRODUCT_SQL's column order; executemany
+# binds it like any plain tuple
+ProductRow = namedtuple('ProductRow', (
+    'product_id', 'name', 'description', 'product_group_id', 'category_id',
+    'product_type_id', 'unit_of_measure', 'wholesale_price', 'retail_price',
+    'tax_exempt', 'is_promo', 'is_new', 'is_active', 'is_popular', 'image_url',
+    'rating', 'nutrition_info', 'created_at', 'updated_at',
+))
+
+# Parameters are the ProductRows built by prepare_product_row
+INSERT_PRODUCT_SQL = """
+    INSERT OR REPLACE INTO products (
+        product_id, name, description, product_group_id, category_id, 
+        product_type_id, unit_of_measure, wholesale_price, retail_price,
+        tax_exempt, is_promo, is_new, is_active, is_popular, image_url,
+        rating, nutrition_info, created_at, updated_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Same import done in SQL over the csv extension's virtual table; short rows and
+# rows whose product_id is not a plain integer are skipped, like the Python path's bad rows
+INSERT_PRODUCT_FROM_CSV_SQL = """
+    INSERT OR REPLACE INTO products (
+        product_id, name, description, product_group_id, category_id, 
+        product_type_id, unit_of_measure, wholesale_price, retail_price,
+        tax_exempt, is_promo, is_new, is_active, is_popular, image_url,
+        rating, nutrition_info, created_at, updated_at
+    )
+    SELECT CAST(product_id AS INTEGER), name, description, product_group_id(product_group),
+           category_id(product_group, product_category), product_type_id(product_type),
+           unit_of_measure, wholesale_price, retail_price,
+           tax_exempt, is_promo, is_new, 1,
+           retail_price > 15.0 OR instr(lower(name), 'espresso') > 0
+               OR instr(lower(product_type), 'premium') > 0,
+           image_url(product_type), product_rating(retail_price), nutrition_info(product_type),
+           ?, ?
+    FROM (
+        SELECT trim(product_id) AS product_id, trim(product) AS name,
+               trim(product_description) AS description,
+               trim(product_group) AS product_group, trim(product_category) AS product_category,
+               trim(product_type) AS product_type, trim(unit_of_measure) AS unit_of_measure,
+               clean_price(current_wholesale_price) AS wholesale_price,
+               clean_price(current_retail_price) AS retail_price,
+               upper(tax_exempt_yn) = 'Y' AS tax_exempt, upper(promo_yn) = 'Y' AS is_promo,
+               upper(new_product_yn) = 'Y' AS is_new
+        FROM temp.raw_products
+        -- Short rows read as NULLs, and || is NULL if any part is
+        WHERE (product_id || product_group || product_category || product_type || product
+               || product_description || unit_of_measure || current_wholesale_price
+               || current_retail_price || tax_exempt_yn || promo_yn || new_product_yn) IS NOT NULL
+          AND trim(product_id) <> '' AND trim(product_id) NOT GLOB '*[^0-9]*'
+    )
+"""
+
+# SQLite csv extension (ext/misc/csv.c) to load; a name on the library path or a file path
+CSV_EXTENSION = os.environ.get('SQLITE_CSV_EXTENSION', 'csv')
+
+# Read buffer for the product CSV (the default is 8 KiB)
+CSV_READ_BUFFER = 1024 * 1024
+
+# CSVs at least this long are transformed in a process pool; below it, startup costs more than it saves
+PARALLEL_MIN_ROWS = 20000
+
+# Prepared statements kept per connection (sqlite3's default is 128)
+CACHED_STATEMENTS = 256
+
+# str.translate table deleting every ASCII character except digits and '.'
+PRICE_STRIP = str.maketrans('', '', ''.join(
+    chr(c) for c in range(128) if not (chr(c).isdigit() or chr(c) == '.')
+))
+
+# Map CSV categories to database categories
+CATEGORY_MAPPING = {
+    'Whole Bean/Teas': {
+        'Coffee beans': 6,
+        'Loose Tea': 7,
+        'Packaged Chocolate': 8
+    },
+    'Beverages': {
+        'Coffee': 9,
+        'Tea': 10,
+        'Drinking Chocolate': 11
+    },
+    'Food': {
+        'Bakery': 12
+    },
+    'Merchandise': {
+        'Branded': 13
+    },
+    'Add-ons': {
+        'Flavours': 14
+    }
+}
+
+# Flattened (product_group, product_category) -> category ID, one hash lookup per row
+CATEGORY_IDS = {
+    (group, category): category_id
+    for group, categories in CATEGORY_MAPPING.items()
+    for category, category_id in categories.items()
+}
+
+PRODUCT_TYPE_IDS = {
+    'Organic Beans': 1,
+    'House blend Beans': 2,
+    'Espresso Beans': 3,
+    'Gourmet Beans': 4,
+    'Premium Beans': 5,
+    'Green beans': 6,
+    'Herbal tea': 7,
+    'Black tea': 8,
+    'Green tea': 9,
+    'Chai tea': 10,
+    'Drinking Chocolate': 11,
+    'Organic Chocolate': 12,
+    'Drip coffee': 13,
+    'Organic brewed coffee': 14,
+    'Gourmet brewed coffee': 15,
+    'Premium brewed coffee': 16,
+    'Barista Espresso': 17,
+    'Seasonal drink': 18,
+    'Specialty coffee': 19,
+    'Brewed herbal tea': 20,
+    'Brewed Green tea': 21,
+    'Brewed Black tea': 22,
+    'Brewed Chai tea': 23,
+    'Hot chocolate': 24,
+    'Pastry': 26,
+    'Scone': 27,
+    'Biscotti': 28,
+    'Clothing': 29,
+    'Housewares': 30,
+    'Regular syrup': 31,
+    'Sugar free syrup': 32
+}
+
+PRODUCT_GROUP_IDS = {
+    'Whole Bean/Teas': 1,
+    'Beverages': 2,
+    'Food': 3,
+    'Merchandise': 4,
+    'Add-ons': 5
+}
+
+# Map product types to relevant coffee/tea images
+IMAGE_MAPPING = {
+    'Coffee beans': '1442517655-1b1b1b1b1b1b',
+    'Loose Tea': '1442517655-2b2b2b2b2b2b',
+    'Coffee': '1442517655-3b3b3b3b3b3b',
+    'Tea': '1442517655-4b4b4b4b4b4b',
+    'Bakery': '1442517655-5b5b5b5b5b5b',
+    'Merchandise': '1442517655-6b6b6b6b6b6b',
+    'Add-ons': '1442517655-7b7b7b7b7b7b'
+}
 
 class DatabaseMigrator:
-    def __init__(self, db_path="coffee_shop.db"):
+    def __init__(self, db_path="coffee_shop.db", fast_load=True):
         self.db_path = db_path
+        self.fast_load = fast_load
         self.conn = None
         self.cursor = None
         
     def connect(self):
         """Connect to SQLite database"""
-        self.conn = sqlite3.connect(self.db_path)
+        # Autocommit mode: transactions are opened explicitly with BEGIN
+        self.conn = sqlite3.connect(
+            self.db_path, isolation_level=None, cached_statements=CACHED_STATEMENTS
+        )
         self.cursor = self.conn.cursor()
+        for pragma in FAST_LOAD_PRAGMAS if self.fast_load else SAFE_LOAD_PRAGMAS:
+            self.cursor.execute(pragma)
         print(f"Connected to database: {self.db_path}")
         
     def close(self):
         """Close database connection"""
         if self.conn:
+            if self.fast_load:
+                # Checkpoint with full syncing so the bulk load is on disk before we exit
+                self.cursor.execute("PRAGMA synchronous=FULL")
+                self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
             self.conn.close()
             print("Database connection closed")
             
@@ -42,10 +235,17 @@ class DatabaseMigrator:
         
     def clean_price(self, price_str):
         """Clean and convert price string to decimal"""
+        if isinstance(price_str, (int, float)):
+            return float(price_str)
         if not price_str:
             return 0.0
             
         # Remove currency symbols and whitespace
+        try:
+            return float(str(price_str).translate(PRICE_STRIP))
+        except ValueError:
+            pass
+        # Non-ASCII symbols or digits: the slower regex scan
         cleaned = re.sub(r'[^\d.]', '', str(price_str))
         try:
             return float(cleaned)
@@ -54,106 +254,34 @@ class DatabaseMigrator:
             
     def get_category_id(self, product_group, product_category, product_type):
         """Get category ID based on product classification"""
-        # Map CSV categories to database categories
-        category_mapping = {
-            'Whole Bean/Teas': {
-                'Coffee beans': 6,
-                'Loose Tea': 7,
-                'Packaged Chocolate': 8
-            },
-            'Beverages': {
-                'Coffee': 9,
-                'Tea': 10,
-                'Drinking Chocolate': 11
-            },
-            'Food': {
-                'Bakery': 12
-            },
-            'Merchandise': {
-                'Branded': 13
-            },
-            'Add-ons': {
-                'Flavours': 14
-            }
-        }
-        
-        return category_mapping.get(product_group, {}).get(product_category, 1)
+        return CATEGORY_IDS.get((product_group, product_category), 1)
         
     def get_product_type_id(self, product_type):
         """Get product type ID based on product type name"""
-        type_mapping = {
-            'Organic Beans': 1,
-            'House blend Beans': 2,
-            'Espresso Beans': 3,
-            'Gourmet Beans': 4,
-            'Premium Beans': 5,
-            'Green beans': 6,
-            'Herbal tea': 7,
-            'Black tea': 8,
-            'Green tea': 9,
-            'Chai tea': 10,
-            'Drinking Chocolate': 11,
-            'Organic Chocolate': 12,
-            'Drip coffee': 13,
-            'Organic brewed coffee': 14,
-            'Gourmet brewed coffee': 15,
-            'Premium brewed coffee': 16,
-            'Barista Espresso': 17,
-            'Seasonal drink': 18,
-            'Specialty coffee': 19,
-            'Brewed herbal tea': 20,
-            'Brewed Green tea': 21,
-            'Brewed Black tea': 22,
-            'Brewed Chai tea': 23,
-            'Hot chocolate': 24,
-            'Pastry': 26,
-            'Scone': 27,
-            'Biscotti': 28,
-            'Clothing': 29,
-            'Housewares': 30,
-            'Regular syrup': 31,
-            'Sugar free syrup': 32
-        }
-        
-        return type_mapping.get(product_type, 1)
+        return PRODUCT_TYPE_IDS.get(product_type, 1)
         
     def get_product_group_id(self, product_group):
         """Get product group ID"""
-        group_mapping = {
-            'Whole Bean/Teas': 1,
-            'Beverages': 2,
-            'Food': 3,
-            'Merchandise': 4,
-            'Add-ons': 5
-        }
-        
-        return group_mapping.get(product_group, 1)
+        return PRODUCT_GROUP_IDS.get(product_group, 1)
         
-    def generate_image_url(self, product_name, product_type):
-        """Generate placeholder image URL based on product type"""
+    @staticmethod
+    @functools.lru_cache(maxsize=128)
+    def generate_image_url(product_type):
+        """Generate placeholder image URL based on product type (cached per type)"""
         base_url = "https://images.unsplash.com/photo-"
         
-        # Map product types to relevant coffee/tea images
-        image_mapping = {
-            'Coffee beans': '1442517655-1b1b1b1b1b1b',
-            'Loose Tea': '1442517655-2b2b2b2b2b2b',
-            'Coffee': '1442517655-3b3b3b3b3b3b',
-            'Tea': '1442517655-4b4b4b4b4b4b',
-            'Bakery': '1442517655-5b5b5b5b5b5b',
-            'Merchandise': '1442517655-6b6b6b6b6b6b',
-            'Add-ons': '1442517655-7b7b7b7b7b7b'
-        }
-        
         # Find matching category
-        for category, image_id in image_mapping.items():
+        for category, image_id in IMAGE_MAPPING.items():
             if category.lower() in product_type.lower():
                 return f"{base_url}{image_id}?w=400&h=300&fit=crop"
                 
         # Default coffee image
         return f"{base_url}1442517655-1b1b1b1b1b1b?w=400&h=300&fit=crop"
         
-    def generate_nutrition_info(self, product_name, product_type):
-        """Generate placeholder nutrition info"""
+    @staticmethod
+    @functools.lru_cache(maxsize=128)
+    def generate_nutrition_info(product_type):
+        """Generate placeholder nutrition info as a JSON string (cached per type)"""
         nutrition_templates = {
             'Coffee': {
                 'calories': 5,
@@ -203,70 +331,211 @@ class DatabaseMigrator:
             
         return json.dumps(template)
         
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def product_rating(retail_price):
+        """Generate rating (placeholder, cached per price)"""
+        rating = round(4.0 + (retail_price / 50.0), 1)  # Higher price = slightly higher rating
+        return min(5.0, max(3.5, rating))  # Keep between 3.5 and 5.0
+        
+    def prepare_product_row(self, values, timestamp):
+        """Build the products ProductRow from one row's CSV_COLUMNS values"""
+        (product_id, product_group, product_category, product_type, name, description,
+         unit_of_measure, wholesale_price, retail_price, tax_exempt, is_promo, is_new) = values
+        
+        # Clean and prepare data
+        product_id = int(product_id)
+        name = name.strip()
+        description = description.strip()
+        product_group = product_group.strip()
+        product_category = product_category.strip()
+        product_type = product_type.strip()
+        unit_of_measure = unit_of_measure.strip()
+        
+        # Clean prices
+        wholesale_price = self.clean_price(wholesale_price)
+        retail_price = self.clean_price(retail_price)
+        
+        # Convert Y/N to boolean
+        tax_exempt = tax_exempt.upper() == 'Y'
+        is_promo = is_promo.upper() == 'Y'
+        is_new = is_new.upper() == 'Y'
+        
+        # Get IDs
+        category_id = self.get_category_id(product_group, product_category, product_type)
+        product_type_id = self.get_product_type_id(product_type)
+        product_group_id = self.get_product_group_id(product_group)
+        
+        # Generate additional data
+        image_url = self.generate_image_url(product_type)
+        nutrition_info = self.generate_nutrition_info(product_type)
+        
+        # Determine if product is popular (based on price and type)
+        is_popular = retail_price > 15.0 or 'espresso' in name.lower() or 'premium' in product_type.lower()
+        
+        rating = self.product_rating(retail_price)
+        
+        return ProductRow(
+            product_id, name, description, product_group_id, category_id,
+            product_type_id, unit_of_measure, wholesale_price, retail_price,
+            tax_exempt, is_promo, is_new, True, is_popular, image_url,
+            rating, nutrition_info, timestamp, timestamp
+        )
+        
+    def drop_indexes(self, table):
+        """Drop a table's secondary indexes and return their CREATE statements"""
+        # Autoindexes (sql IS NULL) and unique indexes stay: INSERT OR REPLACE relies on them
+        self.cursor.execute("""
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL
+              AND sql NOT LIKE 'CREATE UNIQUE%'
+        """, (table,))
+        indexes = self.cursor.fetchall()
+        for name, _ in indexes:
+            self.cursor.execute(f'DROP INDEX "{name}"')
+        return [sql for _, sql in indexes]
+        
+    def create_indexes(self, statements):
+        """Recreate indexes from their stored CREATE statements"""
+        for sql in statements:
+            self.cursor.execute(sql)
+            
+    def prepare_product_rows(self, rows, pick, timestamp):
+        """
+        Prepare (line_number, csv_row) pairs for the insert.
+        Returns the ProductRows and the (line_number, error) of each bad row.
+        """
+        good_rows = []
+        bad_rows = []
+        for line_number, row in rows:
+            try:
+                good_rows.append(self.prepare_product_row(pick(row), timestamp))
+            except Exception as e:
+                bad_rows.append((line_number, str(e)))
+        return good_rows, bad_rows
+        
+    def load_csv_extension(self):
+        """Load SQLite's CSV virtual table extension; False when it is not available"""
+        try:
+            self.conn.enable_load_extension(True)
+            try:
+                self.conn.load_extension(CSV_EXTENSION)
+            finally:
+                self.conn.enable_load_extension(False)
+            return True
+        except (AttributeError, sqlite3.Error):
+            # AttributeError: Python built without extension loading
+            return False
+            
+    def register_product_functions(self):
+        """Expose the row cleanup helpers to SQL for INSERT_PRODUCT_FROM_CSV_SQL"""
+        functions = {
+            'clean_price': (1, self.clean_price),
+            'category_id': (2, lambda group, category: CATEGORY_IDS.get((group, category), 1)),
+            'product_type_id': (1, self.get_product_type_id),
+            'product_group_id': (1, self.get_product_group_id),
+            'image_url': (1, self.generate_image_url),
+            'nutrition_info': (1, self.generate_nutrition_info),
+            'product_rating': (1, self.product_rating),
+        }
+        for name, (narg, func) in functions.items():
+            self.conn.create_function(name, narg, func, deterministic=True)
+            
+    def insert_products_native(self, csv_path, timestamp):
+        """
+        Insert products with one INSERT ... SELECT over a CSV virtual table,
+        so the rows never pass through Python. Returns the number of rows skipped.
+        """
+        self.register_product_functions()
+        # Virtual table arguments are literal text, not bound parameters
+        filename = str(csv_path).replace("'", "''")
+        self.cursor.execute(
+            f"CREATE VIRTUAL TABLE temp.raw_products USING csv(filename='{filename}', header=YES)"
+        )
+        try:
+            self.cursor.execute("SELECT COUNT(*) FROM temp.raw_products")
+            total = self.cursor.fetchone()[0]
+            self.cursor.execute(INSERT_PRODUCT_FROM_CSV_SQL, (timestamp, timestamp))
+            return total - self.cursor.rowcount
+        finally:
+            self.cursor.execute("DROP TABLE temp.raw_products")
+            
+    def read_product_rows(self, csv_path, timestamp):
+        """
+        Read and prepare every CSV row.
+        Returns the ProductRows and the (line_number, error) of each bad row.
+        """
+        # newline='' as the csv module expects; a large buffer means fewer read() calls
+        with open(csv_path, 'r', encoding='utf-8', newline='', buffering=CSV_READ_BUFFER) as file:
+            if hasattr(os, 'posix_fadvise'):
+                # The file is read front to back once: ask for aggressive readahead
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            reader = csv.reader(file)
+            
+            # Resolve the column positions once; rows are then plain lists
+            header = next(reader, [])
+            missing = [name for name in CSV_COLUMNS if name not in header]
+            if missing:
+                raise ValueError(f"CSV file is missing columns: {', '.join(missing)}")
+            pick = itemgetter(*(header.index(name) for name in CSV_COLUMNS))
+            
+            # Line numbers count the header as line 1
+            rows = [(line_number, row) for line_number, row in enumerate(reader, start=2) if row]
+            
+        # Validate every row up front; bad rows are reported and left out of the insert
+        workers = os.cpu_count() or 1
+        if len(rows) < PARALLEL_MIN_ROWS or workers == 1:
+            good_rows, bad_rows = self.prepare_product_rows(rows, pick, timestamp)
+        else:
+            # Rows are independent: transform chunks in worker processes, insert here
+            chunk_size = len(rows) // workers + 1
+            chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+            good_rows = []
+            bad_rows = []
+            with ProcessPoolExecutor(workers) as executor:
+                for chunk_good, chunk_bad in executor.map(
+                    _prepare_product_chunk, chunks, repeat(pick), repeat(timestamp)
+                ):
+                    good_rows.extend(chunk_good)
+                    bad_rows.extend(chunk_bad)
+        return good_rows, bad_rows
+        
     def migrate_products(self, csv_path):
         """Migrate products from CSV to database"""
         print(f"Migrating products from {csv_path}...")
         
-        with open(csv_path, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
+        # Same text format as CURRENT_TIMESTAMP, computed once for the whole import
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        
+        # SQLite's CSV extension when it can be loaded, otherwise the Python reader
+        native = self.load_csv_extension()
+        if native:
+            print("Reading the CSV through the SQLite csv extension")
+        else:
+            good_rows, bad_rows = self.read_product_rows(csv_path, timestamp)
+            for line_number, error in bad_rows:
+                print(f"Error migrating product on line {line_number}: {error}")
+            skipped = len(bad_rows)
             
-            for row in reader:
-                try:
-                    # Clean and prepare data
-                    product_id = int(row['product_id'])
-                    name = row['product'].strip()
-                    description = row['product_description'].strip()
-                    product_group = row['product_group'].strip()
-                    product_category = row['product_category'].strip()
-                    product_type = row['product_type'].strip()
-                    unit_of_measure = row['unit_of_measure'].strip()
-                    
-                    # Clean prices
-                    wholesale_price = self.clean_price(row['current_wholesale_price'])
-                    retail_price = self.clean_price(row['current_retail_price'])
-                    
-                    # Convert Y/N to boolean
-                    tax_exempt = row['tax_exempt_yn'].upper() == 'Y'
-                    is_promo = row['promo_yn'].upper() == 'Y'
-                    is_new = row['new_product_yn'].upper() == 'Y'
-                    
-                    # Get IDs
-                    category_id = self.get_category_id(product_group, product_category, product_type)
-                    product_type_id = self.get_product_type_id(product_type)
-                    product_group_id = self.get_product_group_id(product_group)
-                    
-                    # Generate additional data
-                    image_url = self.generate_image_url(name, product_type)
-                    nutrition_info = self.generate_nutrition_info(name, product_type)
-                    
-                    # Determine if product is popular (based on price and type)
-                    is_popular = retail_price > 15.0 or 'espresso' in name.lower() or 'premium' in product_type.lower()
-                    
-                    # Generate rating (placeholder)
-                    rating = round(4.0 + (retail_price / 50.0), 1)  # Higher price = slightly higher rating
-                    rating = min(5.0, max(3.5, rating))  # Keep between 3.5 and 5.0
-                    
-                    # Insert product
-                    self.cursor.execute("""
-                        INSERT OR REPLACE INTO products (
-                            product_id, name, description, product_group_id, category_id, 
-                            product_type_id, unit_of_measure, wholesale_price, retail_price,
-                            tax_exempt, is_promo, is_new, is_active, is_popular, image_url,
-                            rating, nutrition_info, created_at, updated_at
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 
-                                CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                    """, (
-                        product_id, name, description, product_group_id, category_id,
-                        product_type_id, unit_of_measure, wholesale_price, retail_price,
-                        tax_exempt, is_promo, is_new, True, is_popular, image_url,
-                        rating, nutrition_info
-                    ))
-                    
-                except Exception as e:
-                    print(f"Error migrating product {row.get('product_id', 'unknown')}: {e}")
-                    continue
-                    
-        self.conn.commit()
+        # One insert in one transaction; indexes are built once after the insert
+        # instead of being updated row by row
+        self.cursor.execute("BEGIN")
+        with self.conn:
+            index_statements = self.drop_indexes("products")
+            if native:
+                skipped = self.insert_products_native(csv_path, timestamp)
+            else:
+                self.cursor.executemany(INSERT_PRODUCT_SQL, good_rows)
+            self.create_indexes(index_statements)
+            
+            # INSERT OR REPLACE does not fire the delete trigger, so rebuild the search index
+            self.cursor.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+            
+        # Fresh planner statistics for the rebuilt indexes
+        self.cursor.execute("ANALYZE products")
+        
+        if skipped:
+            print(f"Skipped {skipped} invalid product rows")
         print("Products migration completed")
         
     def create_sample_user(self):
@@ -289,8 +558,12 @@ class DatabaseMigrator:
         except Exception as e:
             print(f"Error creating sample user: {e}")
             
-    def run_migration(self, csv_path):
-        """Run complete migration process"""
+    def run_migration(self, csv_path, keep_open=False):
+        """
+        Run complete migration process.
+        With keep_open, a successful run leaves self.conn open for the caller,
+        who then calls close().
+        """
         try:
             print("Starting CSV to Database Migration...")
             
@@ -313,9 +586,15 @@ class DatabaseMigrator:
             
         except Exception as e:
             print(f"Migration failed: {e}")
+            keep_open = False
             raise
         finally:
-            self.close()
+            if not keep_open:
+                self.close()
+
+def _prepare_product_chunk(rows, pick, timestamp):
+    """Process-pool worker: prepare one chunk of CSV rows"""
+    return DatabaseMigrator().prepare_product_rows(rows, pick, timestamp)
 
 def main():
     """Main migration function"""
@@ -2,47 +2,85 @@ import sqlite3
 
 DB_PATH = 'database/coffee_shop.db'
 
-conn = sqlite3.connect(DB_PATH)
+# ALTER TABLE ... DROP COLUMN needs SQLite 3.35+
+SUPPORTS_DROP_COLUMN = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Autocommit mode: the migration opens its own transaction
+conn = sqlite3.connect(DB_PATH, isolation_level=None)
 c = conn.cursor()
 
-# 1. Backup existing cart_items data (excluding session_id)
-c.execute('''
-    CREATE TABLE IF NOT EXISTS cart_items_backup AS 
-    SELECT id, user_id, product_id, quantity, selected_size, customizations, unit_price, total_price, created_at, updated_at 
-    FROM cart_items
-''')
-
-# 2. Drop the old cart_items table
-c.execute('DROP TABLE IF EXISTS cart_items')
-
-# 3. Recreate the new cart_items table without session_id
-c.execute('''
-    CREATE TABLE cart_items (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        product_id INTEGER NOT NULL,
-        quantity INTEGER NOT NULL DEFAULT 1,
-        selected_size VARCHAR(50),
-        customizations TEXT,
-        unit_price DECIMAL(10,2) NOT NULL,
-        total_price DECIMAL(10,2) NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users(id),
-        FOREIGN KEY (product_id) REFERENCES products(id)
-    )
-''')
-
-# 4. Restore data from backup
-c.execute('''
-    INSERT INTO cart_items (id, user_id, product_id, quantity, selected_size, customizations, unit_price, total_price, created_at, updated_at)
-    SELECT id, user_id, product_id, quantity, selected_size, customizations, unit_price, total_price, created_at, updated_at FROM cart_items_backup
-''')
-
-# 5. Drop the backup table
-c.execute('DROP TABLE IF EXISTS cart_items_backup')
-
-conn.commit()
+columns = [row[1] for row in c.execute('PRAGMA table_info(cart_items)')]
+if 'session_id' not in columns:
+    conn.close()
+    print('Nothing to migrate: cart_items has no session_id column.')
+    raise SystemExit(0)
+
+if SUPPORTS_DROP_COLUMN:
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        # DROP COLUMN refuses indexed columns, so drop the session_id indexes first
+        indexes = c.execute('''
+            SELECT name FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = 'cart_items' AND sql LIKE '%session_id%'
+        ''').fetchall()
+        for (name,) in indexes:
+            c.execute(f'DROP INDEX "{name}"')
+
+        # One internal rewrite of the table
+        c.execute('ALTER TABLE cart_items DROP COLUMN session_id')
+        c.execute('COMMIT')
+    except BaseException:
+        c.execute('ROLLBACK')
+        raise
+else:
+    # Foreign keys stay off while cart_items is dropped and recreated
+    # (this pragma is a no-op inside a transaction, so it is set first)
+    c.execute('PRAGMA foreign_keys=OFF')
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        # 1. Backup existing cart_items data (excluding session_id)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS cart_items_backup AS
+            SELECT id, user_id, product_id, quantity, selected_size, customizations, unit_price, total_price, created_at, updated_at
+            FROM cart_items
+        ''')
+
+        # 2. Drop the old cart_items table
+        c.execute('DROP TABLE IF EXISTS cart_items')
+
+        # 3. Recreate the new cart_items table without session_id
+        c.execute('''
+            CREATE TABLE cart_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                product_id INTEGER NOT NULL,
+                quantity INTEGER NOT NULL DEFAULT 1,
+                selected_size VARCHAR(50),
+                customizations TEXT,
+                unit_price DECIMAL(10,2) NOT NULL,
+                total_price DECIMAL(10,2) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (product_id) REFERENCES products(id)
+            )
+        ''')
+
+        # 4. Restore data from backup
+        c.execute('''
+            INSERT INTO cart_items (id, user_id, product_id, quantity, selected_size, customizations, unit_price, total_price, created_at, updated_at)
+            SELECT id, user_id, product_id, quantity, selected_size, customizations, unit_price, total_price, created_at, updated_at FROM cart_items_backup
+        ''')
+
+        # 5. Drop the backup table
+        c.execute('DROP TABLE IF EXISTS cart_items_backup')
+        c.execute('COMMIT')
+    except BaseException:
+        c.execute('ROLLBACK')
+        raise
+    finally:
+        c.execute('PRAGMA foreign_keys=ON')
+
 conn.close()
 
-print('Migration complete: session_id removed from cart_items table.') 
\ No newline at end of file
+print('Migration complete: session_id removed from cart_items table.')
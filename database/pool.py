@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Database Connection Pool
+Hands out one configured SQLite connection per thread for the database services
+"""
+
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Applied once when a thread opens its connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Compiled statements kept per connection (sqlite3 default is 128); large enough
+# for every fixed query plus the filter combinations get_products builds
+CACHED_STATEMENTS = 512
+
+class ConnectionPool:
+    """Thread-local SQLite connections shared by every service using the pool"""
+
+    def __init__(self, db_path: str = "database/coffee_shop.db"):
+        self.db_path = db_path
+        self._local = threading.local()
+        # Every connection opened by the pool, so close_all can reach other threads' ones
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def get_conn(self) -> sqlite3.Connection:
+        """Get this thread's connection, opening and configuring it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode: transactions are opened explicitly with BEGIN
+            # check_same_thread is off only so close_all can run at shutdown;
+            # a connection is otherwise used by the thread that opened it
+            conn = sqlite3.connect(
+                self.db_path,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=CACHED_STATEMENTS
+            )
+            conn.row_factory = sqlite3.Row  # Enable dict-like access
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+            logger.debug(f"Opened SQLite connection to {self.db_path} in {threading.current_thread().name}")
+        return conn
+
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            with self._lock:
+                self._connections.remove(conn)
+            conn.close()
+            self._local.conn = None
+
+    def close_all(self):
+        """Close the connections of every thread (process shutdown)"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"Error closing SQLite connection to {self.db_path}: {e}")
+        # Threads that keep running reopen on their next get_conn
+        self._local = threading.local()
@@ -156,15 +156,44 @@ CREATE TABLE IF NOT EXISTS order_items (
     FOREIGN KEY (product_id) REFERENCES products(id)
 );
 
+-- Full-text index over product names and descriptions for search; the trigram
+-- tokenizer matches substrings like the LIKE '%term%' it replaces (terms of 3+ chars)
+CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+    name, description,
+    content='products', content_rowid='id',
+    tokenize='trigram'
+);
+
+-- Keep products_fts in sync with products
+CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+    INSERT INTO products_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+    INSERT INTO products_fts(products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+    INSERT INTO products_fts(products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    INSERT INTO products_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+END;
+
 -- Create indexes for better performance
 CREATE INDEX IF NOT EXISTS idx_products_category ON products(category_id);
 CREATE INDEX IF NOT EXISTS idx_products_active ON products(is_active);
 CREATE INDEX IF NOT EXISTS idx_products_popular ON products(is_popular);
-CREATE INDEX IF NOT EXISTS idx_cart_session ON cart_items(session_id);
+CREATE INDEX IF NOT EXISTS idx_products_sort ON products(is_popular DESC, retail_price DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_products_category_sort ON products(category_id, is_popular DESC, retail_price DESC, id DESC);
 CREATE INDEX IF NOT EXISTS idx_cart_user ON cart_items(user_id);
+CREATE INDEX IF NOT EXISTS idx_cart_items_user ON cart_items(user_id, created_at DESC);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_items_unique ON cart_items(user_id, product_id, IFNULL(selected_size, ''), IFNULL(customizations, ''));
 CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id);
 CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
+CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id);
 CREATE INDEX IF NOT EXISTS idx_chat_session ON chat_messages(session_id);
+CREATE INDEX IF NOT EXISTS idx_chat_messages_session ON chat_messages(session_id, created_at, id);
 CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
 
 -- Insert default categories
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Database Writer
+Runs single-statement writes on one dedicated thread, batching queued writes
+into shared transactions
+"""
+
+import atexit
+import queue
+import sqlite3
+import threading
+import logging
+from concurrent.futures import Future
+from typing import List, Tuple
+
+from database.pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Most writes committed together in one transaction
+WRITE_BATCH_SIZE = 64
+
+class SQLiteWriter:
+    """
+    FIFO write queue served by a single thread that owns its own pooled
+    connection. Writes waiting in the queue are drained together and
+    committed in one BEGIN IMMEDIATE ... COMMIT; each write runs in its own
+    savepoint, so a failing statement only fails its own future.
+    """
+
+    def __init__(self, pool: ConnectionPool, batch_size: int = WRITE_BATCH_SIZE):
+        self.pool = pool
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run, name=f"sqlite-writer-{pool.db_path}", daemon=True
+        )
+        self._thread.start()
+        # Registered after the pools' handler, so pending writes flush before connections close
+        atexit.register(self.close)
+
+    def submit(self, query: str, params: tuple = ()) -> Future:
+        """Queue a write; the future resolves to its rowcount once committed"""
+        future = Future()
+        self._queue.put((query, params, future))
+        return future
+
+    def close(self, timeout: float = 5.0):
+        """Finish the queued writes and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _run(self):
+        conn = self.pool.get_conn()
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._write_batch(conn, batch)
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[Tuple[str, tuple, Future]]):
+        """Run a batch in one transaction and resolve its futures after the commit"""
+        # Callers that gave up (cancelled) are skipped
+        batch = [entry for entry in batch if entry[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for query, params, future in batch:
+                conn.execute("SAVEPOINT queued_write")
+                try:
+                    rowcount = conn.execute(query, params).rowcount
+                    conn.execute("RELEASE queued_write")
+                    outcomes.append((future, rowcount, None))
+                except sqlite3.Error as e:
+                    conn.execute("ROLLBACK TO queued_write")
+                    conn.execute("RELEASE queued_write")
+                    outcomes.append((future, None, e))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Database batch write error: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for future, rowcount, error in outcomes:
+            if error is not None:
+                logger.error(f"Database update error: {error}")
+                future.set_exception(error)
+            else:
+                future.set_result(rowcount)
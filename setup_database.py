@@ -8,7 +8,11 @@ import os
 import sys
 from pathlib import Path
 import sqlite3
-import subprocess
+
+from database.migrate_csv_to_db import DatabaseMigrator
+
+DB_PATH = Path("database/coffee_shop.db")
+CSV_PATH = Path("chatbot_rag-main/product.csv")
 
 def check_dependencies():
     """Check if required dependencies are available"""
@@ -21,68 +25,56 @@ def check_dependencies():
         return False
     print(f"Python {python_version.major}.{python_version.minor}.{python_version.micro}")
     
-    # Check if required modules are available
-    try:
-        import sqlite3
-        print("SQLite3 module available")
-    except ImportError:
-        print("SQLite3 module not available")
-        return False
-        
-    try:
-        import csv
-        print("CSV module available")
-    except ImportError:
-        print("CSV module not available")
-        return False
-        
-    try:
-        import json
-        print("JSON module available")
-    except ImportError:
-        print("JSON module not available")
-        return False
+    # sqlite3, csv and json are stdlib; only the SQLite library version varies
+    print(f"SQLite {sqlite3.sqlite_version}")
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        print("SQLite before 3.35: RETURNING and DROP COLUMN unavailable, slower fallbacks are used")
         
     return True
 
 def create_database_directory():
     """Create database directory if it doesn't exist"""
-    db_dir = Path("database")
-    db_dir.mkdir(exist_ok=True)
+    db_dir = DB_PATH.parent
+    os.makedirs(db_dir, exist_ok=True)
     print(f"Database directory created: {db_dir}")
     return db_dir
 
 def run_migration():
-    """Run the CSV to database migration"""
+    """
+    Run the CSV to database migration in this process.
+    Returns the migrator with its connection still open, or None on failure.
+    """
     print("\nRunning database migration...")
     
-    migration_script = Path("database/migrate_csv_to_db.py")
-    if not migration_script.exists():
-        print(f"Migration script not found: {migration_script}")
-        return False
+    if not CSV_PATH.exists():
+        print(f"CSV file not found: {CSV_PATH}")
+        return None
         
+    migrator = DatabaseMigrator(db_path=str(DB_PATH))
     try:
-        result = subprocess.run([sys.executable, str(migration_script)], 
-                              capture_output=True, text=True, check=True)
-        print(result.stdout)
-        return True
-    except subprocess.CalledProcessError as e:
+        migrator.run_migration(str(CSV_PATH), keep_open=True)
+        return migrator
+    except Exception as e:
         print(f"Migration failed: {e}")
-        print(f"Error output: {e.stderr}")
-        return False
+        return None
 
-def verify_database():
-    """Verify the database was created correctly"""
+def verify_database(conn=None):
+    """Verify the database was created correctly, on conn if given"""
     print("\nVerifying database...")
     
-    db_path = Path("database/coffee_shop.db")
-    if not db_path.exists():
-        print(f"Database file not found: {db_path}")
-        return False
+    own_conn = conn is None
+    if own_conn:
+        # Read-only open: fails on a missing file rather than creating it
+        try:
+            conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+        except sqlite3.OperationalError:
+            print(f"Database file not found: {DB_PATH}")
+            return False
         
+    cursor = conn.cursor()
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+        # Verification only reads
+        cursor.execute("PRAGMA query_only=1")
         
         # Check tables
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
@@ -101,17 +93,15 @@ def verify_database():
             
         print(f"All tables created: {len(tables)} tables")
         
-        # Check data
-        cursor.execute("SELECT COUNT(*) FROM products")
-        product_count = cursor.fetchone()[0]
+        # Check data (all three counts in one query)
+        cursor.execute("""
+            SELECT (SELECT COUNT(*) FROM products),
+                   (SELECT COUNT(*) FROM categories),
+                   (SELECT COUNT(*) FROM users)
+        """)
+        product_count, category_count, user_count = cursor.fetchone()
         print(f"Products imported: {product_count} products")
-        
-        cursor.execute("SELECT COUNT(*) FROM categories")
-        category_count = cursor.fetchone()[0]
         print(f"Categories created: {category_count} categories")
-        
-        cursor.execute("SELECT COUNT(*) FROM users")
-        user_count = cursor.fetchone()[0]
         print(f"Users created: {user_count} users")
         
         # Check sample data
@@ -119,12 +109,16 @@ def verify_database():
         sample_products = cursor.fetchall()
         print(f"Sample products: {len(sample_products)} products found")
         
-        conn.close()
         return True
         
     except Exception as e:
         print(f"Database verification failed: {e}")
         return False
+    finally:
+        if own_conn:
+            conn.close()
+        else:
+            cursor.execute("PRAGMA query_only=0")
 
 def test_database_operations():
     """Test basic database operations"""
@@ -163,16 +157,27 @@ def create_backup():
     """Create a backup of the database"""
     print("\nCreating database backup...")
     
-    db_path = Path("database/coffee_shop.db")
-    backup_path = Path("database/coffee_shop_backup.db")
+    backup_path = DB_PATH.with_name("coffee_shop_backup.db")
     
-    if not db_path.exists():
+    # Read-only open fails on a missing file instead of creating an empty one,
+    # so it doubles as the existence check
+    try:
+        source = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
         print("Database file not found for backup")
         return False
         
     try:
-        import shutil
-        shutil.copy2(db_path, backup_path)
+        # Online backup: copies live pages through SQLite, consistent even with
+        # WAL content or another writer, in 1000-page steps
+        try:
+            target = sqlite3.connect(backup_path)
+            try:
+                source.backup(target, pages=1000)
+            finally:
+                target.close()
+        finally:
+            source.close()
         print(f"Database backup created: {backup_path}")
         return True
     except Exception as e:
@@ -184,8 +189,8 @@ def main():
     print("Coffee AI Database Setup")
     print("=" * 50)
     
-    # Check dependencies
-    if not check_dependencies():
+    # Check dependencies (COFFEE_AI_SKIP_DEPCHECK=1 skips this, e.g. in CI)
+    if os.environ.get("COFFEE_AI_SKIP_DEPCHECK") != "1" and not check_dependencies():
         print("\nSetup failed: Missing dependencies")
         return False
         
@@ -193,12 +198,17 @@ def main():
     create_database_directory()
     
     # Run migration
-    if not run_migration():
+    migrator = run_migration()
+    if migrator is None:
         print("\nSetup failed: Migration failed")
         return False
         
-    # Verify database
-    if not verify_database():
+    # Verify database on the migration's connection
+    try:
+        verified = verify_database(migrator.conn)
+    finally:
+        migrator.close()
+    if not verified:
         print("\nSetup failed: Database verification failed")
         return False
         
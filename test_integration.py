@@ -4,15 +4,21 @@ Integration test script for Coffee AI Backend-Frontend
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
 import sys
 from pathlib import Path
 
+# One pooled session for every probe, so requests to the same host reuse
+# their keep-alive connection instead of reconnecting each time
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 def test_backend_health():
     """Test if backend is running and healthy"""
     try:
-        response = requests.get("http://localhost:8000/", timeout=5)
+        response = session.get("http://localhost:8000/", timeout=5)
         if response.status_code == 200:
             print("✅ Backend health check passed")
             return True
@@ -29,7 +35,7 @@ def test_api_endpoints():
     
     # Test API root
     try:
-        response = requests.get(f"{base_url}/api/v1/")
+        response = session.get(f"{base_url}/api/v1/")
         if response.status_code == 200:
             print("✅ API root endpoint working")
         else:
@@ -39,7 +45,7 @@ def test_api_endpoints():
     
     # Test products endpoint
     try:
-        response = requests.get(f"{base_url}/api/v1/products/")
+        response = session.get(f"{base_url}/api/v1/products/")
         if response.status_code == 200:
             data = response.json()
             print(f"✅ Products endpoint working - {len(data.get('products', []))} products loaded")
@@ -50,7 +56,7 @@ def test_api_endpoints():
     
     # Test session endpoint
     try:
-        response = requests.get(f"{base_url}/api/v1/session-id/")
+        response = session.get(f"{base_url}/api/v1/session-id/")
         if response.status_code == 200:
             data = response.json()
             print(f"✅ Session endpoint working - Session ID: {data.get('session_id', 'N/A')}")
@@ -62,7 +68,7 @@ def test_api_endpoints():
 def test_chatbot_endpoint():
     """Test chatbot endpoint"""
     try:
-        response = requests.post(
+        response = session.post(
             "http://localhost:8000/api/chatbot",
             json={
                 "message": "Hello, can you help me find a good coffee?",
@@ -86,7 +92,7 @@ def test_chatbot_endpoint():
 def test_frontend_connectivity():
     """Test if frontend can connect to backend"""
     try:
-        response = requests.get("http://localhost:5173", timeout=5)
+        response = session.get("http://localhost:5173", timeout=5)
         if response.status_code == 200:
             print("✅ Frontend is accessible")
             return True
@@ -14,11 +14,18 @@ from database.db_service import UserService
 import hashlib
 import secrets
 
+# Same scrypt cost and hash format as the backend (chatbot_rag-main/main.py)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
 def hash_password(password: str) -> str:
-    """Hash password using SHA-256 with salt"""
-    salt = secrets.token_hex(16)
-    hash_obj = hashlib.sha256((password + salt).encode())
-    return f"{salt}${hash_obj.hexdigest()}"
+    """Hash password with scrypt, as the backend does at registration"""
+    salt = secrets.token_bytes(16)
+    derived = hashlib.scrypt(
+        password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, maxmem=0, dklen=32
+    )
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${derived.hex()}"
 
 def test_registration():
     """Test the registration process"""